@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Cluster node definition
+
+These are the classes that we will use to run several heartbeat servers
+(nodes) together as a cluster, so that the pinging is spread out across the
+nodes and losing a node doesn't leave any servers unmonitored.
+
+Every node keeps the full set of tracked servers (in its own server tracker,
+dump file, and journal), but each server is only pinged by a single node, its
+owner.  Owners are picked by consistent hashing: every node is placed at
+a number of points on a hash ring, and each server is owned by the node at
+the first point after the server's own hash.  When a node joins or leaves,
+only the servers next to its points change owner.
+
+The nodes keep track of each other by heartbeating: once a second, each node
+asks every other node for the statuses of the servers it owns (which are only
+sent in full if anything has changed since the last time we asked).  A node
+that hasn't answered for a few seconds is taken off the ring, and its servers
+are picked up by the remaining nodes on their next scheduled pings (every node
+keeps every server on schedule, whether it owns it or not).  Once the node
+answers again, it goes back on the ring and takes its servers back.
+
+Adding, updating, and removing servers through any node is passed along
+to every other node.  The changes are queued up for each node, and handed
+over in the order they were made: any that don't make it (e.g., because the
+node is down, or the request fails) are tried again every time that node
+answers our heartbeat.  If too many build up for a node, they are dropped,
+and the node is instead asked (as part of our next heartbeat to it) to copy
+the set of tracked servers from us.  A node that starts up while others are
+already running copies the set of tracked servers (along with their ping
+intervals and probe specs) from one of them (replacing the servers it read
+back in from its own dump file), so that it picks up any changes it missed
+while it was down.
+
+To try out a cluster on a single machine, run each node from its own
+directory (so that they each have their own dump file), e.g.
+    HEARTBEAT_NODE=127.0.0.1:5001 HEARTBEAT_PEERS=127.0.0.1:5002,127.0.0.1:5003
+        python HeartbeatServer.py
+and likewise for 127.0.0.1:5002 and 127.0.0.1:5003.
+
+
+Methods:
+--------
+HashRing.owner(server name)
+    - returns the node that owns the given server
+
+ClusterNode.start() / ClusterNode.stop()
+    - copies the tracked servers from another node (if any are up) and
+    starts heartbeating the other nodes, or stops heartbeating them
+
+ClusterNode.ownsServer(server name)
+    - returns whether this node is the one to ping the given server
+
+ClusterNode.replicate(list of changes)
+    - passes along changes made through this node to every other node
+    (queuing them up for any node they don't make it to)
+
+ClusterNode.sendPending(list of nodes)
+    - tries again to pass along the changes queued up for the given nodes
+
+ClusterNode.syncFromPeers(list of nodes)
+    - copies the tracked servers from the first of the given nodes
+    (or of every other node) that answers
+
+ClusterNode.resyncFrom(node)
+    - copies the tracked servers from the given node in the background,
+    when it asks us to
+
+ClusterNode.applyChanges(list of changes)
+    - applies changes passed along from another node
+
+ClusterNode.statusReport(version)
+    - returns the statuses of the servers this node owns, for another node's
+    heartbeat (or nothing, if they haven't changed since the given version)
+
+ClusterNode.describe()
+    - returns a dictionary describing the cluster, as this node sees it
+"""
+# imports
+import bisect
+import hashlib
+import threading
+import requests
+from HeartbeatLoop import HeartbeatLoop
+from ProbeTypes import parseProbeSpec
+from PingScheduler import monotonicTime
+import Instrumentation
+
+# global for how often we heartbeat the other nodes, in seconds
+default_cluster_tick = 1
+# global for how long a node can go without answering before we take it
+# off the ring, in seconds
+default_peer_timeout = 3
+# global for the number of points each node gets on the hash ring
+default_virtual_nodes = 100
+# global for the (connect, read) timeouts of requests to other nodes
+peer_request_timeouts = (0.5, 2)
+# global for the probe spec of the default HTTP ping
+default_probe = {'type': 'http'}
+# global for the most changes we'll queue up for another node before we
+# give up on passing them along, and have it copy our servers instead
+default_pending_limit = 100000
+
+
+def ringPosition(key):
+    """
+    Returns the position of the given key (a node or server name) on the
+    hash ring, as a 64 bit integer
+
+    Uses an MD5 of the key (rather than Python's own hash), so that every
+    node agrees on the positions, and they don't change between runs
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class HashRing:
+
+    def __init__(self, nodes, virtual_nodes = default_virtual_nodes):
+        """
+        Initialization function
+
+        :param nodes = the nodes to place on the ring
+        :param virtual_nodes = the number of points each node gets
+        """
+        self.members = sorted(nodes)
+        points = []
+        for node in self.members:
+            for index in xrange(virtual_nodes):
+                points.append((ringPosition('{0}#{1}'.format(node, index)),
+                               node))
+        points.sort()
+        self.positions = [position for position, node in points]
+        self.nodes = [node for position, node in points]
+
+
+    def owner(self, server_name):
+        """
+        Returns the node that owns the given server
+        (or None if there are no nodes on the ring)
+        """
+        if not self.positions:
+            return None
+        # the first point after the server's own position,
+        # wrapping around to the start of the ring
+        index = bisect.bisect(self.positions, ringPosition(server_name))
+        return self.nodes[index % len(self.nodes)]
+
+
+class ClusterNode:
+
+    def __init__(self, node, peers, tracker, lock, publish_status,
+                 cluster_tick = default_cluster_tick,
+                 peer_timeout = default_peer_timeout,
+                 pending_limit = default_pending_limit):
+        """
+        Initialization function
+
+        :param node = the address (host:port) of this node
+        :param peers = the addresses of the other nodes
+        :param tracker = this node's server tracker
+        :param lock = the lock to hold while using the tracker
+        :param publish_status = function that publishes a fresh status
+        snapshot (see StatusSnapshot.py) if any statuses have changed,
+        and returns the latest one
+        :param cluster_tick = how often to heartbeat the other nodes, in seconds
+        :param peer_timeout = how long another node can go without answering
+        before we take it off the ring, in seconds
+        :param pending_limit = most changes to queue up for another node
+        before having it copy our servers instead
+        """
+        self.node = node
+        self.peers = [peer for peer in peers if peer != node]
+        self.tracker = tracker
+        self.lock = lock
+        self.publish_status = publish_status
+        self.peer_timeout = peer_timeout
+        # one session for every request to the other nodes,
+        # so that the connections to them are reused
+        self.session = requests.Session()
+        # the last (monotonic) time we heard from each node
+        # (nodes we haven't heard from yet are taken to be down)
+        self.last_seen = {}
+        # the version of each node's statuses that we last received
+        self.peer_versions = dict((peer, None) for peer in self.peers)
+        self.members_lock = threading.Lock()
+        # the batches of changes still to pass along to each node, in order,
+        # along with the number of changes in them, and the nodes to ask to
+        # copy our servers instead (once too many changes have built up)
+        self.pending_limit = pending_limit
+        self.pending_changes = dict((peer, []) for peer in self.peers)
+        self.pending_counts = dict((peer, 0) for peer in self.peers)
+        self.resync_peers = set()
+        self.pending_lock = threading.Lock()
+        # held while passing along changes to each node, so that they are
+        # never passed along out of order
+        self.send_locks = dict((peer, threading.Lock()) for peer in self.peers)
+        # whether we're copying the servers from another node at its request
+        self.resyncing = False
+        # the hash ring of the nodes that are up (starting with just us)
+        self.ring = HashRing([node])
+        Instrumentation.cluster_members.set(1)
+        self.heartbeat_loop = HeartbeatLoop(self.heartbeatPeers, cluster_tick)
+        # only ping the servers we own
+        tracker.owns = self.ownsServer
+
+
+    def start(self):
+        """
+        Copies the tracked servers from another node (if any are up),
+        and starts heartbeating the other nodes
+        """
+        self.syncFromPeers()
+        self.heartbeat_loop.start()
+        return
+
+
+    def stop(self, timeout = None):
+        """
+        Stops heartbeating the other nodes
+        """
+        return self.heartbeat_loop.stop(drain = True, timeout = timeout)
+
+
+    def ownsServer(self, server_name):
+        """
+        Returns whether we are the node to ping the given server
+        """
+        return self.ring.owner(server_name) == self.node
+
+
+    def _request(self, method, peer, path, **kwargs):
+        """
+        Sends a request to another node, returning the JSON it answers with
+        (raising a requests.RequestException or ValueError if it doesn't)
+        """
+        response = self.session.request(method, 'http://{0}{1}'.format(peer, path),
+                                        timeout = peer_request_timeouts, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+
+    def heardFrom(self, peer):
+        """
+        Records that we've just heard from another node
+        """
+        if peer in self.peer_versions:
+            with self.members_lock:
+                self.last_seen[peer] = monotonicTime()
+        return
+
+
+    def livePeers(self):
+        """
+        Returns the other nodes that we've heard from recently
+        """
+        now = monotonicTime()
+        with self.members_lock:
+            return [peer for peer in self.peers if peer in self.last_seen and
+                    now - self.last_seen[peer] <= self.peer_timeout]
+
+
+    def updateRing(self):
+        """
+        Rebuilds the hash ring if any nodes have come up or gone down
+        """
+        members = sorted([self.node] + self.livePeers())
+        if members != self.ring.members:
+            # swapping in the new ring is a single assignment,
+            # so the tracker never sees a half-built one
+            self.ring = HashRing(members)
+            Instrumentation.cluster_members.set(len(members))
+            print 'Cluster members now: {0}'.format(', '.join(members))
+        return
+
+
+    def syncFromPeers(self, peers = None):
+        """
+        Copies the set of tracked servers from the first other node that
+        answers, unless it isn't tracking any servers (e.g., when the whole
+        cluster is starting up at once)
+
+        :param peers = the nodes to copy from, if not every other node
+        (in which case we'll copy from them even if they aren't tracking
+        any servers)
+        """
+        resyncing = peers is not None
+        if peers is None:
+            peers = self.peers
+        for peer in peers:
+            try:
+                body = self._request('GET', peer, '/cluster/servers')
+            except (requests.RequestException, ValueError):
+                continue
+            self.heardFrom(peer)
+            # make sure the node is on the ring before taking its word for
+            # the statuses of the servers it owns
+            self.updateRing()
+            rows = body['servers']
+            if not rows and not resyncing:
+                continue
+            peer_probes = body.get('probes', {})
+            known = dict((server, interval) for server, interval, status
+                         in self.publish_status().rows)
+            with self.lock:
+                known_probes = self.tracker.probeSpecs()
+                peer_servers = set(server for server, interval, status in rows)
+                self.tracker.removeServers([server for server in known
+                                            if server not in peer_servers])
+                # (servers the other node doesn't list a probe spec for
+                # are given the default HTTP ping)
+                self.tracker.addServers([(server, interval,
+                                          parseProbeSpec(peer_probes.get(server,
+                                                                         default_probe)))
+                                         for server, interval, status in rows
+                                         if known.get(server) != interval or
+                                         known_probes.get(server) !=
+                                         peer_probes.get(server)])
+                self.tracker.applyStatuses(dict((server, status) for server,
+                                                interval, status in rows))
+            self.publish_status()
+            print 'Copied {0} tracked servers from {1}'.format(len(rows), peer)
+            break
+        self.updateRing()
+        return
+
+
+    def heartbeatPeers(self):
+        """
+        Asks every other node for the statuses of the servers it owns,
+        and updates the ring with the nodes that answered
+
+        Called every cluster tick by our heartbeat loop
+        """
+        for peer in self.peers:
+            params = {'node': self.node, 'since': self.peer_versions[peer]}
+            # (asking it to copy our servers, if we've given up on passing
+            # along our changes to it)
+            with self.pending_lock:
+                asked_to_resync = peer in self.resync_peers
+            if asked_to_resync:
+                params['resync'] = 1
+            try:
+                body = self._request('GET', peer, '/cluster/heartbeat',
+                                     params = params)
+            except (requests.RequestException, ValueError):
+                continue
+            self.heardFrom(peer)
+            with self.pending_lock:
+                if asked_to_resync:
+                    self.resync_peers.discard(peer)
+            # make sure the node is on the ring before taking its word for
+            # the statuses of the servers it owns
+            self.updateRing()
+            # along with any changes it has yet to take
+            self.sendPending([peer])
+            if body['statuses'] is not None:
+                with self.lock:
+                    self.tracker.applyStatuses(body['statuses'])
+                self.peer_versions[peer] = body['version']
+                self.publish_status()
+        self.updateRing()
+        return None
+
+
+    def statusReport(self, version):
+        """
+        Answers another node's heartbeat
+
+        :param version = the version of our statuses the other node
+        last received (as a string, or None)
+
+        Returns a dictionary of our current version and the statuses of the
+        servers we own (or None for the statuses, if the version hasn't changed)
+        """
+        snapshot = self.publish_status()
+        report = {'node': self.node, 'version': snapshot.version,
+                  'statuses': None}
+        if version != str(snapshot.version):
+            report['statuses'] = dict((server, status) for server, interval, status
+                                      in snapshot.rows
+                                      if self.ownsServer(server))
+        return report
+
+
+    def replicate(self, changes):
+        """
+        Passes along changes made through this node to every other node
+
+        The changes are queued up for every node, and passed along straight
+        away to those that are up (any that don't make it are tried again
+        on our next heartbeat to that node, see sendPending())
+
+        :param changes = list of {'op': 'add' or 'remove', 'server': server
+        name, 'interval': ping interval or None, 'probe': probe spec
+        (as a JSON string) or None} dictionaries
+        """
+        if not changes:
+            return
+        with self.pending_lock:
+            for peer in self.peers:
+                if peer in self.resync_peers:
+                    # it'll pick these up when it copies our servers
+                    continue
+                self.pending_changes[peer].append(changes)
+                self.pending_counts[peer] += len(changes)
+                if self.pending_counts[peer] > self.pending_limit:
+                    print 'Too many changes queued up for {0}, will have it ' \
+                          'copy our servers instead'.format(peer)
+                    self.pending_changes[peer] = []
+                    self.pending_counts[peer] = 0
+                    self.resync_peers.add(peer)
+        self.sendPending(self.livePeers())
+        return
+
+
+    def sendPending(self, peers):
+        """
+        Passes along the changes queued up for each of the given nodes,
+        a batch at a time and in the order they were made, stopping at the
+        first batch that doesn't make it (which is left for next time)
+
+        :param peers = the nodes to pass along changes to
+        """
+        for peer in peers:
+            with self.send_locks[peer]:
+                while True:
+                    with self.pending_lock:
+                        if not self.pending_changes[peer]:
+                            break
+                        changes = self.pending_changes[peer][0]
+                    try:
+                        self._request('POST', peer, '/cluster/replicate',
+                                      json = changes)
+                    except (requests.RequestException, ValueError):
+                        print 'Failed to pass along changes to {0}, ' \
+                              'will try again'.format(peer)
+                        break
+                    with self.pending_lock:
+                        # (unless the queue was dropped in the meantime)
+                        if self.pending_changes[peer] and \
+                           self.pending_changes[peer][0] is changes:
+                            self.pending_changes[peer].pop(0)
+                            self.pending_counts[peer] -= len(changes)
+        return
+
+
+    def resyncFrom(self, peer):
+        """
+        Copies the set of tracked servers from the given node in the
+        background (at its request, once it has given up on passing along
+        its changes to us), unless we're already doing so
+        """
+        if peer not in self.peer_versions:
+            return
+        with self.pending_lock:
+            if self.resyncing:
+                return
+            self.resyncing = True
+
+        def resync():
+            try:
+                self.syncFromPeers([peer])
+            finally:
+                with self.pending_lock:
+                    self.resyncing = False
+
+        thread = threading.Thread(target = resync, name = 'cluster-resync')
+        thread.daemon = True
+        thread.start()
+        return
+
+
+    def applyChanges(self, changes):
+        """
+        Applies changes passed along from another node
+
+        :param changes = list of changes, as given to replicate()
+        """
+        added = [(change['server'], change.get('interval'),
+                  change.get('probe') and parseProbeSpec(change['probe']))
+                 for change in changes if change['op'] == 'add']
+        removed = [change['server'] for change in changes
+                   if change['op'] == 'remove']
+        with self.lock:
+            self.tracker.addServers(added)
+            self.tracker.removeServers(removed)
+        self.publish_status()
+        return
+
+
+    def describe(self):
+        """
+        Returns a dictionary describing the cluster, as this node sees it:
+        the nodes on the ring, when we last heard from each other node
+        (and how many changes are still to be passed along to it),
+        and how many servers we own
+        """
+        now = monotonicTime()
+        live_peers = self.livePeers()
+        with self.members_lock:
+            peers = dict((peer, {'alive': peer in live_peers,
+                                 'last_seen_seconds_ago':
+                                     now - self.last_seen[peer]
+                                     if peer in self.last_seen else None})
+                         for peer in self.peers)
+        with self.pending_lock:
+            for peer in self.peers:
+                peers[peer]['pending_changes'] = self.pending_counts[peer]
+                peers[peer]['resync'] = peer in self.resync_peers
+        snapshot = self.publish_status()
+        owned_count = sum(1 for server in snapshot.names
+                          if self.ownsServer(server))
+        return {'node': self.node, 'members': self.ring.members,
+                'peers': peers, 'owned_servers': owned_count,
+                'tracked_servers': len(snapshot.names)}
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+DNS cache definition
+
+This is the class that we will use to look up the addresses of the servers
+we ping, so that every ping doesn't have to go through the (blocking) system
+resolver first.  With thousands of servers, those lookups would otherwise
+make up a good share of the time each ping takes, and a single slow resolver
+would hold up every ping waiting behind it.
+
+Each host's addresses are cached for as long as its DNS records say they may
+be (its TTL, kept between a minimum and a maximum).  If dnspython is installed
+we'll look the (A) records up with it, so that we know their TTLs; otherwise,
+or if dnspython can't find any (e.g., for a name that is only in /etc/hosts,
+or an IPv6-only host), we'll fall back on the system resolver (getaddrinfo),
+which doesn't tell us the TTL, and cache every answer for a default length
+of time instead.
+
+A host may have several addresses, which pings try in turn until one of them
+can be connected to.  An address that can't be connected to is moved to the
+back of the host's addresses, so that later pings try the others first.
+
+Lookups are done by a small pool of resolver threads:
+    - a ping to a host we don't have cached hands the lookup to the resolver
+    threads and waits on it, but only up to a timeout, so that a slow resolver
+    can only hold up a ping for so long (the lookup carries on regardless, and
+    its answer is cached for the next ping)
+    - any number of pings to the same host share a single lookup
+    - once a cached answer is most of the way through its TTL, the next ping
+    to the host kicks off a lookup in the background and carries on with the
+    cached answer, so that busy hosts never have to wait on a lookup at all
+    - hosts that couldn't be looked up are cached too (for a short while), so
+    that a server with a bad name isn't looked up again on every ping
+
+Server names that are already addresses are never looked up.
+
+
+Methods:
+--------
+splitHostPort(host)
+    - splits a host (and optional port) up into the host name
+    and the port (including its leading ':', or '' if there wasn't one)
+
+DnsCache.resolve(host name)
+    - returns an address of the given host, looking it up if need be,
+    or raises a DnsError if it can't be looked up
+
+DnsCache.resolveAll(host name)
+    - the same, but returns every address of the host, to be tried in turn
+
+DnsCache.markUnreachable(host name, address)
+    - moves an address that couldn't be connected to to the back of the
+    host's addresses
+
+DnsCache.peek(host name)
+    - returns a cached address of the given host, or None,
+    without ever looking it up
+"""
+# imports
+import os
+import Queue
+import socket
+import threading
+from PingScheduler import monotonicTime
+from Instrumentation import dns_lookups, dns_resolutions
+# dnspython is optional, and only needed to find out the TTLs of records
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None
+
+# global for the number of resolver threads
+default_resolver_threads = 4
+# global for the longest a ping will wait on a lookup, in seconds
+default_resolve_timeout = 2
+# global for how long we'll cache an answer whose TTL we don't know,
+# and the shortest and longest we'll cache any answer for, in seconds
+default_ttl = 60
+default_min_ttl = 5
+default_max_ttl = 3600
+# global for how long we'll cache a failed lookup, in seconds
+default_negative_ttl = 30
+# global for how far through its TTL an answer is looked up again
+# in the background
+default_refresh_ahead = 0.75
+
+
+class DnsError(Exception):
+    """
+    Raised when a host's address can't be looked up
+    """
+    pass
+
+
+def splitHostPort(host):
+    """
+    Splits a host and optional port, e.g. 'example.com:8080' or '[::1]:8080',
+    into a tuple of the host name and the port (including the leading ':',
+    or '' if there isn't a port)
+    """
+    if host.startswith('['):
+        name, bracket, port = host[1:].partition(']')
+        return name, port
+    name, colon, port = host.partition(':')
+    return name, colon + port
+
+
+def isAddress(host):
+    """
+    Returns whether the given host is already an IPv4 or IPv6 address
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+class CacheEntry(object):
+
+    __slots__ = ('addresses', 'error', 'expires', 'refresh_at')
+
+    def __init__(self, addresses, error, expires, refresh_at):
+        """
+        A cached answer for a single host
+
+        :param addresses = list of the host's addresses (None if the
+        lookup failed)
+        :param error = why the lookup failed (None if it didn't)
+        :param expires = when the answer may no longer be used
+        :param refresh_at = when the answer should be looked up again
+        in the background
+        """
+        self.addresses = addresses
+        self.error = error
+        self.expires = expires
+        self.refresh_at = refresh_at
+
+
+class PendingLookup(object):
+
+    __slots__ = ('done', 'addresses', 'error')
+
+    def __init__(self):
+        """
+        A lookup that the resolver threads are working on, which any number
+        of pings can wait on
+        """
+        self.done = threading.Event()
+        self.addresses = None
+        self.error = None
+
+
+class DnsCache:
+
+    def __init__(self, resolver_threads = default_resolver_threads,
+                 resolve_timeout = default_resolve_timeout,
+                 negative_ttl = default_negative_ttl,
+                 refresh_ahead = default_refresh_ahead):
+        """
+        Initialization function
+
+        :param resolver_threads = number of lookups that can be
+        in progress at once
+        :param resolve_timeout = longest a ping will wait on a lookup,
+        in seconds
+        :param negative_ttl = how long to cache a failed lookup, in seconds
+        :param refresh_ahead = how far through its TTL (between 0 and 1)
+        an answer is looked up again in the background
+        """
+        self.resolver_threads = resolver_threads
+        self.resolve_timeout = resolve_timeout
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        # held (briefly) while touching anything below
+        self.lock = threading.Lock()
+        # {host name: CacheEntry}
+        self.entries = {}
+        # {host name: PendingLookup} for every lookup in progress
+        self.pending = {}
+        # the hosts waiting on a resolver thread
+        self.lookup_queue = Queue.Queue()
+        # the resolver threads are only started once they are needed,
+        # and started again in a process forked off after that
+        # (since threads don't carry over into a forked process)
+        self.threads_pid = None
+        # when we'll next clear out the expired entries
+        self.next_sweep = monotonicTime() + default_max_ttl
+
+
+    def resolve(self, host):
+        """
+        Returns an address of the given host (the first of its addresses),
+        as for resolveAll()
+        """
+        return self.resolveAll(host)[0]
+
+
+    def resolveAll(self, host):
+        """
+        Returns every address of the given host, from the cache if we can,
+        or else looking it up (and waiting up to the resolve timeout)
+
+        :param host = the host name (without a port)
+
+        Returns a list of the addresses, in the order they should be tried,
+        or raises a DnsError if the host couldn't be looked up
+        """
+        if isAddress(host):
+            return [host]
+        host = host.lower()
+        now = monotonicTime()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry is not None and now < entry.expires:
+                if entry.addresses is None:
+                    dns_lookups.inc(labels = ('negative_hit',))
+                    raise DnsError(entry.error)
+                dns_lookups.inc(labels = ('hit',))
+                # look it up again before it expires,
+                # but carry on with what we have for now
+                if now >= entry.refresh_at:
+                    self._startThreads()
+                    if host not in self.pending:
+                        self._startLookup(host)
+                return list(entry.addresses)
+            dns_lookups.inc(labels = ('miss',))
+            self._startThreads()
+            pending = self.pending.get(host)
+            if pending is None:
+                pending = self._startLookup(host)
+
+        if not pending.done.wait(self.resolve_timeout):
+            raise DnsError('Timed out looking up {0}'.format(host))
+        if pending.addresses is None:
+            raise DnsError(pending.error)
+        return list(pending.addresses)
+
+
+    def markUnreachable(self, host, address):
+        """
+        Moves an address of the given host that couldn't be connected to
+        to the back of the host's cached addresses, so that later pings
+        try its other addresses first
+
+        :param host = the host name (without a port)
+        :param address = the address that couldn't be connected to
+        """
+        with self.lock:
+            entry = self.entries.get(host.lower())
+            if entry is not None and entry.addresses and \
+               address in entry.addresses[:-1]:
+                entry.addresses.remove(address)
+                entry.addresses.append(address)
+        return
+
+
+    def peek(self, host):
+        """
+        Returns a cached address of the given host (or the host itself, if
+        it is already an address), or None if we don't have one cached
+
+        :param host = the host name (without a port)
+        """
+        if isAddress(host):
+            return host
+        entry = self.entries.get(host.lower())
+        if entry is None or entry.addresses is None:
+            return None
+        return entry.addresses[0]
+
+
+    def _startThreads(self):
+        """
+        Starts up the resolver threads, unless they are already running
+        in this process (which must be done while holding the lock)
+        """
+        if self.threads_pid == os.getpid():
+            return
+        # any lookups in progress belonged to the threads of the process
+        # we were forked from, so they'll never finish here
+        self.threads_pid = os.getpid()
+        self.pending = {}
+        self.lookup_queue = Queue.Queue()
+        for i in xrange(self.resolver_threads):
+            thread = threading.Thread(target = self._resolverWorker,
+                                      args = (self.lookup_queue,),
+                                      name = 'resolver-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+        return
+
+
+    def _startLookup(self, host):
+        """
+        Hands a host to the resolver threads (which must be done while
+        holding the lock)
+
+        Returns the PendingLookup
+        """
+        pending = self.pending[host] = PendingLookup()
+        self.lookup_queue.put(host)
+        return pending
+
+
+    def _resolverWorker(self, lookup_queue):
+        """
+        Pulls a host off of the lookup queue, looks it up, caches the answer,
+        and wakes up every ping waiting on it
+        """
+        while True:
+            host = lookup_queue.get()
+            try:
+                addresses, ttl, error = self._lookUp(host)
+            except Exception as exception:
+                # make sure a bad lookup can never kill a resolver thread
+                addresses, ttl, error = None, None, str(exception)
+            dns_resolutions.inc(labels = ('resolved' if addresses else 'failed',))
+
+            now = monotonicTime()
+            with self.lock:
+                entry = self.entries.get(host)
+                if addresses:
+                    ttl = max(default_min_ttl, min(ttl, default_max_ttl))
+                    # (our own copy, since markUnreachable() reorders it)
+                    self.entries[host] = CacheEntry(list(addresses), None,
+                                                    now + ttl,
+                                                    now + ttl * self.refresh_ahead)
+                elif entry is None or entry.addresses is None or \
+                     now >= entry.expires:
+                    self.entries[host] = CacheEntry(None, error,
+                                                    now + self.negative_ttl,
+                                                    now + self.negative_ttl)
+                # (a failed lookup ahead of time leaves the answer we have
+                # alone, until it expires)
+                if now >= self.next_sweep:
+                    self._sweep(now)
+                pending = self.pending.pop(host)
+            pending.addresses = addresses
+            pending.error = error
+            pending.done.set()
+
+
+    def _sweep(self, now):
+        """
+        Clears out every expired entry (which must be done while holding
+        the lock), so that hosts we no longer ping don't stay cached forever
+        """
+        for host in [host for host, entry in self.entries.iteritems()
+                     if now >= entry.expires]:
+            del self.entries[host]
+        self.next_sweep = now + default_max_ttl
+        return
+
+
+    def _lookUp(self, host):
+        """
+        Looks up the addresses of a host
+
+        Returns a tuple of (list of addresses or None, TTL in seconds,
+        why the lookup failed or None)
+        """
+        if dns is not None:
+            try:
+                answer = dns.resolver.query(host, 'A')
+                return ([record.address for record in answer],
+                        answer.rrset.ttl, None)
+            except dns.exception.DNSException:
+                # (e.g., a name that is only in /etc/hosts, or an IPv6-only
+                # host, either of which the system resolver can look up for
+                # us below)
+                pass
+        try:
+            addresses = []
+            for family, socktype, proto, canonname, sockaddr in \
+                    socket.getaddrinfo(host, None, socket.AF_UNSPEC,
+                                       socket.SOCK_STREAM):
+                if sockaddr[0] not in addresses:
+                    addresses.append(sockaddr[0])
+        except (socket.error, UnicodeError) as error:
+            return None, None, 'Failed to look up {0}: {1}'.format(host, error)
+        if not addresses:
+            return None, None, 'No addresses for {0}'.format(host)
+        return addresses, default_ttl, None
+
+
+# the cache shared by every probe client that isn't given one explicitly
+default_dns_cache = DnsCache()
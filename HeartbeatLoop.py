@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Heartbeat loop definition
+
+This is the class that we will use to run the heartbeat.  Rather than
+starting up a brand new timer thread for every heartbeat, the loop runs in
+a single long-lived thread that calls the heartbeat function over and over.
+The start of each heartbeat is timed off of a monotonic clock, against a grid
+of intended start times one period apart, so the time a heartbeat takes to run
+doesn't push back every heartbeat after it.  We never wait more than a period
+for the next heartbeat, so even if the clock were to step back, the loop
+would carry on a period later rather than being held up for the whole step.
+
+The heartbeat function may return the number of seconds until it next needs
+to run (e.g., when the next server is due for a ping), in which case the next
+heartbeat starts then if it is sooner than the next point on the grid.
+
+If a heartbeat overruns (takes longer than a period, so that one or more of
+the intended start times have already gone by), the loop either:
+    skip = skips the start times that have gone by, and waits for the next
+    one (the default)
+    catch_up = runs the missed heartbeats back to back until it has caught up
+    (up to a limit, past which the rest are skipped)
+
+The loop can be stopped gracefully: the heartbeat that is running (if any)
+is allowed to finish, and then an optional function is run to drain anything
+left over (e.g., to flush changes out to disk) before the thread exits.
+
+
+Methods:
+--------
+start()
+    - starts the loop in its own (daemon) thread
+
+stop(drain, timeout)
+    - asks the loop to stop after the current heartbeat, and (if drain is set)
+    waits up to timeout seconds for it to finish and run its drain function
+
+stats()
+    - returns a dictionary of how the loop has been doing: heartbeats run,
+    overruns, heartbeats skipped, and lag (how late heartbeats started)
+"""
+# imports
+import threading
+import traceback
+from PingScheduler import monotonicTime
+import Instrumentation
+
+# global for the most missed heartbeats we'll run back to back when catching up
+default_max_catch_up = 10
+
+
+class HeartbeatLoop:
+
+    def __init__(self, heartbeat, period, missed_policy = 'skip',
+                 drain = None, max_catch_up = default_max_catch_up):
+        """
+        Initialization function
+
+        :param heartbeat = function to run every heartbeat, which may return
+        the number of seconds until it next needs to run (or None)
+        :param period = the longest we'll go between heartbeats, in seconds
+        :param missed_policy = what to do about heartbeats that were missed
+        because a heartbeat overran, either 'skip' or 'catch_up'
+        :param drain = function to run once the loop has stopped (or None)
+        :param max_catch_up = most missed heartbeats to run back to back
+        when catching up
+        """
+        if missed_policy not in ('skip', 'catch_up'):
+            raise ValueError('Missed heartbeat policy must be skip or catch_up')
+        self.heartbeat = heartbeat
+        self.period = period
+        self.missed_policy = missed_policy
+        self.drain = drain
+        self.max_catch_up = max_catch_up
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        # stats on how the loop has been doing
+        self.stats_lock = threading.Lock()
+        self.heartbeat_count = 0
+        self.overrun_count = 0
+        self.skipped_count = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+
+    def start(self):
+        """
+        Starts the loop running in its own thread
+        """
+        self.stop_event.clear()
+        self.thread = threading.Thread(target = self._run, name = 'heartbeat')
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+
+    def stop(self, drain = True, timeout = None):
+        """
+        Asks the loop to stop once the current heartbeat (if any) is done
+
+        :param drain = whether to wait for the loop to finish
+        (including running its drain function)
+        :param timeout = most seconds to wait, or None to wait as long as
+        it takes
+
+        Returns whether the loop has finished
+        """
+        self.stop_event.set()
+        if self.thread is None:
+            return True
+        if drain:
+            self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+    def _run(self):
+        """
+        The loop itself, run in the heartbeat thread
+        """
+        next_start = monotonicTime()
+        # number of missed heartbeats we've run back to back so far
+        catch_up_count = 0
+        while not self.stop_event.is_set():
+            # wait until the next heartbeat is meant to start
+            # (waking up straight away if we are asked to stop)
+            delay = next_start - monotonicTime()
+            # (which is never more than a period away, unless the clock has
+            # stepped back, in which case we move the grid back along with it)
+            if delay > self.period:
+                next_start -= delay - self.period
+                delay = self.period
+            if delay > 0 and self.stop_event.wait(delay):
+                break
+
+            start_time = monotonicTime()
+            lag = max(start_time - next_start, 0)
+            try:
+                requested_wait = self.heartbeat()
+            except Exception:
+                # a failed heartbeat shouldn't stop every heartbeat after it
+                traceback.print_exc()
+                requested_wait = None
+            end_time = monotonicTime()
+
+            # the next point on the grid of intended start times
+            grid_start = next_start + self.period
+            overran = end_time > grid_start
+            skipped = 0
+            if overran:
+                if self.missed_policy == 'catch_up' and \
+                   catch_up_count < self.max_catch_up:
+                    # run the next (missed) heartbeat straight away
+                    catch_up_count += 1
+                else:
+                    # move ahead to the first point on the grid
+                    # that hasn't gone by yet
+                    missed = int((end_time - next_start) // self.period)
+                    skipped = missed
+                    grid_start = next_start + (missed + 1) * self.period
+                    catch_up_count = 0
+            else:
+                catch_up_count = 0
+
+            next_start = grid_start
+            if requested_wait is not None:
+                next_start = min(next_start, end_time + requested_wait)
+
+            self._recordHeartbeat(lag, end_time - start_time, overran, skipped)
+
+        # we've been asked to stop, so drain anything left over
+        if self.drain is not None:
+            try:
+                self.drain()
+            except Exception:
+                traceback.print_exc()
+        return
+
+
+    def _recordHeartbeat(self, lag, duration, overran, skipped):
+        """
+        Updates our stats (and metrics) after a heartbeat
+        """
+        with self.stats_lock:
+            self.heartbeat_count += 1
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+            if overran:
+                self.overrun_count += 1
+            self.skipped_count += skipped
+        Instrumentation.tick_lag.observe(lag)
+        Instrumentation.tick_duration.observe(duration)
+        if overran:
+            Instrumentation.tick_overruns.inc()
+        if skipped:
+            Instrumentation.ticks_skipped.inc(skipped)
+        return
+
+
+    def stats(self):
+        """
+        Returns a dictionary of how the loop has been doing
+        (lags are in seconds)
+        """
+        with self.stats_lock:
+            mean_lag = None
+            if self.heartbeat_count:
+                mean_lag = self.total_lag / self.heartbeat_count
+            return {'running': self.thread is not None and self.thread.is_alive(),
+                    'heartbeats': self.heartbeat_count,
+                    'overruns': self.overrun_count,
+                    'skipped': self.skipped_count,
+                    'last_lag': self.last_lag,
+                    'max_lag': self.max_lag,
+                    'mean_lag': mean_lag}
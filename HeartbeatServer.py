@@ -12,7 +12,7 @@ our GET request pings).
 This prototype uses Flask to run the web application and imports a class
 that is defined in the script ServerTracker.py.  This separate class will
 handle the maintenance of the different servers to track, pinging the servers,
-and reading/writing to a dump file that will act as a pseudo memory file in
+and reading/writing to a state store that will act as a pseudo memory file in
 the case that the heartbeat server fails.
 
 Notable features:
@@ -20,14 +20,16 @@ Notable features:
     - remove servers to be tracked
     - pings (via HTTP GET requests) all servers currently being tracked
     (this is done passively using a background thread)
-    - keeps track of all known servers using a file stored in the
-    same directory as the ServerTracker.py file (the file name
-    of this dump 'tracking' file is defined in ServerTracker.py file as well)
+    - keeps track of all known servers using a state store kept in the
+    same directory as the ServerTracker.py file (an SQLite database by
+    default, whose file name is defined in ServerTracker.py file as well)
     
 Note: the structure of the ServerTracker attributes have been defined
-such that each server will have an associated list of two elements,
-    [time that has elapsed since last ping, ping wait time interval]
-This will allow us to ping different servers at different time intervals.
+such that each server will have an associated record of
+    (ping wait time interval, status, time of last ping)
+and a scheduler keeps track of when each server is next due for a ping.
+This will allow us to ping different servers at different time intervals
+(including intervals of less than a second).
 
 To interact with the application, the user can use HTTP GET, POST, and DELETE
 requests.  Note that this heartbeat has been created with the intention
@@ -43,7 +45,8 @@ heartbeat server to
 USAGE NOTES:
 ------------
 GET requests to the server will tell the requestor the status
-of the different servers
+of the different servers.  Servers read back in from the state store on startup
+will show as 'Unknown' until their first ping (within their first interval)
 ============
 POST requests to the server will be used to either add a new server to be
 tracked or update the wait time interval between pings for a given server.
@@ -54,66 +57,698 @@ Example POST request bodies:
     {"server":"google.com"}
     {"server":"python.org","interval":28}
     
+A server can also be given a probe spec, to ping it with something other than
+a plain HTTP request (see ProbeTypes.py for every option):
+    {"server":"db.example.com","interval":10,"probe":{"type":"tcp","port":5432}}
+    {"server":"example.com","probe":{"type":"tls","min_days":14}}
+    {"server":"example.com","probe":{"type":"http","path":"/health",
+                                     "expect":[200],"body":"OK"}}
+Posting a probe spec for a server that is already tracked changes its spec
+(and {"type":"http"} puts it back to the default HTTP ping), while posting
+without one leaves its spec as it is.
+    
 If no wait time interval between pings is specified, we'll use a default
-of 30 (which is specified in the ServerTracker class definition)
+of 30 (which is specified in the ServerTracker class definition).
+Intervals are in seconds and may be fractional, e.g. 0.5
+
+Servers that stay offline are pinged less and less often (each ping waiting
+twice as long as the last, up to five minutes), and a server's status only
+changes once a second ping shortly after the first has confirmed it (see
+ProbePolicy.py).  To cap the number of pings sent out per second, set the
+HEARTBEAT_PROBE_BUDGET environment variable, e.g.
+    HEARTBEAT_PROBE_BUDGET=500 python HeartbeatServer.py
+(when clustering, each node has its own budget)
+
+Server names that point at the same place (e.g. Google.com, google.com/,
+and google.com:80) share their pings, and a server added just after it was
+pinged is given that ping's result rather than being pinged again (see
+ProbeEngine.py).  No more than a few pings are sent to the same host at once.
+To also treat www.example.com as the same as example.com, set the
+HEARTBEAT_MERGE_WWW environment variable, e.g.
+    HEARTBEAT_MERGE_WWW=1 python HeartbeatServer.py
 ============
 DELETE requests to the server will remove a specified server from tracking.
 All we must be given is a server name
 
 Example DELETE request body:
     {"server":"facebook.com"}
+============
+POST and DELETE requests to /bulk will add/update or remove many servers
+at once.  The body can either be a JSON array of the same objects we'd
+accept for a single POST or DELETE, or newline-delimited JSON with one
+object per line.  New servers will show as 'Unknown' until the next heartbeat
+pings them.  We'll respond with a JSON array giving the result for each item.
+
+Example /bulk POST request bodies:
+    [{"server":"google.com"}, {"server":"python.org","interval":28}]
+
+    {"server":"google.com"}
+    {"server":"python.org","interval":28}
+============
+GET requests to /status will return the status of the servers as JSON,
+    {"servers": [{"server": "google.com", "interval": 30, "status": "Online"},
+                 ...],
+     "next_cursor": "google.com"}
+The following query parameters are all optional:
+    status = only return servers with this status (Online, Offline, Unknown)
+    limit = return at most this many servers
+    cursor = return the servers after this one (i.e., the next_cursor
+    from the previous page, which is null once there are no more pages)
+    format = json (the default) or csv
+GET requests to /status/<server> will return the status of a single server.
+GET requests to /stats/<server> will return how a single server has been
+responding to our pings: uptime, latency percentiles, status codes, and the
+number of recent failures of each kind (dns, timeout, connection_error,
+http_error, tls_error, body_mismatch, or error), along with its probe spec
+and, for TLS probes, when its certificate expires.
+
+GET requests to /history/<server> will return the history of a single
+server's pings, which is kept on disk (see HistoryStore.py): every ping for
+the last two days, and a rollup per minute (for two weeks) and per hour (for
+a bit over a year) of the number of pings, how many found the server online,
+and the mean and maximum latency.  Along with the points, we'll return the
+outages (runs of pings that found the server offline) in the range, e.g.
+    {"server": "python.org", "resolution": "hour", "points": [...],
+     "outages": [{"start": 1420070400, "end": 1420077600, "duration": 7200}],
+     "start": ..., "end": ..., "truncated": false}
+The following query parameters are all optional:
+    start = start of the range, either in seconds since the epoch or
+    relative to now, e.g. -7d (the default is -1h)
+    end = end of the range, in the same way (the default is now)
+    resolution = raw, minute, or hour (the default is whichever is the finest
+    that still has the start of the range and doesn't give too many points)
+When clustering, each node only has the history of the pings it sent.
+
+Status responses carry an ETag that only changes when a status or interval
+does, so sending it back in an If-None-Match header will get an empty
+304 response if nothing has changed.
+
+Status requests (including plain GET requests) are answered from the latest
+published status snapshot, without taking the server tracker lock, so they
+never wait on pings or on the disk.  A fresh snapshot is published after every
+heartbeat that changes a status, and after every change made through the
+server, so a change is always visible to the requestor that made it.
+============
+GET requests to /metrics will return metrics on the heartbeat server itself
+(heartbeat duration and lag, lock wait and hold times, pings by outcome,
+pings in flight, time spent writing to disk (including the history), servers
+tracked by status, and status change events handed out and delivered to
+webhooks)
+in the Prometheus text exposition format, along with how the heartbeat loop
+has been doing (heartbeats that overran the one second period, and
+heartbeats that were skipped because of it).
+============
+To spread the servers across several processes (and so several CPU cores),
+set the HEARTBEAT_SHARDS environment variable to the number of shards, e.g.
+    HEARTBEAT_SHARDS=4 python HeartbeatServer.py
+Each shard pings its own share of the servers and keeps its own state store
+(see ShardedTracker.py).  The servers are handed over to the right shards
+whenever the number of shards changes (including from or back to a single
+shard, i.e., unsharded).  Note that the heartbeat, ping, and disk metrics on
+/metrics are only kept by the shards themselves, and so aren't included.
+============
+To run several heartbeat servers together as a cluster, set the
+HEARTBEAT_NODE environment variable to this node's address (host:port, which
+we'll listen on) and HEARTBEAT_PEERS to the comma-separated addresses of the
+other nodes, e.g.
+    HEARTBEAT_NODE=127.0.0.1:5001 HEARTBEAT_PEERS=127.0.0.1:5002,127.0.0.1:5003
+Each server is then only pinged by one node, and its servers are picked up by
+the other nodes if it goes down (see ClusterNode.py).  Changes can be made
+through any node, and any node will answer status requests for every server.
+GET requests to /cluster will describe the cluster as this node sees it.
+Cluster mode can't be combined with sharding.
+============
+Rather than polling for the status of every server, requestors can subscribe
+to status changes (see Notifications.py).  Each change is an event, e.g.
+    {"seq": 42, "server": "google.com", "previous": "Online",
+     "status": "Offline", "time": 1420070400.0}
+GET requests to /events will long-poll for the events after a given one,
+    {"events": [...], "next_since": 42, "missed": false}
+The following query parameters are both optional:
+    since = the seq of the last event seen (i.e., the next_since from the
+    previous request; without it, we'll only wait for new events)
+    timeout = most seconds to wait for an event (up to 60, default 30)
+missed will be true if some of the events after the given one are too old
+to still be kept (or the given one is from before a restart), in which case
+the requestor should check the full status, and carry on from next_since.
+GET requests to /events/stream will instead stream the events as
+server-sent events (picking up after the Last-Event-ID header, if given).
+
+POST requests to /subscriptions will register a webhook that the events
+are POSTed to in batches, e.g.
+    {"url":"http://example.com/heartbeat-events"}
+We'll respond with the subscription's id, which can be given to a DELETE
+request to /subscriptions/<id> to remove it.  Each batch is sent as
+    {"subscription": "<id>", "events": [...], "dropped": 0}
+where dropped is the number of events that couldn't be delivered since the
+last batch (because the webhook fell too far behind, or kept failing even
+after being retried).  Webhooks are delivered to in the background, so a
+slow webhook never holds up the heartbeat.  GET requests to /subscriptions
+will describe every webhook.  Subscriptions are not kept across restarts.
+============
+The servers are remembered across restarts in an SQLite database,
+heartbeat_state.db (see StateStore.py), which is only ever written to a small
+batch of changes at a time.  To keep them in the original CSV dump file and
+journal instead, set the HEARTBEAT_STATE_STORE environment variable, e.g.
+    HEARTBEAT_STATE_STORE=csv python HeartbeatServer.py
+The first time we start up with the SQLite store, any servers in the CSV dump
+file and journal are copied over into the database, and the CSV files are
+renamed with a .migrated suffix.  They can also be copied over by hand with
+    python StateStore.py
+============
+To serve requests from several worker processes (and so several CPU cores),
+set the HEARTBEAT_WORKERS environment variable to the number of workers, e.g.
+    HEARTBEAT_WORKERS=4 python HeartbeatServer.py
+or serve HeartbeatWsgi.py with a WSGI server, e.g.
+    gunicorn --workers 4 --threads 8 HeartbeatWsgi:application
+Only one of the workers (the probe owner, elected with a lock on
+heartbeat_owner.lock) runs the tracker and pings the servers.  The others pass
+their changes along to the owner, and answer status requests from a copy of
+the owner's latest status snapshot, so a change is still always visible to the
+requestor that made it.  If the owner dies, another worker takes over (see
+WorkerPool.py).  Cluster mode can't be combined with several workers.
+
+To start the heartbeat server up from other code, use createApp(), which
+returns the Flask application (importing this file doesn't start anything).
 """
 # standard imports
-from flask import Flask, request
-# imports for threading (in order to run the heartbeat every second)
+from flask import Flask, Response, request
+import StringIO
+import atexit
+import csv
+import json
+import os
 import threading
+import time
+import traceback
+import uuid
+# the heartbeat runs in its own long-lived thread
+from HeartbeatLoop import HeartbeatLoop
 # import the server tracker class
-from ServerTracker import ServerTracker
+from ServerTracker import ServerTracker, parseInterval
+# along with the kind of state store it remembers the servers in by default
+from StateStore import default_state_store
+# along with the probe specs servers may be given
+from ProbeTypes import parseProbeSpec
+# or, when sharding, the class that spreads the servers across processes
+from ShardedTracker import ShardedTracker, adoptLeftoverServers
+# and, when clustering, the class that keeps in touch with the other nodes
+from ClusterNode import ClusterNode
+# status requests are answered from status snapshots
+from StatusSnapshot import StatusSnapshot
+# and subscribers are told about the statuses that change between snapshots
+from Notifications import EventHub, statusChanges
+# and the metrics we keep on the heartbeat server itself
+import Instrumentation
+# for treating www. aliases as the same target
+import ProbeEngine
+# and, when serving from several workers, the classes that let them share
+# a single tracker
+from WorkerPool import claimOwnership, OwnerServer, OwnerClient, RemoteTracker
+from WorkerPool import RemoteEventHub, SnapshotReader, writeSnapshot, serveWorkers
+from WorkerPool import status_snapshot_file, default_snapshot_poll
 
 ########################
 # GLOBAL VARIABLES HERE
 ########################
-# keep track of the servers
-server_tracker = ServerTracker()
-# and try to read in server tracker pseudo memory dump file
-server_tracker.readInServers()
+# longest we'll go between heartbeats, in seconds
+# (we'll check back sooner if a server is due before then)
+heartbeat_tick = 1
+# number of processes to spread the servers across
+# (with a single shard, everything runs in this process)
+shard_count = int(os.environ.get('HEARTBEAT_SHARDS', 1))
+# this node's address, and the addresses of the other nodes, when clustering
+cluster_address = os.environ.get('HEARTBEAT_NODE')
+cluster_peers = [peer.strip() for peer in
+                 os.environ.get('HEARTBEAT_PEERS', '').split(',') if peer.strip()]
+if cluster_address and shard_count > 1:
+    raise ValueError('Cluster mode cannot be combined with sharding')
+# most pings to send out per second (or None for no limit)
+probe_budget = os.environ.get('HEARTBEAT_PROBE_BUDGET')
+if probe_budget is not None:
+    probe_budget = float(probe_budget)
+    # (nan and inf included, neither of which can be spent)
+    if not 0 < probe_budget < float('inf'):
+        raise ValueError('Probe budget must be a positive, finite number '
+                         'of pings per second')
+# the kind of state store to remember the servers in, sqlite or csv
+state_store = os.environ.get('HEARTBEAT_STATE_STORE', default_state_store)
+# whether www.example.com and example.com share their pings
+# (set before the tracker starts, so that every shard picks it up too)
+ProbeEngine.merge_www_aliases = os.environ.get('HEARTBEAT_MERGE_WWW') == '1'
+# number of worker processes to serve requests from, when run directly
+worker_count = int(os.environ.get('HEARTBEAT_WORKERS', 1))
+
+# the server tracker, which is created (and reads in the servers from the
+# state store) once the application is started up by createApp()
+# (in a worker that isn't the probe owner, this is a remote tracker)
+server_tracker = None
 
-# background thread to support heartbeats every second
-background_thread = threading.Thread()
 # initialize a lock for dealing with the server tracker updates
-lock = threading.Lock()
+# (which keeps track of how long it is waited on and held for)
+# note that the lock is never held while waiting on pings or the disk
+lock = Instrumentation.InstrumentedLock(Instrumentation.lock_wait,
+                                        Instrumentation.lock_hold)
+
+
+class Unlocked(object):
+    """
+    Stands in for the lock around a tracker that keeps its own locks
+    """
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *exc_info):
+        return False
+        
+        
+def trackerLock():
+    """
+    Returns the lock to hold while making a change to the server tracker
+    (or asking it for a server's metrics)
+    
+    A sharded or remote tracker only passes the call along to the trackers
+    in other processes, which keep their own locks (and may ping a new server
+    before answering), so nothing needs holding for one of those
+    """
+    if isinstance(server_tracker, (ShardedTracker, RemoteTracker)):
+        return Unlocked()
+    return lock
+
+# relative times accepted for /history ranges, and how many seconds each unit is
+history_time_units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+# the latest status snapshot, which is never changed once published, so that
+# status requests can read it without taking the lock
+status_snapshot = None
+# and a lock for publishing a new one (which is never held by readers)
+publish_lock = threading.Lock()
+# and one for reading in the probe owner's snapshots, in a worker that isn't
+# the owner, so that they are swapped in in the order they were read
+read_lock = threading.Lock()
+# hands out status changes to subscribers
+# (in a worker that isn't the probe owner, this is a remote event hub)
+event_hub = None
+# longest (and default) wait for a long-poll of /events, in seconds
+max_long_poll_timeout = 60
+default_long_poll_timeout = 30
 
 
+def publishStatusSnapshot():
+    """
+    Publishes a fresh status snapshot if any status or interval has changed
+    since the last one was published, and hands any status changes out
+    to subscribers
+    
+    The lock is only held while the servers are copied out of the tracker;
+    the snapshot itself is built without it
+    
+    In a worker that isn't the probe owner, the owner publishes the snapshot,
+    and we then read it in
+    
+    Returns the latest status snapshot
+    """
+    global status_snapshot
+    
+    if owner_client is not None:
+        return readStatusSnapshot(*owner_client.call('publishStatusSnapshot'))
+    published = status_snapshot
+    with lock:
+        update = server_tracker.statusSince(published.version
+                                            if published is not None else None)
+    if update is None:
+        return published
+    snapshot = StatusSnapshot(*update)
+    with publish_lock:
+        # a slower publisher may have been working from an older copy
+        if status_snapshot is None or snapshot.version > status_snapshot.version:
+            changes = statusChanges(status_snapshot, snapshot)
+            status_snapshot = snapshot
+            # (this only queues the events up, so it never waits on a subscriber)
+            event_hub.publish(changes)
+            # and share the snapshot with the other workers, if there are any
+            if owner_server is not None:
+                writeSnapshot(status_snapshot_file, instance_tag, snapshot)
+        return status_snapshot
+        
+        
+def readStatusSnapshot(tag = None, version = None):
+    """
+    Reads in the probe owner's latest status snapshot, in a worker that
+    isn't the owner, if it has changed since we last read it in
+    
+    :param tag = the owner's instance tag, and
+    :param version = the version of the snapshot the owner has just
+    published, which we'll wait (briefly) for, so that a change is always
+    visible to the requestor that made it (or None to take whatever
+    snapshot there is)
+    
+    The snapshot is read in (and waited for) without the publish lock, which
+    is only held to swap the new snapshot in, and nothing is held while
+    we wait
+    
+    Returns the latest status snapshot
+    """
+    global status_snapshot
+    global instance_tag
+    
+    deadline = time.time() + 1
+    while True:
+        # (we may have just taken over as the owner)
+        reader = snapshot_reader
+        if reader is None:
+            return status_snapshot
+        with read_lock:
+            update = reader.read()
+            with publish_lock:
+                if update is not None and snapshot_reader is not None:
+                    update_tag, update_version, rows = update
+                    # (a snapshot from a new owner starts its versions over)
+                    if update_tag != instance_tag or \
+                       update_version > status_snapshot.version:
+                        status_snapshot = StatusSnapshot(update_version, rows)
+                        instance_tag = update_tag
+                published, published_tag = status_snapshot, instance_tag
+        if version is None or time.time() >= deadline or \
+           (published_tag == tag and published.version >= version):
+            return published
+        time.sleep(0.01)
+            
+            
+def followStatusSnapshots():
+    """
+    Reads in the probe owner's status snapshots as they are published,
+    in a worker that isn't the owner (until we become the owner ourselves)
+    """
+    while owner_client is not None:
+        try:
+            readStatusSnapshot()
+        except Exception:
+            traceback.print_exc()
+        time.sleep(default_snapshot_poll)
+    return
+    
+    
 def heartbeatCheck():
     """
-    This function is to be called every second
-    and will ping all of the servers being tracked for which the 
-    specified ping interval time has elapsed
+    This function is to be called every second (or sooner, if a server
+    is due before then) and will ping all of the servers being tracked
+    for which the specified ping interval time has elapsed
+    
+    Note that, in order to run in the background, this is called over and
+    over by the heartbeat loop, in its own thread
     
-    Note that, in order to run the background, we'll use a background thread
+    Returns the number of seconds until the next server is due
+    (or None if there are no servers), so that the heartbeat loop knows
+    when it needs to call this again
     """
-    # specify global server, thread, and lock
+    # specify global server and lock
     global server_tracker
-    global background_thread
     global lock
     
-    # run the incrementTimers()
-    # and pingAllDueServers() functions in this separate thread
-    # to be run every second
+    # run the pingAllDueServers() function in this separate thread
+    # (which only holds the lock while it isn't waiting on the pings)
+    server_tracker.pingAllDueServers(lock)
+    # make sure any changes to the tracked servers have hit the disk
+    # (again, without holding the lock while waiting on the disk)
+    server_tracker.syncJournal(lock)
+    # hand out any statuses that changed
+    publishStatusSnapshot()
+    # find out how long until the next server is due
     with lock:
-        # increment our timing counters
-        server_tracker.incrementTimers()
-        server_tracker.pingAllDueServers()
+        return server_tracker.secondsUntilNextPing()
+        
+        
+def drainHeartbeat():
+    """
+    Called once the heartbeat loop has stopped, to make sure every change
+    to the tracked servers has hit the disk before we exit
+    """
+    server_tracker.syncJournal(lock)
+    return
+    
+    
+# the loop that will call heartbeatCheck() every second (or sooner)
+# (created along with the server tracker)
+heartbeat_loop = None
+
+# and, when clustering, our link to the other nodes
+cluster_node = None
+
+# when serving from several workers, the probe owner answers the calls of
+# the other workers, each of which has a link to the owner and reads in
+# the owner's status snapshots
+owner_server = None
+owner_client = None
+snapshot_reader = None
+# the calls the other workers may make of the probe owner's server tracker,
+# and those of them that may need to ping a new server (which is done before
+# taking the lock, with the probe spec that is passed as their last argument)
+worker_tracker_calls = ('addServer', 'removeServer', 'updatePingInterval',
+                        'addServers', 'removeServers', 'getServerMetrics',
+                        'getServerHistory', 'probeSpecs', 'probeIfUntracked')
+worker_probing_calls = ('addServer', 'updatePingInterval')
+# and those of them that don't need the lock
+worker_unlocked_calls = ('getServerHistory', 'probeIfUntracked')
+# whether we've stopped serving already
+stopped = False
 
-    # start the next thread
-    background_thread = threading.Timer(1, heartbeatCheck)
-    background_thread.start()
+
+def startTracker():
+    """
+    Creates the server tracker, reads in the servers from the state store,
+    and publishes the first status snapshot, along with creating the heartbeat
+    loop (which is left for the caller to start) and, when clustering,
+    our link to the other nodes
+    
+    In a worker taking over as the probe owner, requests keep going to the
+    old owner (or waiting on whoever takes over from it) until everything
+    is ready, and then all switch over to our own tracker at once
+    """
+    global server_tracker
+    global event_hub
+    global status_snapshot
+    global instance_tag
+    global heartbeat_loop
+    global cluster_node
+    global owner_client
+    global snapshot_reader
+    
+    # keep track of the servers
+    if shard_count > 1:
+        tracker = ShardedTracker(shard_count, heartbeat_tick,
+                                 probe_budget = probe_budget,
+                                 state_store = state_store)
+    else:
+        tracker = ServerTracker(probe_budget = probe_budget,
+                                state_store = state_store)
+    # and try to read in the servers from the state store
+    tracker.readInServers()
+    if shard_count == 1:
+        # (along with those of any shards we used to run)
+        adoptLeftoverServers(shard_count, state_store, tracker.adoptServers)
+    Instrumentation.restore_duration.set(tracker.restore_time)
+    snapshot = StatusSnapshot(*tracker.statusSince(None))
+    hub = EventHub()
+    Instrumentation.webhook_queued.callback = hub.queuedEvents
+    
+    with lock:
+        with publish_lock:
+            server_tracker = tracker
+            event_hub = hub
+            status_snapshot = snapshot
+            # (a fresh tag, since our versions have nothing to do with
+            # those of any owner before us)
+            instance_tag = uuid.uuid4().hex[:8]
+            # and we no longer follow another probe owner
+            owner_client = None
+            snapshot_reader = None
+            if owner_server is not None:
+                writeSnapshot(status_snapshot_file, instance_tag, snapshot)
+                
+    heartbeat_loop = HeartbeatLoop(heartbeatCheck, heartbeat_tick,
+                                   drain = drainHeartbeat)
+    if cluster_address:
+        cluster_node = ClusterNode(cluster_address, cluster_peers,
+                                   server_tracker, lock, publishStatusSnapshot)
+    return
+    
+    
+def createApp(workers = False):
+    """
+    Starts up the heartbeat server in this process, and returns the Flask
+    application (only the first call starts anything up)
+    
+    :param workers = whether this process is one of several workers serving
+    the application (e.g., under gunicorn, see HeartbeatWsgi.py), in which
+    case only the worker elected as the probe owner runs the tracker and the
+    heartbeat, and the other workers pass their changes along to it and
+    answer status requests from its status snapshots (see WorkerPool.py)
+    
+    When serving from several workers, the probe owner starts its heartbeat
+    straight away; otherwise, the heartbeat loop is left for the caller to
+    start (e.g., so that a benchmark can drive the heartbeat itself)
+    """
+    if server_tracker is not None:
+        return my_app
+    if not workers:
+        startTracker()
+        return my_app
+    if cluster_address:
+        raise ValueError('Cluster mode cannot be combined with several workers')
+        
+    ownership = claimOwnership()
+    if ownership is not None:
+        becomeOwner(ownership)
+    else:
+        becomeWorker()
+    # let the heartbeat finish and flush out any changes when we exit
+    atexit.register(stopServing)
+    return my_app
+    
+    
+def becomeOwner(ownership):
+    """
+    Starts up the tracker and the heartbeat in this worker, as the probe owner,
+    and starts answering the calls of the other workers
+    
+    :param ownership = the open probe owner lock file (see WorkerPool.py),
+    which is kept open for as long as we're the owner
+    """
+    global owner_server
+    global ownership_lock
+    
+    ownership_lock = ownership
+    # (our snapshots are only shared once the owner server is set)
+    owner_server = OwnerServer(answerWorkerCall)
+    startTracker()
+    owner_server.start()
+    heartbeat_loop.start()
+    print 'Worker {0} is the probe owner'.format(os.getpid())
+    return
+    
+    
+def becomeWorker():
+    """
+    Links this worker up to the probe owner, and starts following the owner's
+    status snapshots and waiting (in the background) to take over as the
+    owner if it ever goes away
+    """
+    global server_tracker
+    global event_hub
+    global status_snapshot
+    global owner_client
+    global snapshot_reader
+    
+    owner_client = OwnerClient()
+    snapshot_reader = SnapshotReader()
+    server_tracker = RemoteTracker(owner_client)
+    event_hub = RemoteEventHub(owner_client)
+    # (an empty snapshot until we read in the owner's)
+    status_snapshot = StatusSnapshot(0, [])
+    readStatusSnapshot()
+    for target, name in ((followStatusSnapshots, 'snapshot-follower'),
+                         (waitForOwnership, 'ownership-waiter')):
+        thread = threading.Thread(target = target, name = name)
+        thread.daemon = True
+        thread.start()
+    return
+    
+    
+def waitForOwnership():
+    """
+    Waits for the probe owner to go away, and then takes over as the owner
+    """
+    ownership = claimOwnership(wait = True)
+    print 'Worker {0} is taking over as the probe owner'.format(os.getpid())
+    becomeOwner(ownership)
+    return
+    
+    
+def answerWorkerCall(method, args):
+    """
+    Answers a call made of the probe owner by another worker
+    
+    :param method = the name of the method called
+    :param args = tuple of its arguments
+    
+    Returns the result of the call
+    """
+    if method in worker_tracker_calls:
+        # (the worker hands along the result of its probeIfUntracked() call,
+        # which is None if the server was tracked already, so in case it has
+        # been removed since, we ping it here if need be)
+        if method in worker_probing_calls and args[-1] is None:
+            args = args[:-1] + (server_tracker.probeIfUntracked(args[0],
+                                                                args[-2]),)
+        if method in worker_unlocked_calls:
+            return getattr(server_tracker, method)(*args)
+        with lock:
+            return getattr(server_tracker, method)(*args)
+    if method == 'publishStatusSnapshot':
+        # (the snapshot is written out for the worker to read in)
+        return instance_tag, publishStatusSnapshot().version
+    if method == 'eventsSince':
+        return event_hub.eventsSince(*args)
+    if method == 'subscribe':
+        return event_hub.subscribe(*args).subscription_id
+    if method == 'unsubscribe':
+        return event_hub.unsubscribe(*args)
+    if method == 'describeSubscriptions':
+        return event_hub.describe()
+    if method == 'renderMetrics':
+        return Instrumentation.registry.render()
+    raise ValueError('Unknown worker call {0}'.format(method))
+    
+    
+def stopServing():
+    """
+    Stops the heartbeat (letting the current one finish and flush out any
+    changes), along with our links to the other nodes or workers
+    """
+    global stopped
+    
+    if stopped:
+        return
+    stopped = True
+    if owner_server is not None:
+        owner_server.stop()
+    if cluster_node is not None:
+        cluster_node.stop(timeout = 5)
+    if heartbeat_loop is not None:
+        heartbeat_loop.stop(drain = True, timeout = 10)
+    if isinstance(server_tracker, ShardedTracker):
+        server_tracker.stop()
+    return
+    
+    
+def replicateChanges(changes):
+    """
+    Passes along changes made through this node to the other nodes
+    of the cluster (if we're clustering)
+
+    :param changes = list of (operation, server name, ping interval,
+    ProbeSpec) tuples, where the operation is either 'add' or 'remove'
+    """
+    if cluster_node is not None:
+        cluster_node.replicate([{'op': operation, 'server': server,
+                                 'interval': interval,
+                                 'probe': probe and probe.key}
+                                for operation, server, interval, probe
+                                in changes])
     return
 
 
 # initialize the Flask application
 my_app = Flask(__name__)
 
+# a tag that is unique to this run of the heartbeat server, so that ETags
+# handed out before a restart can never match the ones handed out after
+# (when serving from several workers, every worker uses the probe owner's)
+instance_tag = uuid.uuid4().hex[:8]
+# the probe owner lock file, which is held open while we are the probe owner
+ownership_lock = None
+
 # we will accept GET requests (return the status of all servers)
 # POST requests (change the ping time interval of a server)
 # and DELETE requests (remove servers from tracking)
@@ -129,32 +764,50 @@ def handleRequest():
     # GET request
     if request.method == 'GET':
         # return the status of all servers
-        return_body = server_tracker.printStatus()
+        return_body = status_snapshot.toCsv()
         
     # POST request
     elif request.method == 'POST':
         # get the parameters as a dictionary
         params = request.get_json(force = True)
         
+        # verify the probe spec, if one was given
+        probe = None
+        if 'probe' in params:
+            try:
+                probe = parseProbeSpec(params['probe'])
+            except ValueError as error:
+                return 'Probe spec invalid: {0}'.format(error)
+        
         # check the fields that were given
         if 'server' in params and 'interval' in params:
             # given the server name and ping interval, we can update
-            # first, verify that the interval is indeed a number
+            # first, verify that the interval is indeed a positive number
             try:
-                ping_int = int(float(params['interval']))
+                ping_int = parseInterval(params['interval'])
             except ValueError:
                 return_body = 'Ping time interval invalid'
                 return return_body
                 
+            # ping the server first if it's new, so that we don't hold
+            # the lock while waiting on it
+            result = server_tracker.probeIfUntracked(params['server'], probe)
             # update our set of tracked servers
-            with lock:
+            with trackerLock():
                 return_body = server_tracker.updatePingInterval(params['server'],
-                                                                ping_int)
+                                                                ping_int, probe,
+                                                                result)
+            publishStatusSnapshot()
+            replicateChanges([('add', params['server'], ping_int, probe)])
             
         elif 'server' in params:
             # given only the server, we'll try and track the server
-            with lock:
-                return_body = server_tracker.addServer(params['server'])
+            result = server_tracker.probeIfUntracked(params['server'], probe)
+            with trackerLock():
+                return_body = server_tracker.addServer(params['server'], probe,
+                                                       result)
+            publishStatusSnapshot()
+            replicateChanges([('add', params['server'], None, probe)])
             
         else:
             # otherwise, we can't do anything with the request
@@ -168,7 +821,10 @@ def handleRequest():
         # make sure we were given a server
         if 'server' in params:
             # if so, remove the server
-            return_body = server_tracker.removeServer(params['server'])
+            with trackerLock():
+                return_body = server_tracker.removeServer(params['server'])
+            publishStatusSnapshot()
+            replicateChanges([('remove', params['server'], None, None)])
         
         
     # before returning, convert any newlines to HTML newlines
@@ -176,7 +832,411 @@ def handleRequest():
     return return_body
     
     
+def parseBulkBody(body):
+    """
+    Pulls the list of items out of the body of a bulk request,
+    which may be either a JSON array or newline-delimited JSON
+    
+    :param body = the raw request body
+    
+    Returns the list of items, or None if the body couldn't be parsed
+    """
+    # first, try the whole body as a single JSON array
+    try:
+        items = json.loads(body)
+    except ValueError:
+        items = None
+    if isinstance(items, list):
+        return items
+        
+    # otherwise, try it as one JSON object per line
+    try:
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    except ValueError:
+        return None
+    
+    
+# POST requests to /bulk add or update many servers at once
+# and DELETE requests to /bulk remove many servers at once
+@my_app.route('/bulk', methods = ['POST', 'DELETE'])
+def handleBulkRequest():
+    # specify the global server and lock
+    global server_tracker
+    global lock
+    
+    items = parseBulkBody(request.get_data())
+    if items is None:
+        return 'Invalid request.  Must be a JSON array or newline-delimited JSON'
+        
+    # we'll fill in a result for every item, in the order they were given
+    # anything we can't use is given its result straight away,
+    # and everything else is handed to the tracker in one go
+    results = [None] * len(items)
+    valid_indexes = []
+    valid_items = []
+    for index, params in enumerate(items):
+        if not isinstance(params, dict) or 'server' not in params:
+            results[index] = 'Invalid request.  Must contain server'
+            continue
+        if request.method == 'POST':
+            # verify the interval, if one was given
+            ping_int = None
+            if 'interval' in params:
+                try:
+                    ping_int = parseInterval(params['interval'])
+                except ValueError:
+                    results[index] = 'Ping time interval invalid'
+                    continue
+            # and the probe spec, if one was given
+            probe = None
+            if 'probe' in params:
+                try:
+                    probe = parseProbeSpec(params['probe'])
+                except ValueError as error:
+                    results[index] = 'Probe spec invalid: {0}'.format(error)
+                    continue
+            valid_items.append((params['server'], ping_int, probe))
+        else:
+            valid_items.append(params['server'])
+        valid_indexes.append(index)
+        
+    # apply all of the changes while holding the lock just once
+    with trackerLock():
+        if request.method == 'POST':
+            tracker_results = server_tracker.addServers(valid_items)
+        else:
+            tracker_results = server_tracker.removeServers(valid_items)
+    for index, result in zip(valid_indexes, tracker_results):
+        results[index] = result
+    publishStatusSnapshot()
+    if request.method == 'POST':
+        replicateChanges([('add', server, interval, probe)
+                          for server, interval, probe in valid_items])
+    else:
+        replicateChanges([('remove', server, None, None)
+                          for server in valid_items])
+        
+    # respond with the result for each item
+    return_body = []
+    for params, result in zip(items, results):
+        server = params.get('server') if isinstance(params, dict) else None
+        return_body.append({'server': server, 'result': result})
+    return Response(json.dumps(return_body), mimetype = 'application/json')
+    
+    
+    
+def jsonResponse(body, status = 200):
+    """
+    Builds a JSON response out of the given body
+    """
+    return Response(json.dumps(body), status = status,
+                    mimetype = 'application/json')
+    
+    
+def getStatusSnapshot():
+    """
+    Grabs the latest published status snapshot, along with its ETag
+    (without taking the lock)
+    
+    In a worker that isn't the probe owner, the owner's latest snapshot is
+    read in first, if it has changed since we last read it in
+    
+    Returns a tuple of (snapshot, ETag)
+    """
+    reader = snapshot_reader
+    if reader is not None and reader.changed():
+        readStatusSnapshot()
+    snapshot = status_snapshot
+    etag = '{0}-{1}'.format(instance_tag, snapshot.version)
+    return snapshot, etag
+    
+    
+def notModified(etag):
+    """
+    Builds an empty 304 response if the requestor already has the
+    version of the status with the given ETag, or returns None otherwise
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status = 304)
+        response.set_etag(etag)
+        return response
+    return None
+    
+    
+def generateCsv(rows, chunk_size = 1000):
+    """
+    Generates the given servers as CSV (in the same format as the dump file),
+    a chunk of rows at a time, so that the response can be streamed
+    """
+    yield 'Server,Ping Interval,Status\n'
+    for start in xrange(0, len(rows), chunk_size):
+        output = StringIO.StringIO()
+        writer = csv.writer(output, lineterminator = '\n')
+        writer.writerows(rows[start:start + chunk_size])
+        yield output.getvalue()
+        
+        
+# GET requests to /status return the status of the servers as JSON (or CSV)
+@my_app.route('/status', methods = ['GET'])
+def handleStatusRequest():
+    snapshot, etag = getStatusSnapshot()
+    response = notModified(etag)
+    if response is not None:
+        return response
+        
+    # check the parameters we were given
+    status = request.args.get('status')
+    if status is not None:
+        status = status.capitalize()
+        if status not in snapshot.rows_by_status:
+            return jsonResponse({'error': 'Invalid status'}, 400)
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            return jsonResponse({'error': 'Invalid limit'}, 400)
+    cursor = request.args.get('cursor')
+    output_format = request.args.get('format', 'json').lower()
+    if output_format not in ('json', 'csv'):
+        return jsonResponse({'error': 'Invalid format'}, 400)
+        
+    rows, next_cursor = snapshot.page(status, cursor, limit)
+    if output_format == 'csv':
+        response = Response(generateCsv(rows), mimetype = 'text/csv')
+        # the CSV has nowhere to put the cursor, so it goes in a header
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+    else:
+        servers = [{'server': server, 'interval': interval, 'status': status}
+                   for server, interval, status in rows]
+        response = jsonResponse({'servers': servers,
+                                 'next_cursor': next_cursor})
+    response.set_etag(etag)
+    return response
+    
+    
+# GET requests to /status/<server> return the status of a single server
+@my_app.route('/status/<path:server>', methods = ['GET'])
+def handleServerStatusRequest(server):
+    snapshot, etag = getStatusSnapshot()
+    response = notModified(etag)
+    if response is not None:
+        return response
+        
+    row = snapshot.lookup(server)
+    if row is None:
+        return jsonResponse({'error': 'Server not currently tracked'}, 404)
+    response = jsonResponse({'server': row[0], 'interval': row[1],
+                             'status': row[2]})
+    response.set_etag(etag)
+    return response
+    
+    
+# GET requests to /stats/<server> return the ping metrics of a single server
+@my_app.route('/stats/<path:server>', methods = ['GET'])
+def handleStatsRequest(server):
+    with trackerLock():
+        summary = server_tracker.getServerMetrics(server)
+    if summary is None:
+        return jsonResponse({'error': 'Server not currently tracked'}, 404)
+    return jsonResponse(summary)
+    
+    
+def parseHistoryTime(value, now):
+    """
+    Parses a time given for a /history range, either in seconds since the
+    epoch or relative to now (e.g., -30m, -7d), raising a ValueError if
+    it is neither
+    """
+    value = value.strip().lower()
+    if value.startswith('-') and value[-1:] in history_time_units:
+        return now - float(value[1:-1]) * history_time_units[value[-1]]
+    return float(value)
+    
+    
+# GET requests to /history/<server> return the history of a single server
+@my_app.route('/history/<path:server>', methods = ['GET'])
+def handleHistoryRequest(server):
+    now = time.time()
+    try:
+        end = parseHistoryTime(request.args.get('end', '-0s'), now)
+        start = parseHistoryTime(request.args.get('start', '-1h'), now)
+    except ValueError:
+        return jsonResponse({'error': 'Invalid start or end'}, 400)
+    if start >= end:
+        return jsonResponse({'error': 'Start must be before end'}, 400)
+    resolution = request.args.get('resolution')
+    if resolution is not None and resolution not in ('raw', 'minute', 'hour'):
+        return jsonResponse({'error': 'Invalid resolution'}, 400)
+    # (the history keeps its own lock)
+    return jsonResponse(server_tracker.getServerHistory(server, start, end,
+                                                        resolution))
+    
+    
+def countTrackedServers():
+    """
+    Counts the servers being tracked by status, for the /metrics endpoint
+    """
+    return dict(((status,), len(rows))
+                for status, rows in status_snapshot.rows_by_status.iteritems())
+        
+Instrumentation.tracked_servers.callback = countTrackedServers
+    
+    
+# the following requests are only used between the nodes of a cluster
+# GET requests to /cluster describe the cluster as this node sees it
+@my_app.route('/cluster', methods = ['GET'])
+def handleClusterRequest():
+    if cluster_node is None:
+        return jsonResponse({'error': 'Not running as part of a cluster'}, 404)
+    return jsonResponse(cluster_node.describe())
+    
+    
+# GET requests to /cluster/heartbeat are another node's heartbeat,
+# answered with the statuses of the servers we ping
+# (and, with resync, ask us to copy the servers from that node)
+@my_app.route('/cluster/heartbeat', methods = ['GET'])
+def handleClusterHeartbeat():
+    if cluster_node is None:
+        return jsonResponse({'error': 'Not running as part of a cluster'}, 404)
+    cluster_node.heardFrom(request.args.get('node'))
+    if request.args.get('resync'):
+        cluster_node.resyncFrom(request.args.get('node'))
+    return jsonResponse(cluster_node.statusReport(request.args.get('since')))
+    
+    
+# GET requests to /cluster/servers return every server, for a starting node
+@my_app.route('/cluster/servers', methods = ['GET'])
+def handleClusterServers():
+    if cluster_node is None:
+        return jsonResponse({'error': 'Not running as part of a cluster'}, 404)
+    snapshot = publishStatusSnapshot()
+    with trackerLock():
+        probes = server_tracker.probeSpecs()
+    return jsonResponse({'servers': snapshot.rows, 'probes': probes})
+    
+    
+# POST requests to /cluster/replicate are changes made through another node
+@my_app.route('/cluster/replicate', methods = ['POST'])
+def handleClusterReplicate():
+    if cluster_node is None:
+        return jsonResponse({'error': 'Not running as part of a cluster'}, 404)
+    cluster_node.applyChanges(request.get_json(force = True))
+    return jsonResponse({'result': 'ok'})
+    
+    
+# GET requests to /events long-poll for status change events
+@my_app.route('/events', methods = ['GET'])
+def handleEventsRequest():
+    try:
+        since = parseEventSeq(request.args.get('since'))
+        timeout = float(request.args.get('timeout', default_long_poll_timeout))
+    except ValueError:
+        return jsonResponse({'error': 'Invalid since or timeout'}, 400)
+    timeout = min(max(timeout, 0), max_long_poll_timeout)
+    events, last_seq, missed = event_hub.eventsSince(since, timeout)
+    return jsonResponse({'events': events, 'next_since': last_seq,
+                         'missed': missed})
+    
+    
+def parseEventSeq(value):
+    """
+    Parses the seq of the last event a subscriber has seen
+    (raising a ValueError if it isn't a number)
+    
+    Returns the seq, or None if none was given
+    """
+    if value is None or value == '':
+        return None
+    return int(value)
+    
+    
+def generateEvents(since):
+    """
+    Generates status change events as server-sent events, forever
+    (or until the requestor goes away, which we find out about
+    the next time we write to it)
+    """
+    # let the requestor know straight away that the stream is open
+    yield ': connected\n\n'
+    while True:
+        events, since, missed = event_hub.eventsSince(since, default_long_poll_timeout)
+        if missed:
+            yield 'event: missed\ndata: {}\n\n'
+        if not events:
+            # keep the connection from looking idle
+            yield ': keepalive\n\n'
+        for event in events:
+            yield 'id: {0}\ndata: {1}\n\n'.format(event['seq'], json.dumps(event))
+            
+            
+# GET requests to /events/stream stream status change events
+@my_app.route('/events/stream', methods = ['GET'])
+def handleEventStream():
+    try:
+        since = parseEventSeq(request.headers.get('Last-Event-ID',
+                                                  request.args.get('since')))
+    except ValueError:
+        return jsonResponse({'error': 'Invalid since'}, 400)
+    response = Response(generateEvents(since), mimetype = 'text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+    
+    
+# POST requests to /subscriptions register a webhook for status change events
+# and GET requests to /subscriptions describe every webhook
+@my_app.route('/subscriptions', methods = ['GET', 'POST'])
+def handleSubscriptionsRequest():
+    if request.method == 'GET':
+        return jsonResponse({'subscriptions': event_hub.describe()})
+    params = request.get_json(force = True)
+    url = params.get('url') if isinstance(params, dict) else None
+    if not isinstance(url, basestring) or \
+       not url.lower().startswith(('http://', 'https://')):
+        return jsonResponse({'error': 'Invalid request.  Must contain an '
+                                      'http:// or https:// url'}, 400)
+    subscriber = event_hub.subscribe(url)
+    return jsonResponse({'id': subscriber.subscription_id, 'url': url}, 201)
+    
+    
+# DELETE requests to /subscriptions/<id> remove a webhook
+@my_app.route('/subscriptions/<subscription_id>', methods = ['DELETE'])
+def handleUnsubscribeRequest(subscription_id):
+    if not event_hub.unsubscribe(subscription_id):
+        return jsonResponse({'error': 'No such subscription'}, 404)
+    return jsonResponse({'result': 'Subscription removed'})
+    
+    
+# GET requests to /metrics return metrics on the heartbeat server itself
+@my_app.route('/metrics', methods = ['GET'])
+def handleMetricsRequest():
+    # (the heartbeat metrics are all kept by the probe owner)
+    if owner_client is not None:
+        body = owner_client.call('renderMetrics')
+    else:
+        body = Instrumentation.registry.render()
+    return Response(body, mimetype = 'text/plain; version=0.0.4')
+    
     
 if __name__ == '__main__':
-    heartbeatCheck()
-    my_app.run()
\ No newline at end of file
+    if worker_count > 1:
+        # each worker starts up the application itself, once it's forked off
+        serveWorkers(lambda: createApp(workers = True), stopServing,
+                     worker_count)
+    else:
+        createApp()
+        heartbeat_loop.start()
+        try:
+            if cluster_node is not None:
+                cluster_node.start()
+                # listen on this node's address, as the other nodes know it
+                host, port = cluster_address.rsplit(':', 1)
+                my_app.run(host = host, port = int(port))
+            else:
+                my_app.run()
+        finally:
+            # let the current heartbeat finish and flush out any changes
+            stopServing()
\ No newline at end of file
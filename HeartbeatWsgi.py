@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+__author__ = 'mshadish'
+"""
+Heartbeat WSGI entry point
+==========================
+This is the module to point a WSGI server at to serve the heartbeat server
+from several worker processes, e.g. with gunicorn:
+
+    gunicorn --workers 4 --threads 8 --bind 127.0.0.1:5000 HeartbeatWsgi:application
+
+Each worker starts up the application as it imports this module.  One of them
+is elected the probe owner, which runs the tracker and the heartbeat, and the
+rest pass their changes along to it and answer status requests from its
+status snapshots (see WorkerPool.py), so that adding workers adds to the
+number of requests we can answer without adding to the pings we send.
+
+Note that:
+    - the application must not be loaded before the workers are forked
+    (i.e., no --preload), so that each worker takes part in the election
+    - the workers should be threaded (e.g., with --threads), since a long-poll
+    of /events holds up its thread for up to a minute
+    - cluster mode can't be combined with several workers
+"""
+# imports
+from HeartbeatServer import createApp
+
+# the WSGI application, started up as a worker
+application = createApp(workers = True)
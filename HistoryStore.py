@@ -0,0 +1,860 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+History store definition
+
+This is the class that we will use to keep the history of every ping we send
+out on disk, so that we can answer questions like "when did python.org go
+down last week, and for how long?" long after the pings have dropped out of
+each server's metrics (see ServerMetrics.py).
+
+The history is kept at three levels of detail:
+    - raw: every ping (when it was sent, whether the server was online, why
+    it failed if it did, the status code, and the latency)
+    - minute: the pings rolled up into a record per server per minute (the
+    number of pings, how many of them found the server online, and the mean
+    and maximum latency)
+    - hour: the same, rolled up into a record per server per hour
+Each level is kept for longer than the one before it, so that recent history
+is kept in full detail and older history takes up much less room.
+
+Each level is split up by time into segment files, e.g. raw-1420070400.seg
+for the raw pings of the hour starting at 1420070400 (seconds since the
+epoch).  The segments hold fixed-size binary records, sorted by server and
+then by time, after a header and an index giving the position of each
+server's records:
+
+    header:  magic 'HBH1', level, segment start, servers, records
+    index:   (server id, first record, record count) for each server
+    records: (time, server id, ...) for each ping or rollup
+
+so that a single server's history over a range of time can be read straight
+out of a memory-mapped segment with a couple of binary searches, without
+loading the rest of the segment (let alone the rest of the history) into
+memory.  Server names are kept as small numeric ids, which are given out
+the first time each server is pinged and kept in the 'servers' file (one
+JSON-encoded name per line, the line number being the id).
+
+The pings of the current hour are appended to an active segment
+(raw-<start>.active) as they come in, in the order they come in, with an
+index of each server's records kept in memory.  Once the hour is up,
+the active segment is sealed (sorted and written out as a raw segment) and
+rolled up into a minute segment in a background thread, and, once the day is
+up, the day's minute segments are rolled up into an hour segment.  Segments
+that have gone past their level's retention are deleted at the same time.
+Sealing and rolling up both work through the records a server at a time,
+reading them straight out of the segments (by their indexes) and writing
+them out as they go, so that neither ever holds a whole level in memory.
+Anything that didn't get sealed or rolled up before a restart (e.g. after a
+crash) is picked back up when the history is next opened.
+
+Pings are recorded in memory while the server tracker lock is held, and only
+written out to the active segment when flush() is called (once a heartbeat,
+without the lock), so that recording a ping never waits on the disk.
+
+
+Methods:
+--------
+HistoryStore.record(server name, probe result)
+    - records a single ping, to be written out by the next flush()
+
+HistoryStore.flush()
+    - writes out the pings recorded since the last flush, sealing the active
+    segment and starting a new one once its hour is up
+
+HistoryStore.query(server name, start time, end time, resolution)
+    - returns the history of a single server over the given range of time
+    ('raw', 'minute', or 'hour', or picked to suit the range if not given),
+    along with the outages found in it
+
+rollUp(records, level, bucket length)
+    - rolls up a single server's raw or rolled up records into longer buckets
+"""
+# imports
+import array
+import bisect
+import itertools
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from ServerMetrics import failure_classes
+from PingScheduler import monotonicTime
+from Instrumentation import persistence_duration
+
+# global for the levels of history we keep, finest first, as tuples of
+# (name, length of each bucket in seconds (None for every ping),
+#  length of each segment in seconds, default retention in seconds)
+# (each level's segments must hold a whole number of the last level's)
+history_levels = (('raw', None, 3600, 2 * 86400),
+                  ('minute', 60, 3600, 14 * 86400),
+                  ('hour', 3600, 86400, 400 * 86400))
+level_names = tuple(level[0] for level in history_levels)
+# global for the segment file layout
+segment_magic = 'HBH1'
+segment_suffix = '.seg'
+active_suffix = '.active'
+server_ids_file = 'servers'
+header_format = struct.Struct('<4sBIII')
+index_format = struct.Struct('<III')
+# raw records: time, server id, failure class (see ServerMetrics.py),
+# status code (0 if none), latency (-1 if none)
+raw_format = struct.Struct('<dIBHf')
+# rollup records: bucket start, server id, pings, pings online,
+# pings with a latency, total latency, maximum latency
+rollup_format = struct.Struct('<IIIIIff')
+record_formats = (raw_format, rollup_format, rollup_format)
+# and just the time (the first field of every record), for binary searches
+time_formats = (struct.Struct('<d'), struct.Struct('<I'), struct.Struct('<I'))
+# and just the server id of a raw record, for indexing an active segment
+server_id_format = struct.Struct('<I')
+server_id_offset = struct.calcsize('<d')
+# global for the number of records we'll write out to a segment at a time
+write_chunk_records = 10000
+# global for the number of segments we'll keep memory-mapped at once
+open_segment_limit = 64
+# global for the most points we'll return from a single query
+max_history_points = 20000
+# globals for picking a resolution to suit the range of a query: the longest
+# range we'll return raw pings for, and the most buckets we'll return
+max_auto_raw_range = 2 * 3600
+max_auto_buckets = 1500
+
+
+def segmentName(level, start, suffix = segment_suffix):
+    """
+    Returns the file name of the given segment
+    """
+    return '{0}-{1}{2}'.format(level_names[level], int(start), suffix)
+
+
+def readIndex(data, offset, count):
+    """
+    Reads count (little-endian) unsigned 32 bit integers out of the given
+    buffer, as an array
+    """
+    values = array.array('I')
+    values.fromstring(data[offset:offset + count * values.itemsize])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def rollUp(records, level, bucket):
+    """
+    Rolls up a single server's records into buckets of the given length
+
+    :param records = the server's records at the given level,
+    as tuples in the record format of that level, sorted by time
+    :param level = the level the records are at
+    :param bucket = the length of each bucket to roll up into, in seconds
+
+    Returns a list of rollup records, sorted by time
+    """
+    rollups = []
+    current = None
+    for record in records:
+        bucket_start = int(record[0]) // bucket * bucket
+        if current is None or current[0] != bucket_start:
+            current = [bucket_start, record[1], 0, 0, 0, 0.0, 0.0]
+            rollups.append(current)
+        if level == 0:
+            # a single ping
+            current[2] += 1
+            if record[2] == 0:
+                current[3] += 1
+            if record[4] >= 0:
+                current[4] += 1
+                current[5] += record[4]
+                current[6] = max(current[6], record[4])
+        else:
+            # an already rolled up bucket
+            current[2] += record[2]
+            current[3] += record[3]
+            current[4] += record[4]
+            current[5] += record[5]
+            current[6] = max(current[6], record[6])
+    return [tuple(rollup) for rollup in rollups]
+
+
+class HistoryStore:
+
+    def __init__(self, directory, retentions = None):
+        """
+        Initialization function
+
+        Opens the history in the given directory (creating it if need be),
+        sealing and rolling up anything that was left over from the last run
+
+        :param directory = the directory to keep the history in
+        :param retentions = dictionary of {level name: seconds to keep
+        that level for}, for any levels that shouldn't use the default
+        """
+        self.directory = directory
+        self.retentions = [retention for name, bucket, length, retention
+                           in history_levels]
+        for name, retention in (retentions or {}).iteritems():
+            self.retentions[level_names.index(name)] = retention
+        # pings recorded since the last flush, as tuples of (time, server
+        # name, failure class, status code, latency)
+        self.pending = []
+        # held briefly while touching anything below, including by queries
+        self.lock = threading.Lock()
+        # held while writing out (only one flush at a time)
+        self.write_lock = threading.Lock()
+        # {server name: server id}, and the open file of server names
+        self.server_ids = {}
+        self.ids_file = None
+        # the sorted start times of the sealed segments at each level
+        self.segments = [[] for level in history_levels]
+        # the active segment: its start time, the open file, the number of
+        # records in it, and {server id: array of its record numbers}
+        self.active_start = None
+        self.active_file = None
+        self.active_count = 0
+        self.active_index = {}
+        # the last active segment while it is being sealed, as
+        # (start time, {server id: array of its record numbers}),
+        # and the thread sealing it
+        self.sealing = None
+        self.seal_thread = None
+        # the memory-mapped segments, least recently used first
+        self.open_segments = OrderedDict()
+        self._open()
+
+
+    def _path(self, file_name):
+        """
+        Returns the path to a file in the history directory
+        """
+        return os.path.join(self.directory, file_name)
+
+
+    def _open(self):
+        """
+        Reads in the server ids and the list of segments, and picks up
+        anything that didn't get sealed or rolled up before the last run ended
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # the server ids (dropping any partly written name at the end)
+        names = []
+        ids_path = self._path(server_ids_file)
+        if os.path.exists(ids_path):
+            with open(ids_path, 'rb') as infile:
+                for line in infile:
+                    if not line.endswith('\n'):
+                        break
+                    names.append(json.loads(line))
+            with open(ids_path, 'wb') as outfile:
+                outfile.writelines(json.dumps(name) + '\n' for name in names)
+        self.server_ids = dict((name, server_id)
+                               for server_id, name in enumerate(names))
+        self.ids_file = open(ids_path, 'ab')
+
+        # the segments, sealed and active
+        actives = []
+        for file_name in os.listdir(self.directory):
+            base, suffix = os.path.splitext(file_name)
+            if suffix not in (segment_suffix, active_suffix):
+                if suffix == '.tmp':
+                    # a segment that was never finished
+                    os.remove(self._path(file_name))
+                continue
+            name, _, start = base.partition('-')
+            if name not in level_names or not start.isdigit():
+                continue
+            if suffix == segment_suffix:
+                self.segments[level_names.index(name)].append(int(start))
+            elif name == 'raw':
+                actives.append(int(start))
+        for starts in self.segments:
+            starts.sort()
+
+        # seal every active segment but the current one (if it's still the
+        # current hour), without waiting for a background thread
+        now = time.time()
+        raw_length = history_levels[0][2]
+        for start in sorted(actives):
+            if start == max(actives) and start + raw_length > now:
+                self._reopenActive(start)
+            else:
+                self._seal(start, self._readActive(start))
+        self._catchUp(now)
+        return
+
+
+    def _readActive(self, start):
+        """
+        Indexes an active segment left on disk
+        (dropping any partly written record at the end)
+
+        Returns a tuple of (the segment memory-mapped, or None if it is empty,
+        number of records, {server id: array of record numbers}), with the
+        records numbered in the order they were written
+        """
+        path = self._path(segmentName(0, start, active_suffix))
+        size = os.path.getsize(path)
+        count = size // raw_format.size
+        if count * raw_format.size != size:
+            with open(path, 'r+b') as outfile:
+                outfile.truncate(count * raw_format.size)
+        if count == 0:
+            return None, 0, {}
+        with open(path, 'rb') as infile:
+            data = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+        # (only the server id of each record is read, to index it)
+        index = {}
+        for number in xrange(count):
+            server_id = server_id_format.unpack_from(
+                data, number * raw_format.size + server_id_offset)[0]
+            index.setdefault(server_id, array.array('I')).append(number)
+        return data, count, index
+
+
+    def _reopenActive(self, start):
+        """
+        Picks back up appending to an active segment left over from the last run
+        """
+        data, count, index = self._readActive(start)
+        if data is not None:
+            data.close()
+        self.active_start = start
+        self.active_file = open(self._path(segmentName(0, start, active_suffix)), 'ab')
+        self.active_count = count
+        self.active_index = index
+        return
+
+
+    def record(self, server_name, result):
+        """
+        Records a single ping, to be written out by the next flush()
+
+        :param server_name = name of the server that was pinged
+        :param result = the ProbeResult of the ping
+        """
+        latency = result.latency
+        if latency is None:
+            latency = -1.0
+        with self.lock:
+            self.pending.append((time.time(), server_name,
+                                 failure_classes.index(result.failure),
+                                 result.status_code or 0, latency))
+        return
+
+
+    def _serverId(self, server_name):
+        """
+        Returns the id of the given server, giving it one if it doesn't
+        have one yet (only called while flushing)
+        """
+        server_id = self.server_ids.get(server_name)
+        if server_id is None:
+            server_id = len(self.server_ids)
+            self.ids_file.write(json.dumps(server_name) + '\n')
+            self.ids_file.flush()
+            self.server_ids[server_name] = server_id
+        return server_id
+
+
+    def flush(self):
+        """
+        Writes out the pings recorded since the last flush to the active
+        segment, sealing it (in a background thread) and starting a new one
+        once its hour is up
+
+        Meant to be called once a heartbeat, without the tracker lock
+        """
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            start_time = monotonicTime()
+            raw_length = history_levels[0][2]
+            chunk = []
+            for when, server_name, failure, status_code, latency in pending:
+                if self.active_start is None or \
+                   when >= self.active_start + raw_length:
+                    self._writeChunk(chunk)
+                    chunk = []
+                    self._rollOver(when - when % raw_length)
+                # (pings are kept in order within the segment, even if the
+                # clock steps back a little)
+                when = max(when, self.active_start)
+                chunk.append((when, self._serverId(server_name), failure,
+                              status_code, latency))
+            self._writeChunk(chunk)
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('history',))
+        return
+
+
+    def _writeChunk(self, records):
+        """
+        Appends records to the active segment, and adds them to its index
+        """
+        if not records:
+            return
+        self.active_file.write(''.join(raw_format.pack(*record)
+                                       for record in records))
+        self.active_file.flush()
+        # only index the records once they can be read back from the file
+        with self.lock:
+            for record in records:
+                self.active_index.setdefault(record[1], array.array('I')).append(
+                    self.active_count)
+                self.active_count += 1
+        return
+
+
+    def _rollOver(self, start):
+        """
+        Starts a new active segment at the given time, handing the current
+        one (if any) to a background thread to be sealed
+        """
+        previous_start = self.active_start
+        if previous_start is not None:
+            self.active_file.close()
+            # (one seal at a time)
+            if self.seal_thread is not None:
+                self.seal_thread.join()
+        with self.lock:
+            if previous_start is not None:
+                # still readable until it has been sealed
+                self.sealing = (previous_start, self.active_index)
+            self.active_start = start
+            self.active_count = 0
+            self.active_index = {}
+        self.active_file = open(self._path(segmentName(0, start, active_suffix)), 'ab')
+        if previous_start is not None:
+            self.seal_thread = threading.Thread(target = self._sealInBackground,
+                                                args = (previous_start,))
+            self.seal_thread.daemon = True
+            self.seal_thread.start()
+        return
+
+
+    def _sealInBackground(self, start):
+        """
+        Seals an active segment, and then rolls up and cleans out the
+        history (run in its own thread)
+        """
+        start_time = monotonicTime()
+        self._seal(start, self._readActive(start))
+        self._catchUp(time.time())
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('history_seal',))
+        return
+
+
+    def _seal(self, start, active):
+        """
+        Writes out an active segment as a sealed raw segment,
+        and deletes the active segment
+
+        :param start = the start time of the active segment
+        :param active = the active segment, from _readActive()
+        """
+        data, count, index = active
+        # sort by server and then by time (the records of each server
+        # are already in time order), reading each record straight out of
+        # the active segment as it is written out
+        server_ids = sorted(index)
+        self._writeSegment(0, start, server_ids,
+                           (raw_format.unpack_from(data, number * raw_format.size)
+                            for server_id in server_ids
+                            for number in index[server_id]))
+        if data is not None:
+            data.close()
+        with self.lock:
+            self.sealing = None
+        os.remove(self._path(segmentName(0, start, active_suffix)))
+        return
+
+
+    def _writeSegment(self, level, start, server_ids, records):
+        """
+        Writes out a sealed segment, atomically
+
+        The records are written out as they come, with the index (which
+        goes before them) filled in once they are all written, so that
+        the segment is never held in memory all at once
+
+        :param level = the level of the segment
+        :param start = the start time of the segment
+        :param server_ids = the ids of the servers with records in the
+        segment, in order
+        :param records = iterable of the segment's records, sorted by server
+        and then time
+        """
+        record_format = record_formats[level]
+        # the index of each server's records, as (server id, first record,
+        # record count) flattened out
+        index = array.array('I')
+        record_count = 0
+        path = self._path(segmentName(level, start))
+        temp_file = path + '.tmp'
+        with open(temp_file, 'wb') as outfile:
+            outfile.seek(header_format.size + len(server_ids) * index_format.size)
+            chunk = []
+            for record in records:
+                if not index or index[-3] != record[1]:
+                    index.extend((record[1], record_count, 0))
+                index[-1] += 1
+                record_count += 1
+                chunk.append(record_format.pack(*record))
+                if len(chunk) >= write_chunk_records:
+                    outfile.write(''.join(chunk))
+                    chunk = []
+            outfile.write(''.join(chunk))
+            if len(index) != len(server_ids) * 3:
+                raise RuntimeError('Segment {0} has records for {1} servers, '
+                                   'not {2}'.format(segmentName(level, start),
+                                                    len(index) // 3,
+                                                    len(server_ids)))
+            outfile.seek(0)
+            outfile.write(header_format.pack(segment_magic, level, start,
+                                             len(server_ids), record_count))
+            if sys.byteorder != 'little':
+                index.byteswap()
+            outfile.write(index.tostring())
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.rename(temp_file, path)
+        with self.lock:
+            if start not in self.segments[level]:
+                bisect.insort(self.segments[level], start)
+        return
+
+
+    def _catchUp(self, now):
+        """
+        Rolls up every period that is over but hasn't been rolled up yet,
+        and deletes every segment past its level's retention
+
+        :param now = the current time (seconds since the epoch)
+        """
+        with self.lock:
+            # everything before the active segment has been sealed
+            frontier = self.active_start
+        if frontier is None:
+            frontier = now - now % history_levels[0][2]
+
+        for level in xrange(1, len(history_levels)):
+            name, bucket, length, default_retention = history_levels[level]
+            with self.lock:
+                lower_starts = list(self.segments[level - 1])
+                done = set(self.segments[level])
+            periods = sorted(set(start - start % length for start in lower_starts))
+            for period in periods:
+                if period in done or period + length > frontier or \
+                   period + length <= now - self.retentions[level]:
+                    continue
+                segments = [segment for segment in
+                            (self._openSegment(level - 1, lower_start)
+                             for lower_start in lower_starts
+                             if period <= lower_start < period + length)
+                            if segment is not None]
+                server_ids = sorted(set(itertools.chain.from_iterable(
+                    segment[1] for segment in segments)))
+                # roll up a server at a time, as the rollups are written out
+                self._writeSegment(level, period, server_ids,
+                                   (rollup for server_id, records in
+                                    self._serverRecords(level - 1, segments,
+                                                        server_ids)
+                                    for rollup in rollUp(records, level - 1,
+                                                         bucket)))
+
+        # and clean out anything past its retention
+        for level, (name, bucket, length, default_retention) in enumerate(history_levels):
+            cutoff = now - self.retentions[level]
+            with self.lock:
+                expired = [start for start in self.segments[level]
+                           if start + length <= cutoff]
+                self.segments[level] = [start for start in self.segments[level]
+                                        if start + length > cutoff]
+                for start in expired:
+                    self.open_segments.pop((level, start), None)
+            for start in expired:
+                os.remove(self._path(segmentName(level, start)))
+        return
+
+
+    def _openSegment(self, level, start):
+        """
+        Memory-maps a sealed segment (or finds it already mapped)
+
+        Returns a tuple of (the mapped segment, array of server ids, array of
+        their first record numbers, array of their record counts, offset of
+        the first record), or None if the segment has since been deleted
+        """
+        key = (level, start)
+        with self.lock:
+            segment = self.open_segments.pop(key, None)
+            if segment is not None:
+                self.open_segments[key] = segment
+                return segment
+        try:
+            with open(self._path(segmentName(level, start)), 'rb') as infile:
+                data = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+        except (IOError, OSError):
+            return None
+        magic, level, start, server_count, record_count = \
+            header_format.unpack_from(data, 0)
+        index = readIndex(data, header_format.size, server_count * 3)
+        segment = (data, index[0::3], index[1::3], index[2::3],
+                   header_format.size + server_count * index_format.size)
+        with self.lock:
+            self.open_segments[key] = segment
+            # (a segment that is dropped here is unmapped once the last
+            # query still reading it is done with it)
+            while len(self.open_segments) > open_segment_limit:
+                self.open_segments.popitem(last = False)
+        return segment
+
+
+    def _serverRecords(self, level, segments, server_ids):
+        """
+        Reads the records of a run of sealed segments a server at a time,
+        straight out of each segment by its index (so that only a single
+        server's records are ever held in memory)
+
+        :param level = the level of the segments
+        :param segments = the open segments (see _openSegment()), in order
+        of time
+        :param server_ids = the ids of every server in the segments, in order
+
+        Yields a tuple of (server id, list of the server's records,
+        sorted by time) for each server in turn
+        """
+        record_format = record_formats[level]
+        # how far through each segment's index we've got
+        positions = [0] * len(segments)
+        for server_id in server_ids:
+            records = []
+            for number, (data, ids, firsts, counts, offset) in enumerate(segments):
+                position = positions[number]
+                if position == len(ids) or ids[position] != server_id:
+                    continue
+                first = offset + firsts[position] * record_format.size
+                records.extend(record_format.unpack_from(data, first + record *
+                                                         record_format.size)
+                               for record in xrange(counts[position]))
+                positions[number] += 1
+            yield server_id, records
+
+
+    def _segmentRecords(self, level, start, server_id, from_time, to_time, limit):
+        """
+        Returns a single server's records from a sealed segment,
+        from the given time up to (but not including) the given end time
+        """
+        segment = self._openSegment(level, start)
+        if segment is None:
+            return []
+        data, server_ids, firsts, counts, offset = segment
+        position = bisect.bisect_left(server_ids, server_id)
+        if position == len(server_ids) or server_ids[position] != server_id:
+            return []
+        record_format = record_formats[level]
+        low = firsts[position]
+        end = high = low + counts[position]
+        # find the first record at or after the start time
+        time_format = time_formats[level]
+        while low < high:
+            middle = (low + high) // 2
+            if time_format.unpack_from(data, offset + middle * record_format.size)[0] < from_time:
+                low = middle + 1
+            else:
+                high = middle
+        records = []
+        for number in xrange(low, min(end, low + limit)):
+            record = record_format.unpack_from(data, offset + number * record_format.size)
+            if record[0] >= to_time:
+                break
+            records.append(record)
+        return records
+
+
+    def _unsealedRecords(self, unsealed, server_id, from_time, to_time, limit):
+        """
+        Returns a single server's raw records from the active segment
+        (and the last one, if it is still being sealed)
+
+        :param unsealed = list of (start time, array of the server's record
+        numbers), as copied out of the index under the lock
+        """
+        records = []
+        for start, numbers in unsealed:
+            if not numbers:
+                continue
+            try:
+                with open(self._path(segmentName(0, start, active_suffix)), 'rb') as infile:
+                    data = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+            except (IOError, OSError):
+                # it has just been sealed
+                records.extend(self._segmentRecords(0, start, server_id, from_time,
+                                                    to_time, limit - len(records)))
+                continue
+            for number in numbers:
+                record = raw_format.unpack_from(data, number * raw_format.size)
+                if from_time <= record[0] < to_time:
+                    records.append(record)
+                    if len(records) >= limit:
+                        break
+        return records
+
+
+    def _levelRecords(self, level, server_id, from_time, to_time, limit):
+        """
+        Returns a single server's records at the given level over the given
+        range of time, rolling up the level below for any part of the range
+        that hasn't been rolled up at this level yet
+        """
+        name, bucket, length, default_retention = history_levels[level]
+        if bucket is not None:
+            from_time -= from_time % bucket
+        with self.lock:
+            starts = list(self.segments[level])
+            if level == 0:
+                unsealed = []
+                if self.sealing is not None:
+                    unsealed.append((self.sealing[0], array.array(
+                        'I', self.sealing[1].get(server_id, ()))))
+                if self.active_start is not None:
+                    unsealed.append((self.active_start, array.array(
+                        'I', self.active_index.get(server_id, ()))))
+        records = []
+        for start in starts:
+            if start + length <= from_time or start >= to_time:
+                continue
+            records.extend(self._segmentRecords(level, start, server_id, from_time,
+                                                to_time, limit - len(records)))
+            if len(records) >= limit:
+                return records
+
+        covered = starts[-1] + length if starts else 0
+        if to_time > covered:
+            from_time = max(from_time, covered)
+            if level == 0:
+                records.extend(self._unsealedRecords(
+                    [entry for entry in unsealed if entry[0] >= covered],
+                    server_id, from_time, to_time, limit - len(records)))
+            else:
+                lower = self._levelRecords(level - 1, server_id, from_time,
+                                           to_time, sys.maxint)
+                records.extend(rollUp(lower, level - 1, bucket)[:limit - len(records)])
+        return records
+
+
+    def pickResolution(self, start, end, now = None):
+        """
+        Returns the finest level of history that still has the given start
+        time and doesn't have too many points over the given range
+        """
+        if now is None:
+            now = time.time()
+        for level, (name, bucket, length, default_retention) in enumerate(history_levels):
+            if start < now - self.retentions[level]:
+                continue
+            if bucket is None and end - start <= max_auto_raw_range:
+                return level
+            if bucket is not None and (end - start) / bucket <= max_auto_buckets:
+                return level
+        return len(history_levels) - 1
+
+
+    def query(self, server_name, start, end, resolution = None):
+        """
+        Returns the history of a single server over a range of time
+
+        :param server_name = name of the server
+        :param start = start of the range (seconds since the epoch)
+        :param end = end of the range (seconds since the epoch)
+        :param resolution = 'raw', 'minute', or 'hour' (or None to pick
+        whichever suits the range)
+
+        Returns a dictionary of the points in the range, at the given
+        resolution, and the outages found in them, suitable for returning
+        as JSON
+        """
+        if resolution is None:
+            level = self.pickResolution(start, end)
+        else:
+            level = level_names.index(resolution)
+        server_id = self.server_ids.get(server_name)
+        records = []
+        if server_id is not None:
+            records = self._levelRecords(level, server_id, start, end,
+                                         max_history_points + 1)
+        truncated = len(records) > max_history_points
+        records = records[:max_history_points]
+
+        if level == 0:
+            points = [{'time': when, 'status': 'Online' if failure == 0 else 'Offline',
+                       'failure': failure_classes[failure],
+                       'status_code': status_code or None,
+                       'latency': round(latency, 6) if latency >= 0 else None}
+                      for when, server_id, failure, status_code, latency in records]
+            outages = self._rawOutages(records)
+        else:
+            points = [{'time': when, 'pings': pings, 'online': online,
+                       'uptime': online / float(pings),
+                       'mean_latency': round(latency_total / latencies, 6)
+                       if latencies else None,
+                       'max_latency': round(max_latency, 6) if latencies else None}
+                      for when, server_id, pings, online, latencies, latency_total,
+                      max_latency in records]
+            outages = self._rollupOutages(records, history_levels[level][1])
+
+        return {'server': server_name, 'resolution': level_names[level],
+                'start': start, 'end': end, 'points': points,
+                'outages': outages, 'truncated': truncated}
+
+
+    def _rawOutages(self, records):
+        """
+        Finds the outages in a server's raw records: each one runs from the
+        first ping that found the server offline to the next ping that found
+        it online (or has no end, if it is still going at the end of the range)
+        """
+        outages = []
+        outage_start = None
+        for record in records:
+            if record[2] != 0 and outage_start is None:
+                outage_start = record[0]
+            elif record[2] == 0 and outage_start is not None:
+                outages.append({'start': outage_start, 'end': record[0],
+                                'duration': record[0] - outage_start})
+                outage_start = None
+        if outage_start is not None:
+            outages.append({'start': outage_start, 'end': None, 'duration': None})
+        return outages
+
+
+    def _rollupOutages(self, records, bucket):
+        """
+        Finds the outages in a server's rollup records: each one is a run of
+        buckets with failed pings in them, and lasts for roughly the share of
+        each bucket's pings that failed (so the start and end are only as
+        precise as the buckets, but the duration is a fair estimate)
+        """
+        outages = []
+        outage = None
+        for when, server_id, pings, online, latencies, latency_total, \
+            max_latency in records:
+            if online < pings:
+                if outage is None:
+                    outage = {'start': when, 'end': None, 'duration': 0}
+                    outages.append(outage)
+                outage['end'] = when + bucket
+                outage['duration'] += bucket * (pings - online) / float(pings)
+            else:
+                outage = None
+        return outages
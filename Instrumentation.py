@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Instrumentation definitions
+
+These are the classes that we will use to keep track of how the heartbeat
+server itself is doing (how long each heartbeat takes, how long the lock is
+waited on and held, how many pings are in flight, and so on), and to write
+all of that out in the Prometheus text exposition format for the /metrics
+endpoint.
+
+Every metric lives in a single global registry.  The metrics that the rest
+of the heartbeat server records are defined at the bottom of this file, so
+that each module can simply import the ones it needs.
+
+Recording a value is meant to be cheap enough to leave on all the time:
+counters and gauges are a single addition, and histograms are a binary search
+over a short, fixed list of buckets plus an addition.  Each metric has its
+own lock, which is only ever held for that long.
+
+
+Methods:
+--------
+Counter.inc(amount, labels)
+    - adds to a counter (which only ever goes up)
+
+Gauge.set(value, labels) / Gauge.inc(amount, labels)
+    - sets or adds to a gauge (which can go up or down)
+
+CallbackGauge
+    - a gauge whose values are looked up by calling a function whenever
+    the metrics are written out, for values that are already kept elsewhere
+
+Histogram.observe(value, labels)
+    - counts a single value (e.g., a duration in seconds) in a histogram
+
+Registry.render()
+    - writes out every metric in the Prometheus text exposition format
+
+InstrumentedLock
+    - a drop-in replacement for threading.Lock (used as a context manager)
+    that records how long it is waited on and how long it is held
+"""
+# imports
+import bisect
+import threading
+from PingScheduler import monotonicTime
+
+# global for the default histogram buckets, in seconds
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def formatLabels(label_names, label_values, extra = None):
+    """
+    Formats a set of labels as they appear in the exposition format,
+    e.g. {outcome="timeout",le="0.5"}
+
+    :param label_names = the names of the labels
+    :param label_values = the values of the labels, in the same order
+    :param extra = an additional (name, value) pair to tack on the end
+    """
+    pairs = zip(label_names, label_values)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, escapeLabel(value))
+                          for name, value in pairs) + '}'
+
+
+def escapeLabel(value):
+    """
+    Escapes a label value for the exposition format
+    """
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"') \
+                         .replace('\n', '\\n')
+
+
+def formatValue(value):
+    """
+    Formats a sample value for the exposition format
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry:
+
+    def __init__(self):
+        """
+        Initialization function
+        """
+        self.metrics = []
+        self.lock = threading.Lock()
+
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry, and returns it
+        """
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        """
+        Writes out every metric in the Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help_text))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.metric_type))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter:
+
+    metric_type = 'counter'
+
+    def __init__(self, name, help_text, label_names = ()):
+        """
+        Initialization function
+
+        :param name = name of the metric
+        :param help_text = description of the metric
+        :param label_names = names of the labels the metric is broken out by
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        # {tuple of label values: value}
+        # (a metric without labels starts out at zero, rather than missing)
+        self.values = {}
+        if not self.label_names:
+            self.values[()] = 0
+        self.lock = threading.Lock()
+
+
+    def inc(self, amount = 1, labels = ()):
+        """
+        Adds to the value for the given label values
+        """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+        return
+
+
+    def samples(self):
+        """
+        Returns the lines for this metric in the exposition format
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['{0}{1} {2}'.format(self.name,
+                                    formatLabels(self.label_names, labels),
+                                    formatValue(value))
+                for labels, value in values]
+
+
+class Gauge(Counter):
+
+    metric_type = 'gauge'
+
+    def set(self, value, labels = ()):
+        """
+        Sets the value for the given label values
+        """
+        with self.lock:
+            self.values[labels] = value
+        return
+
+
+class CallbackGauge(Counter):
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, label_names = (), callback = None):
+        """
+        Initialization function
+
+        :param callback = function returning a dictionary of
+        {tuple of label values: value}, called whenever the metrics are
+        written out (may be set after the gauge is created)
+        """
+        Counter.__init__(self, name, help_text, label_names)
+        self.callback = callback
+
+
+    def samples(self):
+        """
+        Returns the lines for this metric in the exposition format
+        """
+        if self.callback is None:
+            return []
+        return ['{0}{1} {2}'.format(self.name,
+                                    formatLabels(self.label_names, labels),
+                                    formatValue(value))
+                for labels, value in sorted(self.callback().items())]
+
+
+class Histogram:
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, label_names = (),
+                 buckets = default_buckets):
+        """
+        Initialization function
+
+        :param name = name of the metric
+        :param help_text = description of the metric
+        :param label_names = names of the labels the metric is broken out by
+        :param buckets = the upper bounds of the buckets, in increasing order
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # {tuple of label values: [bucket counts, sum of values]}
+        # (the last bucket count is for anything past the last bucket)
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, labels = ()):
+        """
+        Counts a single value for the given label values
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+        return
+
+
+    def samples(self):
+        """
+        Returns the lines for this metric in the exposition format
+        (note that the bucket counts are cumulative in the exposition format)
+        """
+        with self.lock:
+            values = sorted((labels, (list(counts), total))
+                            for labels, (counts, total) in self.values.items())
+        lines = []
+        for labels, (counts, total) in values:
+            running_count = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                running_count += count
+                lines.append('{0}_bucket{1} {2}'.format(self.name,
+                             formatLabels(self.label_names, labels,
+                                          ('le', formatValue(bound))),
+                             running_count))
+            label_text = formatLabels(self.label_names, labels)
+            lines.append('{0}_sum{1} {2}'.format(self.name, label_text,
+                                                 formatValue(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, label_text,
+                                                   running_count))
+        return lines
+
+
+class InstrumentedLock:
+
+    def __init__(self, wait_histogram, hold_histogram):
+        """
+        Initialization function
+
+        :param wait_histogram = histogram to record the time spent waiting
+        to acquire the lock in
+        :param hold_histogram = histogram to record the time the lock
+        was held for in
+        """
+        self.lock = threading.Lock()
+        self.wait_histogram = wait_histogram
+        self.hold_histogram = hold_histogram
+        self.acquired_time = None
+
+
+    def __enter__(self):
+        start_time = monotonicTime()
+        self.lock.acquire()
+        # only the holder of the lock ever touches the acquired time
+        self.acquired_time = monotonicTime()
+        self.wait_histogram.observe(self.acquired_time - start_time)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        held_time = monotonicTime() - self.acquired_time
+        self.lock.release()
+        self.hold_histogram.observe(held_time)
+        return False
+
+
+########################
+# GLOBAL METRICS HERE
+########################
+registry = Registry()
+
+tick_duration = registry.register(Histogram(
+    'heartbeat_tick_duration_seconds',
+    'Time taken by each heartbeat (pinging every due server)'))
+tick_lag = registry.register(Histogram(
+    'heartbeat_scheduler_lag_seconds',
+    'How late each heartbeat started, compared to when it was meant to'))
+tick_overruns = registry.register(Counter(
+    'heartbeat_tick_overruns_total',
+    'Heartbeats that took longer than the heartbeat period'))
+ticks_skipped = registry.register(Counter(
+    'heartbeat_ticks_skipped_total',
+    'Heartbeats skipped because an earlier heartbeat overran'))
+lock_wait = registry.register(Histogram(
+    'heartbeat_lock_wait_seconds',
+    'Time spent waiting to acquire the server tracker lock'))
+lock_hold = registry.register(Histogram(
+    'heartbeat_lock_hold_seconds',
+    'Time the server tracker lock was held for'))
+probes = registry.register(Counter(
+    'heartbeat_probes_total',
+    'Pings sent, by outcome (online, or the reason the ping failed)',
+    ('outcome',)))
+probes_in_flight = registry.register(Gauge(
+    'heartbeat_probes_in_flight',
+    'Pings currently waiting on a response'))
+probes_reused = registry.register(Counter(
+    'heartbeat_probes_reused_total',
+    'Pings answered with the result of another ping of the same target, '
+    'by reason (cached or coalesced)',
+    ('reason',)))
+probes_deferred = registry.register(Counter(
+    'heartbeat_probes_deferred_total',
+    'Pings held back because their host already had as many pings '
+    'in flight as allowed'))
+dns_lookups = registry.register(Counter(
+    'heartbeat_dns_cache_lookups_total',
+    'Host addresses asked of the DNS cache, by result '
+    '(hit, negative_hit, or miss)',
+    ('result',)))
+dns_resolutions = registry.register(Counter(
+    'heartbeat_dns_resolutions_total',
+    'Host addresses looked up by the resolver threads, by outcome '
+    '(resolved or failed)',
+    ('outcome',)))
+persistence_duration = registry.register(Histogram(
+    'heartbeat_persistence_seconds',
+    'Time spent writing tracked servers out to disk, by operation',
+    ('operation',)))
+tracked_servers = registry.register(CallbackGauge(
+    'heartbeat_tracked_servers',
+    'Servers currently being tracked, by status',
+    ('status',)))
+restore_duration = registry.register(Gauge(
+    'heartbeat_restore_seconds',
+    'Time taken to read the tracked servers back in on startup'))
+cluster_members = registry.register(Gauge(
+    'heartbeat_cluster_members',
+    'Nodes currently on the cluster hash ring, including this one'))
+status_events = registry.register(Counter(
+    'heartbeat_status_events_total',
+    'Status changes handed out to subscribers'))
+webhook_events = registry.register(Counter(
+    'heartbeat_webhook_events_total',
+    'Status change events for webhooks, by outcome (delivered or dropped)',
+    ('outcome',)))
+webhook_queued = registry.register(CallbackGauge(
+    'heartbeat_webhook_queued_events',
+    'Status change events waiting to be delivered, by subscription',
+    ('subscription',)))
@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+__author__ = 'mshadish'
+"""
+Load Benchmark
+==============
+Measures how the heartbeat server holds up with a large number of tracked
+servers, by pointing it at a fleet of fake servers running on this machine
+and driving it through the real heartbeat loop and the Flask endpoints.
+
+The fake servers come in five kinds, mixed in configurable proportions:
+    - fast: answer straight away
+    - slow: answer after a delay
+    - flapping: answer with a success or an error in turns, switching every
+    so often (each server on its own phase)
+    - erroring: always answer with a 500
+    - black-holed: never answer at all (connections to them pile up in a
+    listening socket that never accepts them, so the pings time out)
+Every fake server is a separate tracked server (e.g. 127.0.0.1:40000/fast/17),
+but they are all served by a handful of local HTTP server processes.
+
+For each number of servers, the benchmark:
+    - starts the fake fleet, and starts up the heartbeat server in a fresh
+    process and a fresh directory (so that it starts out with no servers)
+    - adds every server through POST requests to /bulk
+    - runs the heartbeat loop for a while, with a few threads sending
+    requests to the status endpoints the whole time
+    - stops, and then starts the heartbeat server back up in another fresh
+    process, to time reading the servers back in
+and reports:
+    - heartbeat (tick) duration percentiles, overruns, skips, and lag
+    - pings sent per second, by outcome
+    - pings to each kind of server, expected (one per interval) vs. actual
+    (as recorded by the heartbeat), so that a heartbeat that has stalled
+    shows up as far fewer pings than expected (offline servers are backed off
+    by the probe policy, so they fall short of one per interval anyway)
+    - schedule drift: how far the time between pings to each fast server
+    strayed from its interval, or, if no fast server was pinged often enough
+    to tell, whether that's because the heartbeat stalled or because the run
+    was too short to measure
+    - endpoint latency percentiles, for each endpoint
+    - memory per server (growth in resident memory, divided by the servers,
+    both right after adding them and after running)
+    - how long adding the servers took, and how long starting back up took
+
+The results are written out as JSON, so that runs of different versions
+can be compared, either by hand or with --compare.
+
+Note that every fake server shares one of a handful of host:port pairs, so
+the benchmark gives the ping client as many keep-alive connections to each
+one as there can be pings in flight (with the usual two connections per host,
+nearly every ping would open a new connection, and a large fleet would soon
+run out of local ports).
+
+------------
+USAGE NOTES:
+------------
+    python LoadBenchmark.py [--servers 1000,10000,100000] [--duration 90]
+        [--interval 30] [--mix fast=0.7,slow=0.1,flapping=0.1,error=0.05,blackhole=0.05]
+        [--output load_benchmark.json] [--label name] [--compare earlier.json]
+
+Run python LoadBenchmark.py --help for the rest of the options.  Larger runs
+need plenty of open files (ulimit -n) for the fleet's connections.  The
+HEARTBEAT_* environment variables are passed through to the heartbeat server,
+but note that, when sharding, the heartbeats run in the shard processes and
+so aren't timed.
+"""
+# imports
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# global for the numbers of servers to benchmark with
+default_server_counts = (1000, 10000, 100000)
+# global for how long to run the heartbeat for, in seconds
+default_duration = 90
+# global for the ping interval of every server, in seconds
+default_interval = 30
+# global for the proportions of each kind of fake server
+default_mix = (('fast', 0.7), ('slow', 0.1), ('flapping', 0.1),
+               ('error', 0.05), ('blackhole', 0.05))
+fleet_kinds = tuple(kind for kind, share in default_mix)
+# global for how long the slow servers take to answer, in seconds
+default_slow_delay = 0.5
+# global for how often the flapping servers switch, in seconds
+default_flap_period = 15
+# global for the number of processes serving the fake servers
+default_fleet_processes = 4
+# global for the number of threads sending requests to the endpoints
+default_client_threads = 4
+# global for the number of servers added by each request to /bulk
+bulk_chunk_size = 10000
+# global for the file the results are written to
+default_output_file = 'load_benchmark.json'
+# global for the share of their expected pings the fast servers have to get
+# for a run whose schedule drift couldn't be measured not to count as stalled
+stalled_ping_ratio = 0.5
+
+
+def percentiles(values):
+    """
+    Summarizes a list of numbers by their percentiles
+
+    Returns a dictionary of the count, mean, 50th, 90th, and 99th percentiles,
+    and maximum (or just the count, if there are no values)
+    """
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    def at(percent):
+        return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+    return {'count': len(values), 'mean': sum(values) / len(values),
+            'p50': at(50), 'p90': at(90), 'p99': at(99), 'max': values[-1]}
+
+
+def residentMemory():
+    """
+    Returns the resident memory of this process, in bytes
+    (or None if it can't be found out)
+    """
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class FleetServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class FleetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep-alive, so that each ping doesn't need a new connection
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """
+        Answers a ping according to the kind of fake server it is for,
+        which is the first part of the path
+        """
+        now = time.time()
+        kind = self.path.split('/')[1] if self.path.count('/') > 1 else ''
+        if kind == 'fast':
+            # (only the fast servers are used to measure the schedule drift)
+            self.server.arrivals.setdefault(self.path, []).append(now)
+        status_code = 200
+        if kind == 'slow':
+            time.sleep(self.server.slow_delay)
+        elif kind == 'error':
+            status_code = 500
+        elif kind == 'flapping':
+            period = self.server.flap_period
+            phase = zlib.crc32(self.path) % 1000 / 1000.0 * period
+            if int((now + phase) / period) % 2:
+                status_code = 503
+        body = 'ok'
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        return
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        return
+
+
+def runFleetProcess(connection, slow_delay, flap_period):
+    """
+    The main function of a fake server process
+
+    Sends back the port it is listening on, serves pings until it is told to
+    stop, and then sends back the times each fast server was pinged at
+    """
+    server = FleetServer(('127.0.0.1', 0), FleetHandler)
+    server.arrivals = {}
+    server.slow_delay = slow_delay
+    server.flap_period = flap_period
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    connection.send(server.server_address[1])
+    connection.recv()
+    server.shutdown()
+    connection.send(server.arrivals)
+    return
+
+
+def buildServerNames(server_count, mix, ports, black_hole_port):
+    """
+    Names the fake servers, giving each kind its share of the servers
+    (shuffled, so that each kind is spread across the fleet)
+
+    Returns a list of (server name, kind)
+    """
+    kinds = []
+    for kind, share in mix:
+        kinds.extend([kind] * int(round(server_count * share)))
+    kinds = (kinds + ['fast'] * server_count)[:server_count]
+    random.Random(server_count).shuffle(kinds)
+    servers = []
+    for index, kind in enumerate(kinds):
+        port = black_hole_port if kind == 'blackhole' else ports[index % len(ports)]
+        servers.append(('127.0.0.1:{0}/{1}/{2}'.format(port, kind, index), kind))
+    return servers
+
+
+def endpointClient(app, servers, interval, stop_event, latencies):
+    """
+    Sends requests to the endpoints, one after another, until told to stop
+    (run in its own thread)
+
+    :param latencies = dictionary of {endpoint: list of latencies},
+    which is added to as we go
+    """
+    client = app.test_client()
+    server_names = [name for name, kind in servers]
+    requests = (('GET /', lambda server: client.get('/')),
+                ('GET /status', lambda server: client.get('/status?limit=100')),
+                ('GET /status/<server>', lambda server: client.get('/status/' + server)),
+                ('GET /stats/<server>', lambda server: client.get('/stats/' + server)),
+                ('GET /history/<server>',
+                 lambda server: client.get('/history/' + server + '?start=-10m')),
+                ('POST /', lambda server: client.post('/', data = json.dumps(
+                    {'server': server, 'interval': interval}))),
+                ('GET /metrics', lambda server: client.get('/metrics')))
+    while not stop_event.is_set():
+        for endpoint, send in requests:
+            server = random.choice(server_names)
+            start = time.time()
+            send(server)
+            latencies.setdefault(endpoint, []).append(time.time() - start)
+            if stop_event.is_set():
+                break
+    return
+
+
+def runScenario(server_count, options, directory, results):
+    """
+    Runs the benchmark for a single number of servers, in a fresh process
+    (started in the given directory), putting the results on the given queue
+    """
+    os.chdir(directory)
+    # start the fleet before anything else starts any threads
+    fleet = []
+    for index in xrange(options.fleet_processes):
+        parent_end, child_end = multiprocessing.Pipe()
+        process = multiprocessing.Process(target = runFleetProcess,
+                                          args = (child_end, options.slow_delay,
+                                                  options.flap_period))
+        process.daemon = True
+        process.start()
+        fleet.append((process, parent_end))
+    ports = [connection.recv() for process, connection in fleet]
+    # the black hole listens, but never accepts a connection
+    black_hole = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    black_hole.bind(('127.0.0.1', 0))
+    black_hole.listen(1)
+    servers = buildServerNames(server_count, options.mix, ports,
+                               black_hole.getsockname()[1])
+
+    # the ping client needs enough keep-alive connections to each fleet
+    # process for every ping that may be in flight (see the notes above)
+    import ProbeEngine
+    ProbeEngine.default_probe_client = ProbeEngine.ProbeClient(
+        connections_per_host = ProbeEngine.default_max_in_flight)
+    import HeartbeatServer
+    import Instrumentation
+    from HeartbeatLoop import HeartbeatLoop
+    HeartbeatServer.createApp()
+    memory_before = residentMemory()
+    client = HeartbeatServer.my_app.test_client()
+
+    # add every server through /bulk
+    start = time.time()
+    for index in xrange(0, len(servers), bulk_chunk_size):
+        chunk = [{'server': name, 'interval': options.interval}
+                 for name, kind in servers[index:index + bulk_chunk_size]]
+        client.post('/bulk', data = json.dumps(chunk))
+    add_time = time.time() - start
+    memory_added = residentMemory()
+
+    # run the real heartbeat, timing each one
+    tick_durations = []
+    def timedHeartbeat():
+        tick_start = time.time()
+        wait = HeartbeatServer.heartbeatCheck()
+        tick_durations.append(time.time() - tick_start)
+        return wait
+    heartbeat_loop = HeartbeatLoop(timedHeartbeat, HeartbeatServer.heartbeat_tick,
+                                   drain = HeartbeatServer.drainHeartbeat)
+    # with the endpoints being hit the whole time
+    stop_event = threading.Event()
+    latencies = {}
+    clients = [threading.Thread(target = endpointClient,
+                                args = (HeartbeatServer.my_app, servers,
+                                        options.interval, stop_event, latencies))
+               for index in xrange(options.clients)]
+    run_start = time.time()
+    heartbeat_loop.start()
+    for thread in clients:
+        thread.start()
+    time.sleep(options.duration)
+    stop_event.set()
+    for thread in clients:
+        thread.join()
+    heartbeat_loop.stop(drain = True, timeout = 60)
+    run_time = time.time() - run_start
+    memory_after = residentMemory()
+
+    # gather up the pings that reached the fleet
+    arrivals = {}
+    for process, connection in fleet:
+        connection.send('stop')
+        arrivals.update(connection.recv())
+        process.join()
+    black_hole.close()
+    # the pings the heartbeat recorded to each kind of server,
+    # against one per interval for the whole run
+    pings_by_kind = {}
+    for name, kind in servers:
+        counts = pings_by_kind.setdefault(kind, {'servers': 0, 'actual': 0})
+        counts['servers'] += 1
+        metrics = HeartbeatServer.server_tracker.getServerMetrics(name)
+        if metrics is not None:
+            counts['actual'] += metrics['pings']
+    for counts in pings_by_kind.itervalues():
+        counts['expected'] = counts['servers'] * run_time / options.interval
+        counts['ratio'] = counts['actual'] / counts['expected']
+    drift = []
+    for times in arrivals.itervalues():
+        times.sort()
+        # (the first gap includes each server's phase, so it is left out)
+        drift.extend(later - earlier - options.interval
+                     for earlier, later in zip(times[1:], times[2:]))
+    probe_counts = dict((labels[0], int(count)) for labels, count
+                        in Instrumentation.probes.values.items())
+    # (with no drift to go on, a run is only clean if the fast servers
+    # got their pings)
+    drift_status = 'measured'
+    if not drift:
+        fast = pings_by_kind.get('fast')
+        if fast is not None and fast['ratio'] < stalled_ping_ratio:
+            drift_status = 'stalled'
+        else:
+            drift_status = 'unmeasured'
+
+    loop_stats = heartbeat_loop.stats()
+    # (right after adding the servers, and after running, which also counts
+    # their metrics, the history buffers, and anything else built up)
+    added_growth = run_growth = None
+    if memory_before is not None:
+        added_growth = (memory_added - memory_before) / float(server_count)
+        run_growth = (memory_after - memory_before) / float(server_count)
+    results.put({
+        'servers': server_count,
+        'kinds': dict((kind, sum(1 for name, server_kind in servers
+                                 if server_kind == kind)) for kind in fleet_kinds),
+        'bulk_add_seconds': add_time,
+        'run_seconds': run_time,
+        'ticks': dict(percentiles(tick_durations),
+                      overruns = loop_stats['overruns'],
+                      skipped = loop_stats['skipped'],
+                      max_lag = loop_stats['max_lag'],
+                      mean_lag = loop_stats['mean_lag']),
+        'probes': {'total': sum(probe_counts.values()),
+                   'per_second': sum(probe_counts.values()) / run_time,
+                   'by_outcome': probe_counts},
+        'pings_by_kind': pings_by_kind,
+        'schedule_drift': dict(percentiles([abs(value) for value in drift]),
+                               late = sum(1 for value in drift if value > 1),
+                               early = sum(1 for value in drift if value < -1),
+                               status = drift_status),
+        'endpoints': dict((endpoint, percentiles(values))
+                          for endpoint, values in latencies.iteritems()),
+        'memory': {'before_bytes': memory_before,
+                   'after_add_bytes': memory_added,
+                   'after_run_bytes': memory_after,
+                   'per_server_added_bytes': added_growth,
+                   'per_server_bytes': run_growth},
+    })
+    return
+
+
+def measureRestore(directory, results):
+    """
+    Times starting the heartbeat server back up in the given directory
+    (in a fresh process), putting the results on the given queue
+    """
+    os.chdir(directory)
+    start = time.time()
+    import HeartbeatServer
+    HeartbeatServer.createApp()
+    results.put({'startup_seconds': time.time() - start,
+                 'restore_seconds': HeartbeatServer.server_tracker.restore_time})
+    return
+
+
+def runInProcess(target, *args):
+    """
+    Runs the given function in a fresh process, returning what it puts
+    on the results queue (or None if it died without putting anything)
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target = target, args = args + (results,))
+    process.start()
+    result = None
+    while result is None and (process.is_alive() or not results.empty()):
+        try:
+            result = results.get(timeout = 1)
+        except Exception:
+            continue
+    process.join()
+    return result
+
+
+def compareResults(earlier, later):
+    """
+    Prints the headline numbers of two sets of results side by side
+    """
+    headlines = (('tick p50 (s)', ('ticks', 'p50')),
+                 ('tick p99 (s)', ('ticks', 'p99')),
+                 ('tick overruns', ('ticks', 'overruns')),
+                 ('pings/second', ('probes', 'per_second')),
+                 ('fast pings/expected', ('pings_by_kind', 'fast', 'ratio')),
+                 ('drift p99 (s)', ('schedule_drift', 'p99')),
+                 ('memory/server (bytes)', ('memory', 'per_server_bytes')),
+                 ('bulk add (s)', ('bulk_add_seconds',)),
+                 ('restore (s)', ('restore', 'restore_seconds')))
+    def lookup(run, path):
+        for key in path:
+            if not isinstance(run, dict) or key not in run:
+                return None
+            run = run[key]
+        return run
+    earlier_runs = dict((run['servers'], run) for run in earlier['runs'])
+    print '{0:<32} {1:>14} {2:>14} {3:>8}'.format(
+        '', earlier.get('label') or 'earlier', later.get('label') or 'later', 'ratio')
+    for run in later['runs']:
+        earlier_run = earlier_runs.get(run['servers'])
+        if earlier_run is None:
+            continue
+        print '{0:,} servers'.format(run['servers'])
+        rows = [(name, path) for name, path in headlines]
+        rows.extend(('{0} p99 (s)'.format(endpoint), ('endpoints', endpoint, 'p99'))
+                    for endpoint in sorted(run['endpoints']))
+        for name, path in rows:
+            old, new = lookup(earlier_run, path), lookup(run, path)
+            ratio = ''
+            if old and new is not None:
+                ratio = '{0:.2f}x'.format(new / float(old))
+            print '  {0:<30} {1:>14} {2:>14} {3:>8}'.format(
+                name, '{0:.4g}'.format(old) if old is not None else '-',
+                '{0:.4g}'.format(new) if new is not None else '-', ratio)
+    return
+
+
+def parseMix(value):
+    """
+    Parses the proportions of each kind of fake server, e.g.
+    fast=0.7,slow=0.1,flapping=0.1,error=0.05,blackhole=0.05
+    (any kinds left out get none of the servers)
+    """
+    mix = []
+    for item in value.split(','):
+        kind, _, share = item.partition('=')
+        if kind.strip() not in fleet_kinds:
+            raise argparse.ArgumentTypeError('Unknown kind of server: ' + kind)
+        mix.append((kind.strip(), float(share)))
+    return tuple(mix)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Load benchmark for the '
+                                     'heartbeat server (see the notes at the '
+                                     'top of LoadBenchmark.py)')
+    parser.add_argument('--servers', default = ','.join(str(count) for count
+                                                        in default_server_counts),
+                        help = 'comma-separated numbers of servers to run with')
+    parser.add_argument('--duration', type = float, default = default_duration,
+                        help = 'seconds to run the heartbeat for')
+    parser.add_argument('--interval', type = float, default = default_interval,
+                        help = 'ping interval of every server, in seconds')
+    parser.add_argument('--mix', type = parseMix, default = default_mix,
+                        help = 'proportions of each kind of fake server')
+    parser.add_argument('--slow-delay', type = float, default = default_slow_delay,
+                        help = 'seconds the slow servers take to answer')
+    parser.add_argument('--flap-period', type = float, default = default_flap_period,
+                        help = 'seconds between the flapping servers switching')
+    parser.add_argument('--fleet-processes', type = int,
+                        default = default_fleet_processes,
+                        help = 'processes serving the fake servers')
+    parser.add_argument('--clients', type = int, default = default_client_threads,
+                        help = 'threads sending requests to the endpoints')
+    parser.add_argument('--output', default = default_output_file,
+                        help = 'file to write the results to')
+    parser.add_argument('--label', default = '',
+                        help = 'name for this run (e.g., the version benchmarked)')
+    parser.add_argument('--compare', metavar = 'FILE',
+                        help = 'earlier results to compare these ones with')
+    options = parser.parse_args()
+
+    # the heartbeat server is imported from here, whatever directory it runs in
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    output = {'label': options.label, 'started_at': time.time(),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'options': {'duration': options.duration, 'interval': options.interval,
+                          'mix': dict(options.mix), 'slow_delay': options.slow_delay,
+                          'flap_period': options.flap_period,
+                          'fleet_processes': options.fleet_processes,
+                          'clients': options.clients},
+              'runs': []}
+    for server_count in [int(count) for count in options.servers.split(',')]:
+        print 'Benchmarking {0:,} servers...'.format(server_count)
+        directory = tempfile.mkdtemp(prefix = 'heartbeat_benchmark_')
+        try:
+            run = runInProcess(runScenario, server_count, options, directory)
+            if run is None:
+                print '  the benchmark process died'
+                continue
+            run['restore'] = runInProcess(measureRestore, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors = True)
+        output['runs'].append(run)
+        print '  tick p50 {0:.3f}s p99 {1:.3f}s, {2:.0f} pings/second, ' \
+              '{3:.0f} bytes/server'.format(run['ticks'].get('p50', 0),
+                                            run['ticks'].get('p99', 0),
+                                            run['probes']['per_second'],
+                                            run['memory']['per_server_bytes'] or 0)
+        for kind in fleet_kinds:
+            counts = run['pings_by_kind'].get(kind)
+            if counts is not None:
+                print '  {0}: {1} of {2:.0f} expected pings'.format(
+                    kind, counts['actual'], counts['expected'])
+        if run['schedule_drift']['status'] != 'measured':
+            print '  schedule drift {0} (no fast server was pinged ' \
+                  'more than twice)'.format(run['schedule_drift']['status'])
+
+    with open(options.output, 'wb') as outfile:
+        json.dump(output, outfile, indent = 2, sort_keys = True)
+    print 'Results written to {0}'.format(options.output)
+
+    if options.compare:
+        with open(options.compare, 'rb') as infile:
+            compareResults(json.load(infile), output)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+__author__ = 'mshadish'
+"""
+Memory Benchmark
+================
+Compares how much memory it takes to hold a large number of tracked servers
+using the server records in a single dictionary (see ServerRecord.py)
+against the original layout of two dictionaries (one for online servers,
+one for offline) of two-element lists:
+
+    {server_name: [time of last ping, ping wait time interval]}
+
+Sizes are measured by walking each structure and adding up sys.getsizeof
+of every object in it (counting each object only once).  The server names
+themselves are left out, since both layouts share the very same strings.
+
+------------
+USAGE NOTES:
+------------
+    python MemoryBenchmark.py [number of servers]
+
+The number of servers defaults to 100,000.
+"""
+# imports
+import sys
+import time
+from ServerRecord import ServerRecord
+
+# global for the number of servers to benchmark with
+default_server_count = 100000
+
+
+def deepSize(obj, seen):
+    """
+    Adds up the size of the given object and of everything it holds on to
+
+    :param obj = the object to size up
+    :param seen = set of ids of objects that have already been counted
+    (which is updated as we go)
+
+    Returns the size, in bytes
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += deepSize(key, seen) + deepSize(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deepSize(item, seen)
+    elif hasattr(obj, '__slots__'):
+        for slot in obj.__slots__:
+            size += deepSize(getattr(obj, slot), seen)
+
+    return size
+
+
+def buildListLayout(names, now):
+    """
+    Builds the original layout: online and offline dictionaries
+    of [time of last ping, ping interval] lists
+    (every other server is online)
+    """
+    online_servers = {}
+    offline_servers = {}
+    for index, name in enumerate(names):
+        # each server gets its own last ping time, as it would in practice
+        if index % 2 == 0:
+            online_servers[name] = [now + index, 30]
+        else:
+            offline_servers[name] = [now + index, 30]
+    return online_servers, offline_servers
+
+
+def buildRecordLayout(names, now):
+    """
+    Builds the record layout: a single dictionary of server records
+    (every other server is online)
+    """
+    servers = {}
+    for index, name in enumerate(names):
+        if index % 2 == 0:
+            status = 'Online'
+        else:
+            status = 'Offline'
+        servers[name] = ServerRecord(name, 30, status, now + index)
+    return servers
+
+
+def measure(build, names, now):
+    """
+    Builds a layout and sizes it up
+
+    Returns a tuple of (size in bytes, seconds taken to build)
+    """
+    start = time.time()
+    layout = build(names, now)
+    build_time = time.time() - start
+    # don't count the shared server names
+    seen = set(id(name) for name in names)
+    return deepSize(layout, seen), build_time
+
+
+if __name__ == '__main__':
+    server_count = default_server_count
+    if len(sys.argv) > 1:
+        server_count = int(sys.argv[1])
+
+    names = ['server{0}.example.com'.format(i) for i in xrange(server_count)]
+    now = time.time()
+
+    print 'Memory used by {0} tracked servers:'.format(server_count)
+    for label, build in (('online/offline dictionaries of lists', buildListLayout),
+                         ('single dictionary of server records', buildRecordLayout)):
+        size, build_time = measure(build, names, now)
+        print '  {0:<40} {1:>12,} bytes  {2:>7.1f} bytes/server  ' \
+              '(built in {3:.3f}s)'.format(label, size,
+                                           size / float(server_count),
+                                           build_time)
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Notifications definition
+
+These are the classes that we will use to tell subscribers about servers
+changing status, so that they don't have to keep polling for the status of
+every server to notice when one goes offline (or comes back online).
+
+Every time a new status snapshot is published (see StatusSnapshot.py), it is
+compared against the one before it, and each server whose status changed
+becomes an event:
+
+    {"seq": 42, "server": "google.com", "previous": "Online",
+     "status": "Offline", "time": 1420070400.0}
+
+Events are numbered in order, and the most recent ones are kept in a bounded
+history, which subscribers can read from in one of two ways:
+    - long-polling, i.e. asking for the events after a given number and
+    waiting (up to a timeout) until there are some
+    - a stream of server-sent events, which is the same thing in a loop
+
+Subscribers can also register a webhook, i.e. a URL that we POST the events
+to.  Each webhook has its own bounded queue of events and its own delivery
+thread, so a slow (or dead) webhook can never hold up the heartbeat or any
+other webhook.  The delivery thread sends events in batches, retrying a
+failed batch a few times (with exponential backoff) before giving up on it.
+If a webhook falls so far behind that its queue fills up, the oldest events
+are dropped to make room, and the number dropped is passed along in the next
+batch so that the subscriber knows to catch up on the full status.
+
+Subscriptions are kept in memory only, so webhooks need to be registered
+again after a restart.
+
+
+Methods:
+--------
+statusChanges(old snapshot, new snapshot)
+    - returns the (server name, previous status, new status) of every server
+    whose status differs between the two snapshots
+
+EventHub.publish(list of changes)
+    - turns status changes into events, and hands them to every subscriber
+
+EventHub.eventsSince(event number, timeout)
+    - returns the events after the given one, waiting up to the timeout
+    for some to come in
+
+EventHub.subscribe(url) / EventHub.unsubscribe(subscription id)
+    - registers or removes a webhook
+
+WebhookSubscriber.describe()
+    - returns a dictionary describing a webhook and how its deliveries
+    have been going
+"""
+# imports
+import collections
+import itertools
+import threading
+import time
+import traceback
+import uuid
+import requests
+from PingScheduler import monotonicTime
+import Instrumentation
+
+# global for the number of recent events we'll keep for long-polling
+default_history_size = 10000
+# global for the most events we'll return from a single long-poll
+default_max_poll_events = 1000
+# global for the most events we'll queue up for a single webhook
+default_queue_size = 10000
+# global for the most events we'll send to a webhook at once
+default_batch_size = 100
+# global for how long we'll wait for more events to batch together, in seconds
+default_batch_delay = 0.5
+# global for how many times we'll retry a failed batch before giving up on it
+default_max_retries = 5
+# global for how long we'll wait before the first retry, in seconds
+# (which doubles with each retry, up to the maximum)
+default_retry_delay = 0.5
+default_max_retry_delay = 30
+# global for the (connect, read) timeouts of requests to webhooks
+webhook_request_timeouts = (2, 5)
+
+
+def statusChanges(old_snapshot, new_snapshot):
+    """
+    Compares two status snapshots
+
+    :param old_snapshot = the earlier snapshot (or None)
+    :param new_snapshot = the later snapshot
+
+    Returns a list of (server name, previous status, status) for every server
+    whose status changed (servers that are new in the later snapshot have a
+    previous status of None, and servers that are still 'Unknown' are left
+    out, since nothing has been found out about them yet)
+    """
+    if old_snapshot is None:
+        return []
+    if old_snapshot.names == new_snapshot.names:
+        # the same servers (the usual case), so we can walk them side by side
+        return [(server, old_status, status) for (server, interval, status),
+                (old_server, old_interval, old_status)
+                in itertools.izip(new_snapshot.rows, old_snapshot.rows)
+                if status != old_status and status != 'Unknown']
+    old_statuses = dict((server, status) for server, interval, status
+                        in old_snapshot.rows)
+    return [(server, old_statuses.get(server), status)
+            for server, interval, status in new_snapshot.rows
+            if status != old_statuses.get(server) and status != 'Unknown']
+
+
+class EventHub:
+
+    def __init__(self, history_size = default_history_size):
+        """
+        Initialization function
+
+        :param history_size = number of recent events to keep
+        """
+        self.events = collections.deque(maxlen = history_size)
+        # the number of the last event handed out
+        self.last_seq = 0
+        # held while touching the events or the subscribers, and notified
+        # whenever new events come in
+        self.condition = threading.Condition()
+        # {subscription id: WebhookSubscriber}
+        self.subscribers = {}
+
+
+    def publish(self, changes):
+        """
+        Turns status changes into events, adds them to the history,
+        and hands them to every webhook
+
+        :param changes = list of (server name, previous status, status)
+        """
+        if not changes:
+            return
+        now = time.time()
+        with self.condition:
+            events = []
+            for server, previous, status in changes:
+                self.last_seq += 1
+                events.append({'seq': self.last_seq, 'server': server,
+                               'previous': previous, 'status': status,
+                               'time': now})
+            self.events.extend(events)
+            self.condition.notify_all()
+            subscribers = self.subscribers.values()
+        # handing the events to a webhook only ever queues them up
+        for subscriber in subscribers:
+            subscriber.enqueue(events)
+        Instrumentation.status_events.inc(len(events))
+        return
+
+
+    def eventsSince(self, seq, timeout, limit = default_max_poll_events):
+        """
+        Returns the events after the given one, waiting up to the given
+        timeout for some to come in if there aren't any yet
+
+        :param seq = the number of the last event the subscriber has seen
+        (or None, to only wait for new events)
+        :param timeout = most seconds to wait
+        :param limit = most events to return
+
+        Returns a tuple of (list of events, number of the last event returned
+        or seen, whether any events after the given one have already been
+        dropped from the history)
+        
+        An event number we haven't got to yet (e.g., one handed out before
+        a restart, which numbers the events from the start again) counts as
+        events having been dropped, and is answered straight away, so that
+        the subscriber checks the full status and picks up from our numbers
+        """
+        deadline = monotonicTime() + timeout
+        with self.condition:
+            if seq is not None and seq > self.last_seq:
+                return [], self.last_seq, True
+            if seq is None:
+                seq = self.last_seq
+            while self.last_seq <= seq:
+                remaining = deadline - monotonicTime()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            missed = False
+            events = []
+            if self.events:
+                first_seq = self.events[0]['seq']
+                missed = first_seq > seq + 1
+                start = max(seq + 1 - first_seq, 0)
+                events = list(itertools.islice(self.events, start,
+                                               start + limit))
+        if events:
+            seq = events[-1]['seq']
+        return events, seq, missed
+
+
+    def subscribe(self, url):
+        """
+        Registers a webhook, and starts delivering events to it
+
+        :param url = the URL to POST events to
+
+        Returns the new WebhookSubscriber
+        """
+        subscriber = WebhookSubscriber(uuid.uuid4().hex, url)
+        with self.condition:
+            self.subscribers[subscriber.subscription_id] = subscriber
+        subscriber.start()
+        return subscriber
+
+
+    def unsubscribe(self, subscription_id):
+        """
+        Removes a webhook, and stops delivering events to it
+
+        Returns whether there was a webhook to remove
+        """
+        with self.condition:
+            subscriber = self.subscribers.pop(subscription_id, None)
+        if subscriber is None:
+            return False
+        subscriber.stop()
+        return True
+
+
+    def describe(self):
+        """
+        Returns a list describing every webhook
+        """
+        with self.condition:
+            subscribers = self.subscribers.values()
+        return [subscriber.describe() for subscriber in subscribers]
+
+
+    def queuedEvents(self):
+        """
+        Returns the number of events waiting to be delivered to each webhook,
+        for the /metrics endpoint
+        """
+        with self.condition:
+            subscribers = self.subscribers.values()
+        return dict(((subscriber.subscription_id,), subscriber.queuedCount())
+                    for subscriber in subscribers)
+
+
+class WebhookSubscriber:
+
+    def __init__(self, subscription_id, url, queue_size = default_queue_size,
+                 batch_size = default_batch_size,
+                 batch_delay = default_batch_delay,
+                 max_retries = default_max_retries):
+        """
+        Initialization function
+
+        :param subscription_id = the id of this subscription
+        :param url = the URL to POST events to
+        :param queue_size = most events to queue up
+        :param batch_size = most events to send at once
+        :param batch_delay = how long to wait for more events
+        to batch together, in seconds
+        :param max_retries = how many times to retry a failed batch
+        """
+        self.subscription_id = subscription_id
+        self.url = url
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_retries = max_retries
+        # the queue of events waiting to go out, and a condition
+        # that is notified whenever events are added to it
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        # events dropped since the last batch that went out
+        self.unreported_drops = 0
+        self.session = requests.Session()
+        self.stop_event = threading.Event()
+        self.thread = None
+        # stats on how the deliveries have been going
+        self.delivered_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+        self.last_error = None
+
+
+    def start(self):
+        """
+        Starts delivering events in our own (daemon) thread
+        """
+        self.thread = threading.Thread(target = self._run,
+                                       name = 'webhook-' + self.subscription_id)
+        self.thread.daemon = True
+        self.thread.start()
+        return
+
+
+    def stop(self):
+        """
+        Stops delivering events (anything still queued is thrown away)
+        """
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify()
+        return
+
+
+    def enqueue(self, events):
+        """
+        Queues up events for delivery, dropping the oldest events
+        if the queue is full (this never waits on the webhook)
+        """
+        with self.condition:
+            overflow = len(self.queue) + len(events) - self.queue_size
+            for _ in xrange(min(max(overflow, 0), len(self.queue))):
+                self.queue.popleft()
+                self._recordDrops(1)
+            # (more events than the whole queue holds just keeps the newest)
+            if len(events) > self.queue_size:
+                self._recordDrops(len(events) - self.queue_size)
+                events = events[-self.queue_size:]
+            self.queue.extend(events)
+            self.condition.notify()
+        return
+
+
+    def _recordDrops(self, count):
+        """
+        Counts events that were dropped without being delivered
+        """
+        self.unreported_drops += count
+        self.dropped_count += count
+        Instrumentation.webhook_events.inc(count, labels = ('dropped',))
+        return
+
+
+    def queuedCount(self):
+        """
+        Returns the number of events waiting to go out
+        """
+        with self.condition:
+            return len(self.queue)
+
+
+    def _run(self):
+        """
+        The delivery loop, run in our own thread
+        """
+        while not self.stop_event.is_set():
+            with self.condition:
+                while not self.queue and not self.stop_event.is_set():
+                    # (waking up now and then, since a wait without a
+                    # timeout can't be interrupted)
+                    self.condition.wait(1)
+                if self.stop_event.is_set():
+                    break
+                queued = len(self.queue)
+            # give a few more events a chance to come in,
+            # so that they go out together
+            if queued < self.batch_size and \
+               self.stop_event.wait(self.batch_delay):
+                break
+            with self.condition:
+                batch = [self.queue.popleft() for _ in
+                         xrange(min(self.batch_size, len(self.queue)))]
+                dropped = self.unreported_drops
+                self.unreported_drops = 0
+            try:
+                self._deliver(batch, dropped)
+            except Exception:
+                # a bad batch shouldn't stop every delivery after it
+                traceback.print_exc()
+        return
+
+
+    def _deliver(self, batch, dropped):
+        """
+        Sends a batch of events to the webhook, retrying with exponential
+        backoff if it fails
+
+        :param batch = list of events
+        :param dropped = number of events dropped since the last batch
+        """
+        body = {'subscription': self.subscription_id, 'events': batch,
+                'dropped': dropped}
+        delay = default_retry_delay
+        for attempt in xrange(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, json = body,
+                                             timeout = webhook_request_timeouts)
+                response.raise_for_status()
+            except requests.RequestException as error:
+                self.last_error = str(error)
+                # wait before trying again (unless we're asked to stop)
+                if attempt == self.max_retries or self.stop_event.wait(delay):
+                    break
+                delay = min(delay * 2, default_max_retry_delay)
+                continue
+            self.delivered_count += len(batch)
+            Instrumentation.webhook_events.inc(len(batch),
+                                               labels = ('delivered',))
+            return True
+
+        # we've given up on this batch, so the subscriber will hear
+        # about the events (and any drops) as dropped in the next one
+        self.failed_count += 1
+        with self.condition:
+            self._recordDrops(len(batch))
+            self.unreported_drops += dropped
+        return False
+
+
+    def describe(self):
+        """
+        Returns a dictionary describing this webhook and how its
+        deliveries have been going
+        """
+        return {'id': self.subscription_id, 'url': self.url,
+                'queued': self.queuedCount(),
+                'delivered': self.delivered_count,
+                'failed_batches': self.failed_count,
+                'dropped': self.dropped_count,
+                'last_error': self.last_error}
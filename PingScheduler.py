@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Ping scheduler definition
+
+This is the class that we will use to keep track of when each server is
+next due for a ping.  Rather than counting up a timer for every server on
+every tick and then checking every server to see whether its timer has run
+out, we keep a min-heap of (next due time, server name) entries.  On each
+tick we only pop the entries off the top of the heap that are actually due,
+so the servers that aren't due are never touched.
+
+Due times are taken from a monotonic clock, so that changes to the wall
+clock can't cause servers to be skipped or pinged in a burst.  Python 2 has
+no monotonic clock of its own, so we read CLOCK_MONOTONIC through
+clock_gettime() in the C library (time.monotonic is used where it exists).
+Failing both, we fall back to the wall clock, but never let it go backwards,
+so that a step back only holds the clock still rather than holding up every
+ping for the size of the step.  Intervals are in (possibly fractional)
+seconds.
+
+Rather than digging through the heap to remove or move a server, we keep
+a separate dictionary of {server name: next due time} which is the source
+of truth.  Any entry on the heap that doesn't match this dictionary is stale
+and is simply thrown away when it reaches the top of the heap.
+
+
+Methods:
+--------
+schedule(server name, due time)
+    - (re)schedules the given server to be pinged at the given time
+
+unschedule(server name)
+    - stops scheduling pings for the given server
+
+popDueServers(current time, limit)
+    - removes and returns all of the servers that are due as of the given time
+    (or just the limit most overdue, if a limit is given),
+    along with the time each of them was due
+
+nextDueTime()
+    - returns the time at which the next server is due, or None if
+    there is nothing scheduled
+"""
+# imports
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import sys
+import threading
+import time
+
+# global for the number of CLOCK_MONOTONIC on each platform we know of
+monotonic_clock_ids = {'linux': 1, 'linux2': 1, 'darwin': 6, 'freebsd': 4}
+
+
+class Timespec(ctypes.Structure):
+    # struct timespec, as filled in by clock_gettime()
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def clockGettimeClock():
+    """
+    Looks up clock_gettime() in the C library
+
+    Returns a function reading CLOCK_MONOTONIC in seconds, or None if
+    there is no clock_gettime() (or no CLOCK_MONOTONIC) that we can use
+    """
+    clock_id = None
+    for platform, number in monotonic_clock_ids.items():
+        if sys.platform.startswith(platform):
+            clock_id = number
+    if clock_id is None:
+        return None
+    clock_gettime = None
+    # (older C libraries keep it in librt)
+    for library in (ctypes.util.find_library('c'),
+                    ctypes.util.find_library('rt')):
+        try:
+            clock_gettime = ctypes.CDLL(library, use_errno = True).clock_gettime
+            break
+        except (OSError, AttributeError, TypeError):
+            continue
+    if clock_gettime is None:
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+    clock_gettime.restype = ctypes.c_int
+    
+    def readClock():
+        timespec = Timespec()
+        if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    
+    try:
+        readClock()
+    except OSError:
+        return None
+    return readClock
+
+
+def forwardOnlyClock():
+    """
+    Returns a function reading the wall clock that never goes backwards
+    (a step back is taken off every later reading instead)
+    """
+    lock = threading.Lock()
+    # [the latest reading handed out, how far the clock has stepped back]
+    state = [time.time(), 0.0]
+    
+    def readClock():
+        with lock:
+            now = time.time() + state[1]
+            if now < state[0]:
+                state[1] += state[0] - now
+                now = state[0]
+            state[0] = now
+            return now
+    
+    return readClock
+
+
+# the clock we'll use for all scheduling (and for timing everything else)
+monotonicTime = getattr(time, 'monotonic', None) or clockGettimeClock() or \
+                forwardOnlyClock()
+
+
+class PingScheduler:
+
+    def __init__(self):
+        """
+        Initialization function
+        """
+        # the heap itself, made up of (due time, sequence number, server name)
+        # the sequence number breaks ties between servers due at the same
+        # time, so that we never fall back to comparing server names
+        self.heap = []
+        self.sequence = itertools.count()
+        # the current due time of every scheduled server
+        self.due_times = {}
+
+
+    def __len__(self):
+        return len(self.due_times)
+
+
+    def schedule(self, server, due_time):
+        """
+        Schedules a server to be pinged at the given time,
+        replacing any time that server was previously scheduled for
+
+        :param server = name of the server to schedule
+        :param due_time = monotonic time at which the server is due
+        """
+        self.due_times[server] = due_time
+        heapq.heappush(self.heap, (due_time, next(self.sequence), server))
+        return
+
+
+    def unschedule(self, server):
+        """
+        Stops scheduling pings for the given server
+        (the entry left on the heap is now stale and will be skipped)
+
+        :param server = name of the server to stop scheduling
+        """
+        self.due_times.pop(server, None)
+        return
+
+
+    def _discardStaleEntries(self):
+        """
+        Pops entries off the top of the heap until the top entry
+        is one that is still current
+        """
+        while self.heap:
+            due_time, seq, server = self.heap[0]
+            if self.due_times.get(server) == due_time:
+                break
+            heapq.heappop(self.heap)
+        return
+
+
+    def popDueServers(self, now, limit = None):
+        """
+        Removes every server that is due as of the given time
+
+        :param now = current monotonic time
+        :param limit = the most servers to remove (or None for no limit),
+        in which case the servers that have been due the longest go first
+        and the rest are left where they are
+
+        Returns a list of (server name, time that the server was due) tuples
+        """
+        due = []
+        self._discardStaleEntries()
+        while self.heap and self.heap[0][0] <= now and \
+              (limit is None or len(due) < limit):
+            due_time, seq, server = heapq.heappop(self.heap)
+            # the server is no longer scheduled until it is rescheduled
+            self.due_times.pop(server)
+            due.append((server, due_time))
+            self._discardStaleEntries()
+
+        return due
+
+
+    def nextDueTime(self):
+        """
+        Returns the monotonic time at which the next server is due,
+        or None if there are no servers scheduled
+        """
+        self._discardStaleEntries()
+        if not self.heap:
+            return None
+        return self.heap[0][0]
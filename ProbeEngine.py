@@ -0,0 +1,790 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Probe engine definition
+
+This is the class that we will use to send out pings to many servers at once.
+Rather than pinging each due server one after another (where a single slow
+server would hold up every other server behind it), the probe engine keeps
+a fixed pool of worker threads around and hands each of them a server to ping.
+All of the pings in a batch are fired in parallel, and the results are
+gathered up and handed back once the whole batch has completed.
+
+The size of the worker pool bounds the number of pings that can be in flight
+at any one time, and every ping is given a timeout so that a hung server
+cannot tie up a worker indefinitely.  Since the connect and read timeouts
+are only on each connection attempt and each read (and a ping may try
+several addresses, and follow several redirects), every ping is also given
+a deadline for the whole ping, and every batch a deadline of its own: a ping
+that isn't back by the batch's deadline counts as timed out, and one that
+hasn't even been sent by then is left out of the batch's results (to be sent
+with a later batch), so that the batch never waits any longer than that.
+
+Server names that point at the same target (e.g. 'Google.com' and
+'google.com/', or 'google.com:80') are pinged as one: each name is normalized
+into a target (the lowercased host, without a default port or trailing
+slashes or dots, and the path), and
+    - within a batch, the names of a single target share a single ping
+    - a ping that is asked for while the same target is already being pinged
+    waits for that ping's result rather than sending another (single-flight)
+    - each target's last result is cached for a short time, so that, e.g.,
+    adding a server that the heartbeat has only just pinged doesn't ping it
+    again
+'www.' is only dropped from the host if merge_www_aliases is set, since
+example.com and www.example.com are quite often served differently.
+
+On top of the worker pool, there is a limit on the pings in flight to any
+one host, so that a single origin serving hundreds of the servers we track
+(e.g. one per virtual host or path) doesn't get hammered with all of their
+pings at once (once a host's address has been looked up, the limit is on
+the pings to that address instead, so that it also covers different host names
+that point at the same machine).  A worker that picks up a ping to a host that
+is already at its limit leaves it for whichever worker next finishes a ping
+to that host, and moves on to the next ping, so that one busy host can't tie
+up every worker.  Once a ping to a host times out (or can't connect at all),
+though, the rest of the pings left waiting on that host are put off to a
+later batch rather than sent a few at a time, since each of them would only
+keep the batch waiting for another timeout.
+
+The pings themselves are sent by a probe client, which holds on to a pool
+of keep-alive connections for each server it has pinged.  That way a ping
+to a server we've already pinged can reuse the open connection, rather than
+paying for a fresh TCP (and TLS) handshake every time.  The address of each
+server is looked up in a DNS cache (see DnsCache.py) rather than on every
+ping, and the ping is sent straight to that address.  Redirects are followed
+by the probe client itself, so that each hop is looked up in the same way
+and sent its own host name.
+
+Servers may also be given a probe spec (see ProbeTypes.py), to be pinged with
+a TCP connection, a TLS handshake, or an HTTP request with its own method,
+path, expected status codes, and expected body.  Those pings go through the
+same workers (and the same DNS cache and timeouts) as every other ping.
+
+Each ping comes back as a probe result, which holds on to how long the server
+took to respond, the HTTP status code it responded with, and the reason the
+ping failed (if it did) along with whether the server is 'Online' or 'Offline'.
+The reasons a ping can fail are:
+    dns = we couldn't look up the server's address
+    timeout = the server didn't connect or respond in time
+    connection_error = we couldn't connect to the server at all
+    http_error = the server responded, but not with a success code
+    (or, for an http probe, not with one of the codes it expects)
+    body_mismatch = the server responded, but without the text an http
+    probe expects
+    tls_error = a tls probe couldn't complete the handshake, or the server's
+    certificate expires too soon
+    error = anything else that went wrong
+
+
+Methods:
+--------
+sendPing(server name, probe client)
+    - pings a single server (using an HTTP request) and returns
+    either 'Online' or 'Offline'
+    - uses the shared default probe client unless one is given
+
+ProbeClient.probe(server name, probe spec, deadline)
+    - pings a single server using the client's pooled connections,
+    with the client's HTTP method (GET or HEAD) and connect/read timeouts
+    - or, if given a probe spec, pings it as the spec says (see ProbeTypes.py)
+    - gives up once the client's probe deadline (or the given deadline,
+    if that is sooner) has passed
+    - returns the probe result
+
+ProbeClient.timeouts()
+    - returns the connect and read timeouts for the next connection attempt
+    or read of the ping being sent in this thread, cut short so that the ping
+    doesn't run past its deadline
+
+ProbeClient.ping(server name)
+    - same as probe(), but returns only 'Online' or 'Offline'
+
+normalizeTarget(server name)
+    - returns the target that a server name points at, so that names that
+    point at the same target share their pings
+
+ProbeEngine.pingServer(server name, max age, probe spec, deadline)
+    - pings a single server right away, in the calling thread,
+    and returns the probe result (or the result of a ping to the same target
+    that is already in flight, or that came back within the max age)
+
+ProbeEngine.pingServers(list of server names, max age, probe specs, deadline)
+    - pings all of the given servers in parallel, using at most
+    max_in_flight worker threads at once
+    - blocks until every ping has completed (or timed out), or until the
+    deadline has passed
+    - returns a dictionary of {server name: probe result}, leaving out any
+    servers that weren't pinged (which should be pinged again later)
+"""
+# imports
+import Queue
+import collections
+import socket
+import threading
+import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from PingScheduler import monotonicTime
+from DnsCache import DnsError, default_dns_cache, splitHostPort
+from Instrumentation import probes, probes_in_flight, probes_reused, probes_deferred
+
+# global for the maximum number of pings we'll allow in flight at once
+default_max_in_flight = 50
+# globals for how long to wait on any single ping, in seconds
+# (to establish the connection, and then for the server to respond)
+default_connect_timeout = 3
+default_read_timeout = 5
+# global for how long any single ping may take in all, in seconds
+# (across every address of the server, and every redirect it sends us along)
+# which is also how long a batch of pings will wait for its pings to come back
+default_probe_deadline = default_connect_timeout + default_read_timeout
+# global for the number of servers we'll keep open connections to
+default_pool_size = 1000
+# global for the number of open connections we'll keep to any one server
+default_connections_per_host = 2
+# global for the HTTP method used to ping, either 'GET' or 'HEAD'
+default_probe_method = 'GET'
+# global for how long a ping's result is handed out again to other pings
+# of the same target, in seconds
+default_cache_ttl = 0.5
+# global for the most pings we'll have in flight to any one host at once
+# (or None for no limit)
+default_max_per_host = 4
+# global for the ways a ping can fail that mean its host isn't answering
+# (so that the rest of the pings waiting on that host are put off)
+unanswered_failures = ('timeout', 'connection_error')
+# global for whether www.example.com is taken to be the same target
+# as example.com
+merge_www_aliases = False
+
+
+def normalizeTarget(server):
+    """
+    Returns the target that the given server name points at: the host
+    (lowercased, without the default port, a trailing dot, or, if
+    merge_www_aliases is set, a leading 'www.') followed by the path
+    (without any trailing slashes), e.g.
+        'WWW.Example.com.:80/Health/' -> 'www.example.com/Health'
+    """
+    host, slash, path = server.strip().partition('/')
+    host = host.lower()
+    if host.endswith(':80'):
+        host = host[:-3]
+    host = host.rstrip('.')
+    if merge_www_aliases and host.startswith('www.'):
+        host = host[4:]
+    path = path.rstrip('/')
+    if path:
+        return host + '/' + path
+    return host
+
+
+def probeKey(server, spec = None):
+    """
+    Returns the key that pings of the given server (with the given ProbeSpec)
+    are shared by, i.e., its normalized target, along with the spec if it
+    isn't the default
+    """
+    if spec is None:
+        return normalizeTarget(server)
+    return normalizeTarget(server) + ' ' + spec.key
+
+
+def splitServer(server):
+    """
+    Splits a server name up into a tuple of the host name, the port
+    (including its leading ':', or '' if there isn't one), and the path
+    (including its leading '/', or '' if there isn't one)
+    """
+    host, slash, path = server.partition('/')
+    host_name, port = splitHostPort(host)
+    return host_name, port, slash + path
+
+
+class ProbeResult(object):
+
+    __slots__ = ('status', 'latency', 'status_code', 'failure', 'cert_expires')
+
+    def __init__(self, status, latency = None, status_code = None,
+                 failure = None, cert_expires = None):
+        """
+        Initialization function
+
+        :param status = 'Online' or 'Offline'
+        :param latency = how long the server took to respond, in seconds
+        (None if it didn't respond)
+        :param status_code = the HTTP status code the server responded with
+        (None if it didn't respond)
+        :param failure = why the ping failed, or None if it didn't
+        :param cert_expires = when the server's TLS certificate expires,
+        in seconds since the epoch (None unless it was a TLS probe)
+        """
+        self.status = status
+        self.latency = latency
+        self.status_code = status_code
+        self.failure = failure
+        self.cert_expires = cert_expires
+
+
+class ProbeClient:
+
+    def __init__(self, pool_size = default_pool_size,
+                 connections_per_host = default_connections_per_host,
+                 probe_method = default_probe_method,
+                 connect_timeout = default_connect_timeout,
+                 read_timeout = default_read_timeout, dns_cache = None,
+                 probe_deadline = default_probe_deadline):
+        """
+        Initialization function
+
+        :param pool_size = number of servers to keep open connections to
+        (once exceeded, the least recently pinged server's connections
+        are closed)
+        :param connections_per_host = number of open connections to keep
+        to any one server
+        :param probe_method = HTTP method to ping with, 'GET' or 'HEAD'
+        (HEAD saves the server from sending us a response body)
+        :param connect_timeout = number of seconds to wait on a connection
+        :param read_timeout = number of seconds to wait on a response
+        once connected
+        :param dns_cache = the DNS cache to look up addresses in
+        (if not given, we'll use the shared default cache)
+        :param probe_deadline = number of seconds any one ping may take in all
+        """
+        probe_method = probe_method.upper()
+        if probe_method not in ('GET', 'HEAD'):
+            raise ValueError('Probe method must be either GET or HEAD')
+        self.probe_method = probe_method
+        self.timeout = (connect_timeout, read_timeout)
+        self.probe_deadline = probe_deadline
+        # the deadline of the ping each thread is sending (see timeouts())
+        self.deadlines = threading.local()
+        if dns_cache is None:
+            dns_cache = default_dns_cache
+        self.dns_cache = dns_cache
+
+        # a single session is shared by every thread that pings,
+        # so that they all share the same connection pools
+        # the adapter keeps a pool of keep-alive connections for each server
+        adapter = HTTPAdapter(pool_connections = pool_size,
+                              pool_maxsize = connections_per_host)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def probe(self, server, spec = None, deadline = None):
+        """
+        Pings a given server (using HTTP, unless given a probe spec)
+
+        :param server = name of the server to ping
+        :param spec = the ProbeSpec to ping the server with (see ProbeTypes.py),
+        or None for the default HTTP ping
+        :param deadline = the (monotonic) time by which the ping has to be done,
+        if that is sooner than the client's probe deadline from now
+
+        Returns a ProbeResult
+        """
+        probe_deadline = monotonicTime() + self.probe_deadline
+        if deadline is None or deadline > probe_deadline:
+            deadline = probe_deadline
+        self.deadlines.at = deadline
+        try:
+            if spec is not None:
+                return spec.probe(self, server)
+            return self.probeHttp(server)
+        finally:
+            self.deadlines.at = None
+
+
+    def timeouts(self):
+        """
+        Returns a tuple of the (connect, read) timeouts for the next connection
+        attempt or read of the ping being sent in this thread, cut short so
+        that the ping doesn't run past its deadline
+
+        Raises a socket.timeout if the deadline has already passed
+        """
+        deadline = getattr(self.deadlines, 'at', None)
+        if deadline is None:
+            return self.timeout
+        remaining = deadline - monotonicTime()
+        if remaining <= 0:
+            raise socket.timeout('Ping deadline passed')
+        return min(self.timeout[0], remaining), min(self.timeout[1], remaining)
+
+
+    def probeHttp(self, server, method = None, path = None, scheme = 'http',
+                  expect = None, body = None):
+        """
+        Pings a given server using HTTP
+
+        :param server = name of the server to ping
+        :param method = HTTP method to ping with (if not given, the client's)
+        :param path = path to request, in place of the one in the server name
+        :param scheme = 'http' or 'https'
+        :param expect = list of the status codes that mean the server is
+        online (if not given, any code below 400)
+        :param body = text that the response must contain for the server
+        to be online
+
+        Returns a ProbeResult
+        """
+        host, slash, server_path = server.partition('/')
+        if path is None:
+            path = slash + server_path
+        url = '{0}://{1}{2}'.format(scheme, host, path)
+        method = method or self.probe_method
+        # send the ping via HTTP, timing how long it takes
+        # note that the response body is read in full before this returns,
+        # which frees up the connection to be reused by the next ping
+        start_time = monotonicTime()
+        try:
+            # we follow any redirects ourselves, so that each one is looked
+            # up (and named in the Host header) in its own right
+            for redirect_count in xrange(self.session.max_redirects + 1):
+                health = self._send(method, url)
+                if not health.is_redirect:
+                    break
+                url = urlparse.urljoin(url, health.headers['location'])
+                method = redirectMethod(method, health.status_code)
+            else:
+                return ProbeResult('Offline', failure = 'error')
+        except DnsError:
+            return ProbeResult('Offline', failure = 'dns')
+        except (requests.Timeout, socket.timeout):
+            return ProbeResult('Offline', failure = 'timeout')
+        except requests.ConnectionError:
+            return ProbeResult('Offline', failure = 'connection_error')
+        except requests.RequestException:
+            return ProbeResult('Offline', failure = 'error')
+        latency = monotonicTime() - start_time
+
+        # depending on the health of the system, respond accordingly
+        if expect is None:
+            healthy = health.ok
+        else:
+            healthy = health.status_code in expect
+        if not healthy:
+            return ProbeResult('Offline', latency, health.status_code,
+                               'http_error')
+        if body is not None and body.encode('utf-8') not in health.content:
+            return ProbeResult('Offline', latency, health.status_code,
+                               'body_mismatch')
+        return ProbeResult('Online', latency, health.status_code)
+
+
+    def _send(self, method, url):
+        """
+        Sends a single request for the given url (without following any
+        redirect it is answered with)
+
+        For plain HTTP, the host's addresses are looked up in the DNS cache,
+        and the request is sent straight to each of them in turn (passing
+        the host name along in the Host header) until one of them can be
+        connected to.  For HTTPS, the certificate is checked against the host
+        name in the url, so we leave looking it up to requests
+
+        Returns the response, or raises a DnsError if the host's addresses
+        can't be looked up, a socket.timeout if the ping's deadline passes
+        (or whatever requests raises)
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme != 'http':
+            return self.session.request(method, url, timeout = self.timeouts(),
+                                        allow_redirects = False)
+        host_name, port = splitHostPort(parts.netloc)
+        addresses = self.dns_cache.resolveAll(host_name)
+        for address in addresses:
+            host = address
+            if ':' in address:
+                host = '[{0}]'.format(address)
+            try:
+                return self.session.request(method, urlparse.urlunsplit(
+                    ('http', host + port, parts.path or '/', parts.query, '')),
+                                            headers = {'Host': parts.netloc},
+                                            timeout = self.timeouts(),
+                                            allow_redirects = False)
+            except requests.ConnectionError:
+                # (including a connect timeout) try the host's next address,
+                # if it has another
+                if address == addresses[-1]:
+                    raise
+                self.dns_cache.markUnreachable(host_name, address)
+
+
+    def ping(self, server):
+        """
+        Pings a given server (using HTTP), returns the status of the server
+
+        :param server = name of the server to ping
+
+        Returns either 'Online' or 'Offline'
+        """
+        return self.probe(server).status
+
+
+# the client used for any pings that aren't given one explicitly
+default_probe_client = ProbeClient()
+
+
+def redirectMethod(method, status_code):
+    """
+    Returns the HTTP method to follow a redirect with, as browsers
+    (and requests) do: a 302 or 303 is followed with a GET (unless it was
+    a HEAD), as is a 301 in answer to a POST
+    """
+    if status_code in (302, 303) and method != 'HEAD':
+        return 'GET'
+    if status_code == 301 and method == 'POST':
+        return 'GET'
+    return method
+
+
+def sendPing(server, probe_client = None):
+    """
+    Pings a given server (using HTTP), returns the status of the server
+
+    :param server = name of the server to ping
+    :param probe_client = the probe client to send the ping with
+    (if not given, we'll use the shared default client)
+
+    Returns either 'Online' or 'Offline'
+    """
+    if probe_client is None:
+        probe_client = default_probe_client
+    return probe_client.ping(server)
+
+
+class PendingProbe(object):
+
+    __slots__ = ('done', 'result')
+
+    def __init__(self):
+        """
+        A ping that is in flight, which other pings of the same target
+        can wait on rather than sending their own
+        """
+        self.done = threading.Event()
+        self.result = None
+
+
+class ProbeBatch(object):
+
+    __slots__ = ('deadline', 'cutoff', 'results', 'started', 'closed')
+
+    def __init__(self, deadline, cutoff):
+        """
+        A batch of pings sent out by pingServers(), which the workers hand
+        the results back to
+
+        :param deadline = the (monotonic) time by which the batch has to be
+        done
+        :param cutoff = the (monotonic) time after which no more of its pings
+        are sent, since they wouldn't have long enough left to come back
+        """
+        self.deadline = deadline
+        self.cutoff = cutoff
+        # every batch gets its own result queue, so that batches
+        # can never pick up each other's results
+        self.results = Queue.Queue()
+        # the servers whose pings have been sent, and whether the batch
+        # has stopped waiting (both only touched while holding the lock)
+        self.started = set()
+        self.closed = False
+
+
+class ProbeEngine:
+
+    def __init__(self, max_in_flight = default_max_in_flight,
+                 probe_client = None, cache_ttl = default_cache_ttl,
+                 max_per_host = default_max_per_host):
+        """
+        Initialization function
+
+        :param max_in_flight = number of worker threads, i.e., the most pings
+        that will ever be waiting on a response at the same time
+        :param probe_client = the probe client to send the pings with
+        (if not given, we'll use the shared default client)
+        :param cache_ttl = how long a ping's result is handed out again
+        to other pings of the same target, in seconds (0 to never)
+        :param max_per_host = most pings the workers will have in flight
+        to any one host at once (or None for no limit)
+        """
+        self.max_in_flight = max_in_flight
+        if probe_client is None:
+            probe_client = default_probe_client
+        self.probe_client = probe_client
+        self.cache_ttl = cache_ttl
+        self.max_per_host = max_per_host
+        # all of the pings waiting for a worker will sit in this queue
+        # each entry is a tuple of (server name, ProbeSpec, max age of
+        # a cached result, ProbeBatch to hand the result back to)
+        self.probe_queue = Queue.Queue()
+        # held (briefly) while touching anything below
+        self.lock = threading.Lock()
+        # {probe key: (time the result came back, ProbeResult)}, oldest first
+        self.cache = collections.OrderedDict()
+        # {probe key: PendingProbe} for every ping in flight
+        self.in_flight = {}
+        # {host: number of pings in flight}, for the workers' pings only,
+        # and {host: deque of pings left waiting for that host}
+        self.host_active = {}
+        self.host_waiting = {}
+
+        # start up the workers
+        # these are daemon threads, so they won't keep the process alive
+        self.workers = []
+        for i in xrange(self.max_in_flight):
+            worker = threading.Thread(target = self._probeWorker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+
+    def _probeWorker(self):
+        """
+        Loop run by each of the worker threads
+
+        Pulls a server off of the probe queue, pings it, and puts the
+        result on the queue belonging to the batch that asked for it
+        
+        If the server's host already has as many pings in flight as we allow,
+        the ping is left for the next worker to finish a ping to that host
+        (unless that ping finds the host isn't answering)
+        
+        Pings of a batch that has stopped waiting are dropped, as are pings
+        that would be sent too close to their batch's deadline, and pings
+        left waiting on a host that isn't answering (the batch leaves all of
+        them out of its results)
+        """
+        while True:
+            probe = self.probe_queue.get()
+            host = self._limitKey(probe[0])
+            with self.lock:
+                if not self._canStart(probe[3]):
+                    probe[3].results.put((probe[0], None))
+                    continue
+                active = self.host_active.get(host, 0)
+                if self.max_per_host is not None and active >= self.max_per_host:
+                    self.host_waiting.setdefault(host, collections.deque()).append(probe)
+                    probes_deferred.inc()
+                    continue
+                self.host_active[host] = active + 1
+                probe[3].started.add(probe[0])
+            # keep pinging this host for as long as there are pings waiting
+            # on it (and it is answering), and then give up its slot
+            while probe is not None:
+                server, spec, max_age, batch = probe
+                result = self.pingServer(server, max_age, spec, batch.deadline)
+                batch.results.put((server, result))
+                with self.lock:
+                    waiting = self.host_waiting.get(host)
+                    # (skipping over any pings whose batches are done with)
+                    probe = None
+                    while waiting and probe is None:
+                        probe = waiting.popleft()
+                        if result.failure in unanswered_failures or \
+                           not self._canStart(probe[3]):
+                            probe[3].results.put((probe[0], None))
+                            probe = None
+                        else:
+                            probe[3].started.add(probe[0])
+                    if waiting is not None and not waiting:
+                        del self.host_waiting[host]
+                    if probe is None:
+                        self.host_active[host] -= 1
+                        if not self.host_active[host]:
+                            del self.host_active[host]
+
+
+    def _canStart(self, batch):
+        """
+        Returns whether a worker should go ahead with a ping of the given
+        batch, i.e., the batch is still waiting, and its cutoff hasn't passed
+        
+        Only called while holding the lock
+        """
+        return not batch.closed and monotonicTime() <= batch.cutoff
+
+
+    def _limitKey(self, server):
+        """
+        Returns what the per-host limit of the given server is kept by:
+        its address and port, if its address has already been looked up,
+        or else its host (and port)
+        """
+        host_name, port, path = splitServer(normalizeTarget(server))
+        address = self.probe_client.dns_cache.peek(host_name)
+        if address is None:
+            return host_name + port
+        return address + port
+
+
+    def pingServer(self, server, max_age = None, spec = None, deadline = None):
+        """
+        Pings a single server right away, in the calling thread
+        
+        If the same target is already being pinged (with the same probe spec),
+        we'll wait for that ping's result instead, and if it was pinged within
+        the max age (or the cache TTL, whichever is shorter), we'll hand back
+        that ping's result straight away
+
+        :param server = name of the server to ping
+        :param max_age = oldest cached result to hand back, in seconds
+        (if not given, the cache TTL)
+        :param spec = the ProbeSpec to ping the server with (see ProbeTypes.py),
+        or None for the default HTTP ping
+        :param deadline = the (monotonic) time by which the ping has to be done,
+        if that is sooner than the probe client's probe deadline from now
+
+        Returns a ProbeResult
+        """
+        target = probeKey(server, spec)
+        if max_age is None or max_age > self.cache_ttl:
+            max_age = self.cache_ttl
+        with self.lock:
+            cached = self.cache.get(target)
+            if cached is not None and monotonicTime() - cached[0] <= max_age:
+                probes_reused.inc(labels = ('cached',))
+                return cached[1]
+            pending = self.in_flight.get(target)
+            if pending is None:
+                pending = self.in_flight[target] = PendingProbe()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            probes_reused.inc(labels = ('coalesced',))
+            # (the ping we're waiting on may have a later deadline than ours)
+            if deadline is None:
+                pending.done.wait()
+            elif not pending.done.wait(max(deadline - monotonicTime(), 0)):
+                return ProbeResult('Offline', failure = 'timeout')
+            return pending.result
+
+        result = self._probe(server, spec, deadline)
+        now = monotonicTime()
+        with self.lock:
+            del self.in_flight[target]
+            if self.cache_ttl > 0:
+                self.cache.pop(target, None)
+                self.cache[target] = (now, result)
+                # the oldest results are at the front
+                while self.cache:
+                    oldest_target, (result_time, oldest) = next(self.cache.iteritems())
+                    if now - result_time <= self.cache_ttl:
+                        break
+                    del self.cache[oldest_target]
+        pending.result = result
+        pending.done.set()
+        return result
+
+
+    def _probe(self, server, spec, deadline = None):
+        """
+        Sends a single ping (with the given deadline, if any),
+        counting it in the metrics
+
+        Returns a ProbeResult
+        """
+        probes_in_flight.inc()
+        # make sure a misbehaving ping can never kill a worker
+        # (or leave a batch waiting on a result that will never come)
+        try:
+            result = self.probe_client.probe(server, spec, deadline)
+        except Exception:
+            result = ProbeResult('Offline', failure = 'error')
+        finally:
+            probes_in_flight.inc(-1)
+        probes.inc(labels = (result.failure or 'online',))
+        return result
+
+
+    def pingServers(self, servers, max_age = None, specs = None,
+                    deadline = None):
+        """
+        Pings every one of the given servers in parallel and waits for
+        all of the results to come back (or for the deadline to pass)
+        
+        Servers that point at the same target (with the same probe spec)
+        share a single ping
+        
+        Any ping that was sent but isn't back by the deadline counts as timed
+        out, and any that hadn't been sent yet (which is only the case if
+        there were more pings than the workers could get through in time) is
+        left out of the results, so that it can be sent with a later batch
+        (as are any that would be sent with less than the connect timeout,
+        or half of the deadline, left to go, and any left waiting on a host
+        that isn't answering)
+
+        :param servers = list of server names to ping
+        :param max_age = oldest cached result to hand back, in seconds
+        (if not given, the cache TTL)
+        :param specs = dictionary of {server name: ProbeSpec} for any of the
+        servers that aren't given the default HTTP ping
+        :param deadline = most seconds to wait for the results
+        (if not given, the probe client's probe deadline)
+
+        Returns a dictionary of {server name: ProbeResult}
+        """
+        if specs is None:
+            specs = {}
+        if deadline is None:
+            deadline = self.probe_client.probe_deadline
+        # {the server name we'll ping: every server name for its target}
+        aliases = {}
+        first_names = {}
+        for server in servers:
+            target = probeKey(server, specs.get(server))
+            if target not in first_names:
+                first_names[target] = server
+                aliases[server] = []
+            aliases[first_names[target]].append(server)
+            
+        batch_deadline = monotonicTime() + deadline
+        batch = ProbeBatch(batch_deadline, batch_deadline -
+                           min(self.probe_client.timeout[0], deadline / 2.0))
+        for server in aliases:
+            self.probe_queue.put((server, specs.get(server), max_age, batch))
+
+        # gather up the results as they come in, until the deadline
+        results = {}
+        answered = set()
+        while len(answered) < len(aliases):
+            remaining = batch.deadline - monotonicTime()
+            if remaining <= 0:
+                break
+            try:
+                server, result = batch.results.get(timeout = remaining)
+            except Queue.Empty:
+                break
+            answered.add(server)
+            # (no result if the ping was dropped)
+            if result is None:
+                continue
+            for name in aliases[server]:
+                results[name] = result
+                
+        if len(answered) < len(aliases):
+            # stop sending the rest of the batch
+            with self.lock:
+                batch.closed = True
+                started = set(batch.started)
+            # (taking any results that made it back in the meantime)
+            while True:
+                try:
+                    server, result = batch.results.get_nowait()
+                except Queue.Empty:
+                    break
+                answered.add(server)
+                if result is None:
+                    continue
+                for name in aliases[server]:
+                    results[name] = result
+            timed_out = ProbeResult('Offline', failure = 'timeout')
+            for server in started - answered:
+                for name in aliases[server]:
+                    results[name] = timed_out
+
+        return results
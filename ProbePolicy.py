@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Probe policy definition
+
+These are the classes that we will use to decide when each server is next
+pinged, rather than always pinging it exactly one interval after its last
+ping:
+    - servers that stay offline are backed off exponentially (each ping
+    waits twice as long as the last, up to a limit), with some random jitter
+    so that servers that went offline together don't stay in step, since
+    pings to dead servers tend to tie up a connection until they time out
+    - when a ping disagrees with a server's status, the status isn't changed
+    straight away; instead, the server is pinged again shortly after to
+    confirm it, so that a single dropped ping (or a server flapping between
+    online and offline) doesn't flip its status back and forth
+    - each server's pings are spread out within its interval by a phase
+    that comes from its name, so that servers added together with the same
+    interval aren't all pinged on the same tick forever after
+
+Separately, a probe budget caps the number of pings sent out per second
+across every server, so that a large batch of servers coming due at once
+is spread out over the following ticks instead of going out all together.
+The budget is a token bucket: tokens are added at the given rate (up to
+a second's worth, or a single token for a rate below one ping per second),
+and each ping spends one.
+
+
+Methods:
+--------
+ProbePolicy.update(server record, status seen by the ping)
+    - updates the server's status (once confirmed) and the counts that the
+    policy keeps on the record, and returns the delay until the next ping
+
+ProbeBudget.available(current time)
+    - returns the number of pings that can be sent right now
+
+ProbeBudget.spend(number of pings)
+    - spends part of the budget
+
+ProbeBudget.secondsUntilAvailable(current time)
+    - returns how long until at least one more ping can be sent
+"""
+# imports
+import random
+import zlib
+
+# global for how much longer each ping to an offline server waits
+# than the last one
+default_backoff_multiplier = 2
+# global for the longest we'll back off to, in seconds
+# (unless the server's own interval is longer than that)
+default_max_backoff = 300
+# global for how far the backoff delays are randomly stretched or shrunk,
+# as a fraction of the delay
+default_jitter = 0.2
+# global for how many pings in a row must agree before a status changes
+# (counting the ping that first saw the change)
+default_confirmations = 2
+# global for the longest we'll wait before pinging a server again to confirm
+# a change in its status, in seconds
+default_confirm_delay = 1
+
+
+def phaseOffset(server_name, interval):
+    """
+    Returns the offset of the given server's pings within its interval,
+    which is picked by its name so that it is the same from one run to the
+    next, and so that servers with the same interval are spread out evenly
+    """
+    if isinstance(server_name, unicode):
+        server_name = server_name.encode('utf-8')
+    return interval * (zlib.crc32(server_name) & 0xffffffff) / float(2 ** 32)
+
+
+class ProbePolicy:
+
+    def __init__(self, backoff_multiplier = default_backoff_multiplier,
+                 max_backoff = default_max_backoff, jitter = default_jitter,
+                 confirmations = default_confirmations,
+                 confirm_delay = default_confirm_delay):
+        """
+        Initialization function
+
+        :param backoff_multiplier = how much longer each ping to an offline
+        server waits than the last one (1 to never back off)
+        :param max_backoff = longest to back off to, in seconds
+        :param jitter = how far to randomly stretch or shrink the backoff
+        delays, as a fraction of the delay
+        :param confirmations = how many pings in a row must agree before
+        a status changes (1 to change it straight away)
+        :param confirm_delay = longest to wait before pinging a server again
+        to confirm a change in its status, in seconds
+        """
+        self.backoff_multiplier = backoff_multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.confirmations = confirmations
+        self.confirm_delay = confirm_delay
+
+
+    def update(self, record, status):
+        """
+        Applies the status seen by a ping to a server's record
+
+        :param record = the server's record (see ServerRecord.py)
+        :param status = the status the ping found the server in
+        ('Online' or 'Offline')
+
+        Returns a tuple of (whether the server's status changed,
+        seconds until the server should next be pinged)
+        """
+        # keep count of the failed pings in a row, for backing off
+        if status == 'Offline':
+            record.failures += 1
+        else:
+            record.failures = 0
+
+        first_ping = record.status == 'Unknown'
+        status_changed = False
+        if status == record.status:
+            # nothing to confirm
+            record.unconfirmed = 0
+        elif first_ping or record.unconfirmed + 1 >= self.confirmations:
+            # the first ping of a server doesn't need confirming, since we
+            # didn't know anything about it before
+            record.status = status
+            record.unconfirmed = 0
+            status_changed = True
+        else:
+            # ping the server again shortly to confirm the change
+            record.unconfirmed += 1
+            return False, min(record.interval, self.confirm_delay)
+
+        delay = record.interval
+        if record.status == 'Offline' and record.failures > 1:
+            delay = self.backoff(record.interval, record.failures - 1)
+        if first_ping:
+            # settle the server into its own phase within its interval
+            delay += phaseOffset(record.name, record.interval)
+        return status_changed, delay
+
+
+    def backoff(self, interval, steps):
+        """
+        Returns the delay before the next ping to a server that has been
+        backed off the given number of times
+
+        :param interval = the server's ping interval
+        :param steps = the number of times to back off
+        """
+        limit = max(interval, self.max_backoff)
+        # (capping the exponent keeps the number from getting silly
+        # for servers that have been offline for a long time)
+        delay = interval * self.backoff_multiplier ** min(steps, 64)
+        delay = min(delay, limit)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(delay, interval)
+
+
+class ProbeBudget:
+
+    def __init__(self, rate):
+        """
+        Initialization function
+
+        :param rate = most pings to send out per second
+        """
+        self.rate = float(rate)
+        # the bucket holds a second's worth of pings, but always at least
+        # one (or a rate below one a second would never add up to a ping)
+        self.capacity = max(self.rate, 1)
+        # and we start out with a full bucket
+        self.tokens = self.capacity
+        self.last_time = None
+
+
+    def _refill(self, now):
+        """
+        Adds the tokens earned since we last looked, up to a full bucket
+        """
+        if self.last_time is not None:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        return
+
+
+    def available(self, now):
+        """
+        Returns the number of pings that can be sent out right now
+
+        :param now = current monotonic time
+        """
+        self._refill(now)
+        return int(self.tokens)
+
+
+    def spend(self, count):
+        """
+        Spends part of the budget on the given number of pings
+        """
+        self.tokens -= count
+        return
+
+
+    def refund(self, count):
+        """
+        Gives back the part of the budget spent on the given number of pings
+        that weren't sent after all
+        """
+        self.tokens = min(self.capacity, self.tokens + count)
+        return
+
+
+    def secondsUntilAvailable(self, now):
+        """
+        Returns the number of seconds until at least one more ping
+        can be sent out (zero if one can be sent out now)
+
+        :param now = current monotonic time
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Probe types definition
+
+These are the classes that we will use to ping servers in ways other than
+the plain HTTP request that every server gets by default.  Each server may be
+given a probe spec, a JSON object naming the type of probe and its options:
+
+    {"type": "tcp", "port": 5432}
+        - opens a TCP connection to the server (to the given port, or else
+        the port in the server name, or 80), and closes it straight away
+        - much cheaper than an HTTP request, for servers that we only need
+        to know are accepting connections
+
+    {"type": "tls", "port": 443, "min_days": 14, "verify": true}
+        - opens a TCP connection and completes a TLS handshake, checking the
+        server's certificate (unless verify is false)
+        - the certificate's expiry is kept in the server's stats, and if
+        min_days is given, a certificate expiring within that many days
+        counts as a failed ping (this needs the certificate to be verified,
+        since Python only hands back the details of a verified certificate)
+
+    {"type": "http", "method": "GET", "path": "/health", "scheme": "https",
+     "expect": [200, 204], "body": "OK"}
+        - sends an HTTP request, as by default, but with the given method,
+        path (in place of the path in the server name), and scheme
+        - the server is only online if it responds with one of the expected
+        status codes (or with any code below 400, if none are given) and,
+        if a body is given, the response contains it (a probe with a body
+        is sent with GET, unless another method is given)
+
+Every option may be left out.  Probes of every type are sent by the probe
+engine's workers using the probe client's DNS cache and timeouts (see
+ProbeEngine.py), just like the default pings.
+
+Every type of probe is kept in a registry by its name, so new types can be
+added with registerProbeType().  A probe type is a class with two static
+methods:
+    parseOptions(dictionary of options) -> dictionary of validated options
+    (raising a ValueError for anything it can't use)
+    probe(probe client, server name, options) -> ProbeResult
+
+Probe specs are parsed into ProbeSpec objects, and every server with the same
+spec shares the same object, so that a spec only costs memory once no matter
+how many servers use it.
+
+
+Methods:
+--------
+registerProbeType(name, probe type)
+    - adds a type of probe to the registry
+
+parseProbeSpec(spec)
+    - validates a probe spec (a dictionary, or the same as a JSON string)
+    and returns its ProbeSpec
+
+ProbeSpec.isDefault()
+    - whether the spec is just the default HTTP ping
+"""
+# imports
+import json
+import socket
+import ssl
+import time
+from PingScheduler import monotonicTime
+from ProbeEngine import ProbeResult, splitServer
+from DnsCache import DnsError
+
+# global for the registry of probe types, by name
+probe_types = {}
+# global for every probe spec parsed so far, by its key
+# (so that servers with the same spec share a single ProbeSpec)
+known_specs = {}
+# global for the HTTP methods an http probe may use
+http_probe_methods = ('GET', 'HEAD', 'POST', 'OPTIONS')
+
+
+def registerProbeType(name, probe_type):
+    """
+    Adds a type of probe to the registry, so that probe specs can name it
+
+    :param name = the name of the type, as given in probe specs
+    :param probe_type = the class implementing the type
+    """
+    probe_types[name] = probe_type
+    return
+
+
+class ProbeSpec(object):
+
+    __slots__ = ('type_name', 'probe_type', 'options', 'key')
+
+    def __init__(self, type_name, options):
+        """
+        A parsed probe spec (use parseProbeSpec() rather than creating these
+        directly, so that identical specs are shared)
+
+        :param type_name = name of the probe type
+        :param options = dictionary of the validated options
+        """
+        self.type_name = type_name
+        self.probe_type = probe_types[type_name]
+        self.options = options
+        # the spec written out as compact JSON, which is how it is kept on
+        # disk and how pings with the same spec are matched up
+        described = dict(options, type = type_name)
+        self.key = json.dumps(described, sort_keys = True,
+                              separators = (',', ':'))
+
+
+    def __reduce__(self):
+        # passed between processes by key, so that it is shared again
+        # once it gets there
+        return (parseProbeSpec, (self.key,))
+
+
+    def isDefault(self):
+        """
+        Returns whether this spec is just the default HTTP ping
+        """
+        return self.type_name == 'http' and not self.options
+
+
+    def describe(self):
+        """
+        Returns the spec as a dictionary, suitable for returning as JSON
+        """
+        return dict(self.options, type = self.type_name)
+
+
+    def probe(self, probe_client, server):
+        """
+        Pings the given server with this spec
+
+        Returns a ProbeResult
+        """
+        return self.probe_type.probe(probe_client, server, self.options)
+
+
+def parseProbeSpec(spec):
+    """
+    Validates a probe spec and returns its ProbeSpec
+
+    :param spec = a dictionary with a 'type' and any options for that type,
+    or the same as a JSON string
+
+    Raises a ValueError if the spec can't be used
+    """
+    if isinstance(spec, basestring):
+        known = known_specs.get(spec)
+        if known is not None:
+            return known
+        try:
+            spec = json.loads(spec)
+        except ValueError:
+            raise ValueError('Probe spec must be a JSON object')
+    if not isinstance(spec, dict):
+        raise ValueError('Probe spec must be a JSON object')
+    options = dict(spec)
+    type_name = options.pop('type', None)
+    if type_name not in probe_types:
+        raise ValueError('Probe type must be one of: {0}'.format(
+            ', '.join(sorted(probe_types))))
+    parsed = ProbeSpec(type_name,
+                       probe_types[type_name].parseOptions(options))
+    # hand back the spec we already have, if it's the same one
+    return known_specs.setdefault(parsed.key, parsed)
+
+
+def checkOptions(options, allowed):
+    """
+    Makes sure that the given options are all ones we know about
+    """
+    unknown = set(options) - set(allowed)
+    if unknown:
+        raise ValueError('Unknown probe options: {0}'.format(
+            ', '.join(sorted(unknown))))
+    return
+
+
+def parsePort(value):
+    """
+    Makes sure that the given value is a port number, and returns it
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, long)) or \
+       not 0 < value < 65536:
+        raise ValueError('Probe port must be a number from 1 to 65535')
+    return value
+
+
+def openConnection(probe_client, server, port):
+    """
+    Opens a TCP connection to a server, looking its addresses up in the
+    probe client's DNS cache and trying each of them in turn (giving up on
+    each after the client's connect timeout, and on all of them once the
+    ping's deadline has passed)
+
+    :param probe_client = the ProbeClient (see ProbeEngine.py)
+    :param server = name of the server
+    :param port = the port to connect to (or None for the port in the
+    server name)
+
+    Returns a tuple of (connected socket, host name), or raises a DnsError
+    or a socket.error
+    """
+    host_name, server_port, path = splitServer(server)
+    if port is None:
+        port = int(server_port[1:])
+    addresses = probe_client.dns_cache.resolveAll(host_name)
+    for address in addresses:
+        # (raising a socket.timeout if the deadline has passed already)
+        connect_timeout = probe_client.timeouts()[0]
+        try:
+            connection = socket.create_connection((address, port),
+                                                  connect_timeout)
+        except socket.error:
+            # try the host's next address, if it has another
+            if address == addresses[-1]:
+                raise
+            probe_client.dns_cache.markUnreachable(host_name, address)
+            continue
+        return connection, host_name
+
+
+def failedConnection(error):
+    """
+    Returns the ProbeResult of a connection that couldn't be opened
+    """
+    if isinstance(error, DnsError):
+        return ProbeResult('Offline', failure = 'dns')
+    if isinstance(error, socket.timeout):
+        return ProbeResult('Offline', failure = 'timeout')
+    return ProbeResult('Offline', failure = 'connection_error')
+
+
+class TcpProbe:
+
+    @staticmethod
+    def parseOptions(options):
+        checkOptions(options, ('port',))
+        if 'port' in options:
+            options['port'] = parsePort(options['port'])
+        return options
+
+
+    @staticmethod
+    def probe(probe_client, server, options):
+        """
+        Opens (and then closes) a TCP connection to the server
+        """
+        port = options.get('port')
+        if port is None and not splitServer(server)[1]:
+            port = 80
+        start_time = monotonicTime()
+        try:
+            connection, host_name = openConnection(probe_client, server, port)
+        except (DnsError, socket.error, ValueError) as error:
+            return failedConnection(error)
+        latency = monotonicTime() - start_time
+        connection.close()
+        return ProbeResult('Online', latency)
+
+
+class TlsProbe:
+
+    @staticmethod
+    def parseOptions(options):
+        checkOptions(options, ('port', 'min_days', 'verify'))
+        if 'port' in options:
+            options['port'] = parsePort(options['port'])
+        if 'min_days' in options:
+            min_days = options['min_days']
+            if isinstance(min_days, bool) or \
+               not isinstance(min_days, (int, long, float)) or min_days < 0:
+                raise ValueError('Probe min_days must be a number of days')
+        if 'verify' in options and not isinstance(options['verify'], bool):
+            raise ValueError('Probe verify must be true or false')
+        # (an unverified certificate can't be looked at, so we'd never
+        # know when it expires)
+        if 'min_days' in options and options.get('verify') is False:
+            raise ValueError('Probe min_days needs the certificate verified')
+        return options
+
+
+    @staticmethod
+    def probe(probe_client, server, options):
+        """
+        Opens a TCP connection to the server and completes a TLS handshake,
+        noting when the server's certificate expires
+
+        Note that the certificate (and so its expiry) can only be looked at
+        when it is verified
+        """
+        port = options.get('port')
+        if port is None and not splitServer(server)[1]:
+            port = 443
+        verify = options.get('verify', True)
+        start_time = monotonicTime()
+        try:
+            connection, host_name = openConnection(probe_client, server, port)
+        except (DnsError, socket.error, ValueError) as error:
+            return failedConnection(error)
+        try:
+            context = ssl.create_default_context()
+            if not verify:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            # the handshake gets the rest of the read timeout, after the time
+            # spent connecting (and no more than the ping's deadline allows)
+            handshake_timeout = min(probe_client.timeouts()[1],
+                                    probe_client.timeout[1] -
+                                    (monotonicTime() - start_time))
+            if handshake_timeout <= 0:
+                raise socket.timeout('Read timeout spent connecting')
+            connection.settimeout(handshake_timeout)
+            connection = context.wrap_socket(connection,
+                                             server_hostname = host_name)
+            certificate = connection.getpeercert()
+        except socket.timeout:
+            connection.close()
+            return ProbeResult('Offline', failure = 'timeout')
+        except (ssl.SSLError, ssl.CertificateError, socket.error):
+            connection.close()
+            return ProbeResult('Offline', failure = 'tls_error')
+        latency = monotonicTime() - start_time
+        connection.close()
+
+        cert_expires = None
+        if certificate and 'notAfter' in certificate:
+            cert_expires = ssl.cert_time_to_seconds(certificate['notAfter'])
+        min_days = options.get('min_days')
+        if min_days is not None and cert_expires is not None and \
+           cert_expires - time.time() < min_days * 86400:
+            return ProbeResult('Offline', latency, failure = 'tls_error',
+                               cert_expires = cert_expires)
+        return ProbeResult('Online', latency, cert_expires = cert_expires)
+
+
+class HttpProbe:
+
+    @staticmethod
+    def parseOptions(options):
+        checkOptions(options, ('method', 'path', 'scheme', 'expect', 'body'))
+        if 'method' in options:
+            if not isinstance(options['method'], basestring) or \
+               options['method'].upper() not in http_probe_methods:
+                raise ValueError('Probe method must be one of: {0}'.format(
+                    ', '.join(http_probe_methods)))
+            options['method'] = options['method'].upper()
+        if 'path' in options:
+            if not isinstance(options['path'], basestring):
+                raise ValueError('Probe path must be a string')
+            options['path'] = '/' + options['path'].lstrip('/')
+        if 'scheme' in options and options['scheme'] not in ('http', 'https'):
+            raise ValueError('Probe scheme must be http or https')
+        if 'expect' in options:
+            expect = options['expect']
+            if not isinstance(expect, list):
+                expect = [expect]
+            if not expect or any(isinstance(code, bool) or
+                                 not isinstance(code, (int, long)) or
+                                 not 100 <= code < 600 for code in expect):
+                raise ValueError('Probe expect must be a status code '
+                                 'or a list of them')
+            options['expect'] = sorted(set(expect))
+        if 'body' in options:
+            if not isinstance(options['body'], basestring) or \
+               not options['body']:
+                raise ValueError('Probe body must be a non-empty string')
+            if options.get('method') == 'HEAD':
+                raise ValueError('Probe body cannot be checked with HEAD')
+            # the client's default method may be HEAD, which has no body
+            options.setdefault('method', 'GET')
+        return options
+
+
+    @staticmethod
+    def probe(probe_client, server, options):
+        """
+        Sends an HTTP request to the server with the given options
+        """
+        return probe_client.probeHttp(server, **options)
+
+
+# the probe types that come built in
+registerProbeType('tcp', TcpProbe)
+registerProbeType('tls', TlsProbe)
+registerProbeType('http', HttpProbe)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+__author__ = 'mshadish'
+"""
+Restore Benchmark
+=================
+Compares the state stores (see StateStore.py) at a large number of tracked
+servers: the SQLite database against the original CSV dump file and journal.
+
+For each store, we'll time:
+    - reading every server back in on startup (i.e., readInServers())
+    - recording a change to a single server, one at a time
+    - writing out the statuses of every server (which rewrites the whole dump
+    file for the csv store, and updates the database a batch at a time for
+    the sqlite store), first just after startup (when every status has gone
+    back to 'Unknown'), and then once 1% of the statuses have changed
+along with the size of the store on disk, and how long it takes to migrate
+the servers from the csv store into a new sqlite store.
+
+Each store is kept in its own temporary directory, which is removed
+afterwards.  Every tenth server is given a TCP probe spec, so that the probe
+specs are read back in too.
+
+------------
+USAGE NOTES:
+------------
+    python RestoreBenchmark.py [number of servers]
+
+The number of servers defaults to 100,000.
+"""
+# imports
+import os
+import shutil
+import sys
+import tempfile
+import time
+from ServerTracker import ServerTracker
+from StateStore import migrateCsv
+
+# global for the number of servers to benchmark with
+default_server_count = 100000
+# global for the number of single changes to time
+change_count = 1000
+# the probe spec given to every tenth server
+probe_key = '{"port":5432,"type":"tcp"}'
+
+
+def openTracker(directory, kind):
+    """
+    Returns a server tracker keeping its servers in the given kind
+    of state store, in the given directory
+    """
+    return ServerTracker(tracker_file = os.path.join(directory, 'dump.csv'),
+                         journal_file = os.path.join(directory, 'dump.journal'),
+                         history_dir = os.path.join(directory, 'history'),
+                         state_store = kind,
+                         state_file = os.path.join(directory, 'state.db'))
+
+
+def storeSize(directory):
+    """
+    Returns the total size of the state store files in the given directory
+
+    The SQLite write-ahead log is left out, since once it has been
+    checkpointed everything in it is in the database too (it is kept
+    around to be written over, rather than being truncated)
+    """
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for name in os.listdir(directory)
+               if os.path.isfile(os.path.join(directory, name)) and
+               not name.endswith(('-wal', '-shm')))
+
+
+def measure(kind, names):
+    """
+    Fills a fresh store of the given kind with the given servers, and then
+    times reading them back in, recording single changes, and writing out
+    every status
+
+    Returns a dictionary of the timings and the size of the store
+    """
+    directory = tempfile.mkdtemp(prefix = 'restore-{0}-'.format(kind))
+    try:
+        store = openTracker(directory, kind).state_store
+        store.appendMany([('add', name, 30,
+                           probe_key if index % 10 == 0 else None)
+                          for index, name in enumerate(names)])
+        store.rotate()
+        store.compact([(name, 30, 'Online' if index % 2 == 0 else 'Offline',
+                        probe_key if index % 10 == 0 else None)
+                       for index, name in enumerate(names)])
+        store.sync()
+        size = storeSize(directory)
+
+        # a fresh tracker, as if we'd just restarted
+        tracker = openTracker(directory, kind)
+        start = time.time()
+        tracker.readInServers()
+        restore_time = time.time() - start
+        if len(tracker.servers) != len(names):
+            raise RuntimeError('Read in {0} of {1} servers'.format(
+                len(tracker.servers), len(names)))
+
+        start = time.time()
+        for name in names[:change_count]:
+            tracker.state_store.append('update', name, 15, None)
+        tracker.state_store.sync()
+        change_time = (time.time() - start) / change_count
+
+        start = time.time()
+        tracker.writeOutServers()
+        status_time = time.time() - start
+
+        for name in names[::100]:
+            tracker.servers[name].status = 'Online'
+        start = time.time()
+        tracker.writeOutServers()
+        changed_time = time.time() - start
+        return {'size': size, 'restore': restore_time, 'change': change_time,
+                'statuses': status_time, 'changed': changed_time}
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+
+def measureMigration(names):
+    """
+    Times migrating the given servers from the csv store into a new
+    sqlite store
+    """
+    directory = tempfile.mkdtemp(prefix = 'restore-migrate-')
+    try:
+        store = openTracker(directory, 'csv').state_store
+        store.appendMany([('add', name, 30, None) for name in names])
+        store.rotate()
+        store.compact([(name, 30, 'Online', None) for name in names])
+        start = time.time()
+        migrateCsv(os.path.join(directory, 'dump.csv'),
+                   os.path.join(directory, 'dump.journal'),
+                   os.path.join(directory, 'state.db'))
+        return time.time() - start
+    finally:
+        shutil.rmtree(directory, ignore_errors = True)
+
+
+if __name__ == '__main__':
+    server_count = default_server_count
+    if len(sys.argv) > 1:
+        server_count = int(sys.argv[1])
+
+    names = ['server{0}.example.com'.format(i) for i in xrange(server_count)]
+
+    print 'State stores with {0} tracked servers:'.format(server_count)
+    print '  {0:<8} {1:>14} {2:>12} {3:>12} {4:>13} {5:>13}'.format(
+        'store', 'size (bytes)', 'restore (s)', 'change (ms)', 'all new (s)',
+        '1% new (s)')
+    for kind in ('csv', 'sqlite'):
+        timings = measure(kind, names)
+        print '  {0:<8} {1:>14,} {2:>12.3f} {3:>12.3f} {4:>13.3f} ' \
+              '{5:>13.3f}'.format(kind, timings['size'], timings['restore'],
+                                  timings['change'] * 1000,
+                                  timings['statuses'], timings['changed'])
+    print '  migrating csv to sqlite took {0:.3f}s'.format(
+        measureMigration(names))
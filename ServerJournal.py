@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Server journal definition
+
+This is the class that we will use to remember which servers we are tracking
+without rewriting the entire dump file on every change (it is the csv state
+store, see StateStore.py).  Every change to the
+set of tracked servers (a server being added, removed, or having its ping
+interval updated) is appended as a single line to a journal file.  Every so
+often, the journal is compacted: the full list of tracked servers is written
+out to the dump file (which serves as our snapshot) and the journal is
+emptied.  On startup, we read in the snapshot and then replay the journal
+on top of it.
+
+The journal file is a CSV with one change per row, of the format:
+    add,google.com,15
+    update,google.com,20
+    remove,google.com,
+Servers that aren't pinged with the default HTTP ping have their probe spec
+(see ProbeTypes.py) as a fourth field, e.g.
+    add,db.example.com:5432,10,"{""port"":5432,""type"":""tcp""}"
+
+Writes to the journal are flushed straight away, but are only fsync'd when
+sync() is called (i.e., once a heartbeat), so that a burst of changes doesn't
+have to wait on the disk for every single one.  Appending never waits on the
+disk, so it is cheap enough to do while holding the server tracker lock; the
+fsync and the compaction are meant to be done without holding it.
+
+Compacting happens in two steps.  First, the journal is rotated: the current
+journal is set aside (renamed with a .old suffix) and new changes start going
+to a fresh journal.  This only takes a rename, so it can be done under the
+server tracker lock, at the same moment as the servers are copied out for the
+snapshot.  Then the snapshot is written to a temporary file which is renamed
+over the old snapshot, and the set-aside journal is deleted.  Since changes
+made after the rotation are in the fresh journal, nothing is lost if they come
+in while the snapshot is being written.
+
+A crash partway through a compaction never leaves us with a truncated dump
+file.  If we crash before the new snapshot is in place, the set-aside journal
+and the fresh journal are both replayed on top of the old snapshot on startup.
+If we crash after, the set-aside journal is replayed on top of the new snapshot,
+which is harmless since replaying a change twice has the same effect as
+replaying it once.
+
+
+Methods:
+--------
+load()
+    - reads in the snapshot and replays the journal on top of it
+
+append(operation, server name, ping interval, probe spec)
+    - records a single change in the journal
+
+appendMany(list of changes)
+    - records a whole batch of changes in the journal,
+    with a single flush for the whole batch
+
+sync()
+    - forces any changes that haven't yet been fsync'd out to disk
+
+needsCompaction()
+    - whether or not enough changes have built up in the journal
+    that it is time to compact
+
+rotate()
+    - sets the current journal aside and starts a fresh one,
+    as the first step of a compaction
+
+compact(rows)
+    - atomically replaces the snapshot with the given servers
+    and deletes the set-aside journal
+
+replay(dictionary of {server name: (ping interval, probe spec)})
+    - applies every change in the set-aside journal and the journal
+    to the given dictionary
+
+formatStatus(rows)
+    - formats the given servers as CSV, in the format of the snapshot
+"""
+# imports
+import StringIO
+import csv
+import os
+import threading
+from collections import OrderedDict
+from Instrumentation import persistence_duration
+from PingScheduler import monotonicTime
+
+# global for how many changes we'll let build up before we compact
+default_compaction_threshold = 1000
+# global for the suffix of the journal that has been set aside for compaction
+rotated_suffix = '.old'
+
+
+class ServerJournal:
+
+    def __init__(self, snapshot_file, journal_file,
+                 compaction_threshold = default_compaction_threshold):
+        """
+        Initialization function
+
+        :param snapshot_file = file to write the full snapshot out to
+        :param journal_file = file to append changes to
+        :param compaction_threshold = number of changes to let build up
+        in the journal before it is time to compact
+        """
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.rotated_file = journal_file + rotated_suffix
+        self.compaction_threshold = compaction_threshold
+        # the open journal file (opened the first time we append)
+        self.outfile = None
+        self.writer = None
+        # number of changes written since the last fsync
+        self.unsynced_count = 0
+        # number of changes in the journal since the last compaction
+        self.entry_count = 0
+        # appends come in under the server tracker lock, while syncs and
+        # compactions happen without it, so we keep our own (short) lock
+        # around the open journal file
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        """
+        Reads in the snapshot, presumed to be of the format:
+            Server,Ping Interval,Status,Probe
+            machine1,10,Offline,
+            google.com,15,Online,
+            db.example.com:5432,10,Online,"{""port"":5432,""type"":""tcp""}"
+
+        (snapshots written out before probe specs existed have no Probe
+        column, and are read in with the default HTTP ping for every server)
+        If the header is any different, we won't read the snapshot in
+
+        Any changes recorded in the journal since the snapshot was written
+        out are then replayed on top of it
+
+        Returns a tuple of (list of (server name, ping interval, probe spec),
+        number of changes replayed), where the intervals and probe specs are
+        as in replay()
+        """
+        servers = OrderedDict()
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'rb') as infile:
+                reader = csv.reader(infile)
+                # verify that the header looks exactly as we expect
+                header = next(reader, None)
+                if header in (['Server','Ping Interval','Status'],
+                              ['Server','Ping Interval','Status','Probe']):
+                    for record in reader:
+                        probe = record[3] if len(record) > 3 else ''
+                        servers[record[0]] = (record[1], probe)
+        # bring the servers up to date with any changes since
+        replayed = self.replay(servers)
+        return [(server, interval, probe) for server, (interval, probe)
+                in servers.iteritems()], replayed
+
+
+    def append(self, operation, server, interval = None, probe = None):
+        """
+        Records a single change in the journal
+
+        :param operation = 'add', 'update', or 'remove'
+        :param server = name of the server that changed
+        :param interval = the server's new ping interval
+        (not needed for removals)
+        :param probe = the server's probe spec, as a JSON string
+        (None for the default HTTP ping)
+        """
+        self.appendMany([(operation, server, interval, probe)])
+        return
+
+
+    def appendMany(self, changes):
+        """
+        Records a batch of changes in the journal, all at once
+
+        :param changes = list of (operation, server name, ping interval,
+        probe spec) tuples, in the order the changes were made
+        """
+        if not changes:
+            return
+        start_time = monotonicTime()
+        with self.lock:
+            for operation, server, interval, probe in changes:
+                self._writeChange(operation, server, interval, probe)
+            # flush out of our own buffer straight away, so that the changes
+            # survive if the process dies (the fsync in sync() is what
+            # makes them survive the machine dying)
+            self.outfile.flush()
+            self.unsynced_count += len(changes)
+            self.entry_count += len(changes)
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('append',))
+        return
+
+
+    def _writeChange(self, operation, server, interval, probe):
+        """
+        Writes a single change out to the journal file
+        (without flushing it), opening the file if need be
+        """
+        if self.outfile is None:
+            self.outfile = open(self.journal_file, 'ab')
+            self.writer = csv.writer(self.outfile, lineterminator = '\n')
+        if interval is None:
+            interval = ''
+        if probe is None:
+            self.writer.writerow([operation, server, interval])
+        else:
+            self.writer.writerow([operation, server, interval, probe])
+        return
+
+
+    def sync(self):
+        """
+        Forces any changes that haven't been fsync'd yet out to disk
+
+        We only hold our lock long enough to get our own handle on the
+        journal file, so that appends don't have to wait on the disk
+        """
+        with self.lock:
+            if self.outfile is None or self.unsynced_count == 0:
+                return
+            fileno = os.dup(self.outfile.fileno())
+            self.unsynced_count = 0
+        start_time = monotonicTime()
+        try:
+            os.fsync(fileno)
+        finally:
+            os.close(fileno)
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('sync',))
+        return
+
+
+    def needsCompaction(self):
+        """
+        Returns whether or not the journal has grown long enough
+        that it should be compacted into the snapshot
+        """
+        return self.entry_count >= self.compaction_threshold
+
+
+    def rotate(self):
+        """
+        Sets the current journal aside and starts a fresh one, as the first
+        step of a compaction (every change in the set-aside journal should
+        make it into the snapshot given to compact())
+        """
+        with self.lock:
+            if self.outfile is not None:
+                self.outfile.close()
+                self.outfile = None
+                self.writer = None
+            if os.path.exists(self.rotated_file):
+                # the last compaction never finished, so the journal it set
+                # aside is still needed until this one does
+                if os.path.exists(self.journal_file):
+                    with open(self.journal_file, 'rb') as infile:
+                        journal = infile.read()
+                    with open(self.rotated_file, 'ab') as outfile:
+                        outfile.write(journal)
+                    os.remove(self.journal_file)
+            elif os.path.exists(self.journal_file):
+                os.rename(self.journal_file, self.rotated_file)
+            self.unsynced_count = 0
+            self.entry_count = 0
+        return
+
+
+    def compact(self, rows):
+        """
+        Writes out the given servers as the new snapshot in place of the old
+        one and deletes the journal set aside by rotate()
+
+        :param rows = (server name, ping interval, status, probe spec)
+        of every server
+        """
+        start_time = monotonicTime()
+        snapshot = formatStatus(rows)
+        # write out the new snapshot alongside the old one
+        temp_file = self.snapshot_file + '.tmp'
+        with open(temp_file, 'wb') as outfile:
+            outfile.write(snapshot)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        # and swap it in (this is atomic, so readers will see either
+        # the old snapshot or the new one, never a partial one)
+        os.rename(temp_file, self.snapshot_file)
+
+        # everything in the set-aside journal is now part of the snapshot
+        if os.path.exists(self.rotated_file):
+            os.remove(self.rotated_file)
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('compact',))
+        return
+
+
+    def replay(self, servers):
+        """
+        Applies every change recorded in the journal (and in the journal
+        set aside by a compaction that never finished) to the given servers
+
+        :param servers = dictionary of {server name: (ping interval,
+        probe spec)} read in from the snapshot, which is updated in place
+        (note that the intervals and probe specs are left as they appear
+        in the file, for the caller to validate, and a probe spec of ''
+        is the default HTTP ping)
+
+        Returns the number of changes that were replayed
+        """
+        replayed = 0
+        # the set-aside journal holds the older changes, so it goes first
+        for journal_file in (self.rotated_file, self.journal_file):
+            if not os.path.exists(journal_file):
+                continue
+            with open(journal_file, 'rb') as infile:
+                journal = infile.read()
+            # every complete change ends in a newline, so anything after the
+            # last newline is a change that was cut short by a crash
+            journal = journal[:journal.rfind('\n') + 1]
+
+            reader = csv.reader(journal.splitlines())
+            for record in reader:
+                # skip anything else we can't make sense of
+                if len(record) == 3:
+                    record.append('')
+                if len(record) != 4:
+                    continue
+                operation, server, interval, probe = record
+                if operation == 'remove':
+                    servers.pop(server, None)
+                elif operation in ('add', 'update') and interval:
+                    servers[server] = (interval, probe)
+                else:
+                    continue
+                replayed += 1
+
+        # these changes are still in the journal, so they count towards
+        # the next compaction
+        self.entry_count += replayed
+        return replayed
+
+
+def formatStatus(rows):
+    """
+    Formats the given servers as CSV, in the format of the snapshot
+
+    :param rows = (server name, ping interval, status, probe spec)
+    of every server, where the probe spec is None for the default HTTP ping
+    """
+    output = StringIO.StringIO()
+    # use a csv writer to write out each row
+    writer = csv.writer(output, lineterminator = '\n')
+
+    # write the header
+    writer.writerow(['Server','Ping Interval','Status','Probe'])
+
+    # write out every server
+    writer.writerows(rows)
+
+    return output.getvalue()
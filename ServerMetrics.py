@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Server metrics definition
+
+These are the classes that we will use to keep track of how each server has
+been responding to our pings -- not just whether it was online or offline,
+but how long it took to respond, what HTTP status code it responded with,
+and, if the ping failed, why.
+
+Since we may be tracking a very large number of servers, everything here
+takes up a fixed amount of memory no matter how long a server is tracked:
+    - the most recent pings are kept in ring buffers (fixed-size arrays
+    that we write over in a circle), which give us the recent uptime,
+    status codes, and failures
+    - every response time is counted in a latency histogram with a fixed set
+    of buckets, which gives us (approximate) latency percentiles
+
+
+Methods:
+--------
+LatencyHistogram.record(latency)
+    - counts a single response time, in seconds
+
+LatencyHistogram.percentile(percent)
+    - returns the (approximate) response time below which the given percent
+    of the response times fall
+
+ServerMetrics.record(probe result)
+    - records the outcome of a single ping (see ProbeResult in ProbeEngine.py)
+
+ServerMetrics.summary()
+    - returns a dictionary summarizing the server's pings, suitable for
+    returning as JSON
+"""
+# imports
+import array
+import bisect
+
+# global for the number of recent pings we'll keep for each server
+default_window_size = 60
+# the reasons a ping may have failed (None meaning that it didn't)
+# stored by their index, so that each one takes up a single byte
+# (these indexes are also kept on disk, so new reasons go on the end)
+failure_classes = (None, 'timeout', 'connection_error', 'http_error', 'error',
+                   'dns', 'tls_error', 'body_mismatch')
+# the upper bounds of the latency histogram buckets, in seconds
+# (growing by half again each time, from 1 millisecond up to a minute or so)
+latency_buckets = tuple(0.001 * 1.5 ** i for i in xrange(28))
+
+
+class LatencyHistogram:
+
+    def __init__(self):
+        """
+        Initialization function
+        """
+        # one count for each bucket, plus one for anything past the last one
+        self.counts = array.array('I', [0] * (len(latency_buckets) + 1))
+        self.total = 0
+        self.max_latency = 0.0
+
+
+    def record(self, latency):
+        """
+        Counts a single response time
+
+        :param latency = the response time, in seconds
+        """
+        self.counts[bisect.bisect_left(latency_buckets, latency)] += 1
+        self.total += 1
+        self.max_latency = max(self.max_latency, latency)
+        return
+
+
+    def percentile(self, percent):
+        """
+        Returns the response time below which the given percent of the
+        response times fall (or None if nothing has been recorded yet)
+
+        Since we only know which bucket each response time fell in, this is
+        the upper bound of the bucket (capped at the slowest response time
+        we've actually seen)
+
+        :param percent = the percentile to find, from 0 to 100
+        """
+        if self.total == 0:
+            return None
+        # the number of response times at or below the percentile
+        target = self.total * percent / 100.0
+        running_count = 0
+        for index, count in enumerate(self.counts):
+            running_count += count
+            if running_count >= target and count:
+                if index < len(latency_buckets):
+                    return min(latency_buckets[index], self.max_latency)
+                break
+        return self.max_latency
+
+
+class ServerMetrics:
+
+    def __init__(self, window_size = default_window_size):
+        """
+        Initialization function
+
+        :param window_size = the number of recent pings to keep
+        """
+        self.window_size = window_size
+        # ring buffers of the most recent pings
+        # (latencies of -1 mean there was no response to time)
+        self.latencies = array.array('f', [-1.0] * window_size)
+        self.status_codes = array.array('H', [0] * window_size)
+        self.failures = array.array('B', [0] * window_size)
+        # where the next ping goes in the ring buffers, and how many
+        # of the slots have been filled so far
+        self.position = 0
+        self.window_count = 0
+        # counts of every ping since we started tracking the server
+        self.total_pings = 0
+        self.total_online = 0
+        # and the histogram of every response time
+        self.histogram = LatencyHistogram()
+        # when the server's TLS certificate expires (for TLS probes only)
+        self.cert_expires = None
+
+
+    def record(self, result):
+        """
+        Records the outcome of a single ping
+
+        :param result = the ProbeResult of the ping
+        """
+        if result.latency is not None:
+            self.latencies[self.position] = result.latency
+            self.histogram.record(result.latency)
+        else:
+            self.latencies[self.position] = -1.0
+        self.status_codes[self.position] = result.status_code or 0
+        self.failures[self.position] = failure_classes.index(result.failure)
+        if result.cert_expires is not None:
+            self.cert_expires = result.cert_expires
+
+        # move on to the next slot, wrapping around at the end
+        self.position = (self.position + 1) % self.window_size
+        self.window_count = min(self.window_count + 1, self.window_size)
+
+        self.total_pings += 1
+        if result.failure is None:
+            self.total_online += 1
+        return
+
+
+    def summary(self):
+        """
+        Summarizes the pings to this server
+
+        Returns a dictionary of the uptime (over the recent window and
+        since tracking started), the latency percentiles (in milliseconds),
+        the most recent status code and response time, the number of
+        recent failures of each kind, and when the server's TLS certificate
+        expires (if it is given TLS probes)
+        """
+        # walk the filled slots of the ring buffers
+        recent_online = 0
+        recent_failures = {}
+        for index in xrange(self.window_count):
+            failure = failure_classes[self.failures[index]]
+            if failure is None:
+                recent_online += 1
+            else:
+                recent_failures[failure] = recent_failures.get(failure, 0) + 1
+
+        # the most recent ping is the one just behind the current position
+        last_code = None
+        last_latency = None
+        if self.window_count:
+            last = (self.position - 1) % self.window_size
+            last_code = self.status_codes[last] or None
+            if self.latencies[last] >= 0:
+                last_latency = round(self.latencies[last] * 1000, 1)
+
+        latency = {}
+        for percent in (50, 95, 99):
+            value = self.histogram.percentile(percent)
+            if value is not None:
+                value = round(value * 1000, 1)
+            latency['p{0}'.format(percent)] = value
+
+        return {'pings': self.total_pings,
+                'uptime_percent': percentOf(self.total_online, self.total_pings),
+                'recent_pings': self.window_count,
+                'recent_uptime_percent': percentOf(recent_online,
+                                                   self.window_count),
+                'recent_failures': recent_failures,
+                'last_status_code': last_code,
+                'last_latency_ms': last_latency,
+                'latency_ms': latency,
+                'cert_expires': self.cert_expires}
+
+
+def percentOf(part, whole):
+    """
+    Returns part as a percentage of whole (or None if whole is zero)
+    """
+    if not whole:
+        return None
+    return round(100.0 * part / whole, 2)
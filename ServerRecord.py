@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Server record definition
+
+This is the class that we will use to hold everything the server tracker
+knows about a single server: its name, the interval of time between pings,
+its current status ('Online', 'Offline', or 'Unknown'), the (monotonic)
+time at which it was last pinged, and the counts that the probe policy
+(see ProbePolicy.py) keeps on it: the number of failed pings in a row, and
+the number of pings in a row that disagreed with its status.  Servers that
+aren't pinged with the default HTTP ping also hold on to their probe spec
+(see ProbeTypes.py), which is shared by every server with the same spec.
+
+Since we may be tracking a very large number of servers, the class uses
+__slots__ rather than a per-instance dictionary, which keeps each record
+down to the size of its seven fields.  Keeping the status as a field (rather
+than keeping a separate dictionary for each status) also means that a server
+changing status is just a matter of updating that field.
+"""
+
+
+class ServerRecord(object):
+
+    __slots__ = ('name', 'interval', 'status', 'last_ping',
+                 'failures', 'unconfirmed', 'probe')
+
+    def __init__(self, name, interval, status, last_ping, probe = None):
+        """
+        Initialization function
+
+        :param name = name of the server
+        :param interval = time interval to wait between pings, in seconds
+        :param status = 'Online', 'Offline', or 'Unknown'
+        :param last_ping = monotonic time at which the server was last pinged
+        (or at which we started tracking it, if it hasn't been pinged yet)
+        :param probe = the ProbeSpec to ping the server with
+        (None for the default HTTP ping)
+        """
+        self.name = name
+        self.interval = interval
+        self.status = status
+        self.last_ping = last_ping
+        self.probe = probe
+        # failed pings in a row, and pings in a row that disagreed with
+        # the status (which is only changed once they are confirmed)
+        self.failures = 0
+        self.unconfirmed = 0
+
+
+    def __repr__(self):
+        return 'ServerRecord({0!r}, {1!r}, {2!r}, {3!r})'.format(self.name,
+                                                                self.interval,
+                                                                self.status,
+                                                                self.last_ping)
@@ -7,225 +7,571 @@ This is the class that we will use to keep track of the various servers
 for which we want heartbeats (i.e., which servers to track,
 which servers are offline, how frequently to ping each server, etc.)
 
-Note that, when keeping track of the servers, we will use dictionaries
-where the key is the server name and the value is a list of 2 elements
-(first element being how many "seconds" has elapsed since the server was
-last pinged, second element being the interval of time between pings).
-So the structure of each dictionary element looks like:
+Note that, when keeping track of the servers, we will use a single dictionary
+where the key is the server name and the value is a server record (see
+ServerRecord.py) holding the server's ping interval, its status, and the
+(monotonic) time at which it was last pinged.  So the structure of each
+dictionary element looks like:
 
-    {server_name: [time elapsed since last ping, ping wait time interval]}
+    {server_name: ServerRecord(server_name, ping wait time interval,
+                               status, time of last ping)}
+
+Each server is pinged with an HTTP request by default, or as its probe spec
+says, if it was given one (e.g., with a TCP connection or a TLS handshake
+instead, see ProbeTypes.py), which is kept on its record and written out
+to the state store along with its ping interval.
+
+The servers are remembered across restarts in a state store (see
+StateStore.py): an SQLite database by default, or else the original dump
+file and journal.  Every change to the tracked servers is recorded in the
+store as it is made, and the statuses every so often.
+
+The status of each server is either 'Online', 'Offline', or 'Unknown'
+(i.e., servers that we haven't pinged yet, such as those read back in from
+the dump file on startup, until their first ping comes back).
+
+When each server is next due for a ping is kept track of separately by
+a ping scheduler (see PingScheduler.py), so that we only ever have to look
+at the servers that are actually due.  Ping intervals are in seconds and
+may be fractional.
 
 
 Methods:
 --------
 readInServers()
-    - will attempt to read in our globally-defined heartbeat server dump file
+    - will attempt to read in the servers in our state store
     which will serve as a way of recovering known server information
     in the case that the heartbeat server goes down
+    - with the csv store, any changes recorded in the journal since the dump
+    file was last written out are replayed on top of it
+    - the servers start out with an 'Unknown' status, and their first pings
+    are left to the scheduler (spread out over their first interval),
+    so that reading in the file doesn't have to wait on any pings
+    
+adoptServers(list of (server name, ping time interval, probe spec))
+    - takes over servers read in from some other state store, as if they
+    had been read in from ours, and records them in our state store
+    
+exportServers(list of server names)
+    - returns the given servers as they are recorded in our state store,
+    for handing them over to another tracker's adoptServers()
     
 writeOutServers()
-    - this will be called any time there is a change in the servers being
-    tracked
     - writes out the current list of servers tracked as well as their statuses
+    to the state store (with the csv store, atomically replacing the dump file
+    and emptying out the journal, since every change in it is now in the
+    dump file)
+    
+syncJournal(lock)
+    - to be called periodically (i.e., once a heartbeat)
+    - makes sure every change in the state store has made it to disk,
+    and writes out the statuses once enough changes have built up
+    - also writes out the pings since the last call to the history
+    - the lock is only held while the servers are copied out for the
+    statuses, not while anything is written to disk
+    
+probeIfUntracked(server name, probe spec)
+    - pings the given server if we aren't already tracking it, so that the
+    ping can be sent out before taking the lock to add the server
     
-addServer(server name)
+addServer(server name, probe spec, probe result)
     - adds the given server name to our set of tracked servers,
     determining whether or not the server is currently online or offline
-    - uses the default time interval between pings of that server
-    - calls writeOutServers() if there were any changes
+    (using the given result of probeIfUntracked(), if there is one)
+    - uses the default time interval between pings of that server,
+    and the given probe spec (or the default HTTP ping, if none is given)
+    - if the server is already tracked, changes its probe spec
+    to the given one
+    - records the change in the state store if there were any changes
     
 removeServer(server name)
     - removes the given server name from our set of tracked servers,
     unless it doesn't exist (in which case there is nothing to remove)
-    - also calls writeOutServers() if there were any changes
+    - also records the change in the state store if there were any changes
     
-updatePingInterval(server name, ping time interval)
+updatePingInterval(server name, ping time interval, probe spec, probe result)
     - updates the time interval between pings for a given server
+    (and its probe spec, if one is given)
     - if the server isn't already tracked, we will track it
-    - will call writeOutServers(), since the ping time interval has presumably
-    been changed (or a new server may have been added to tracking)
+    (using the given result of probeIfUntracked(), if there is one)
+    - will record the change in the state store, since the ping time interval
+    has presumably been changed (or a new server may have been added)
     
-incrementTimers()
-    - increments the first element in the list associated with each server
-    - the idea is to show that, relative to each server's specified wait
-    time interval, some amount of time has passed
+addServers(list of (server name, ping time interval, probe spec))
+    - the bulk version of addServer() and updatePingInterval(), for adding
+    or updating many servers at once
+    - rather than pinging new servers straight away, they start out as
+    'Unknown' and are left for the scheduler to ping
+    - records all of the changes in the state store in a single batch
     
-pingAllDueServers()
+removeServers(list of server names)
+    - the bulk version of removeServer()
+    
+pingAllDueServers(lock)
     - for each server, we'll send a ping (in our case, an HTTP GET request)
     to check the status of any server for which the time that has elapsed
     since the last ping to that server is equal to or greater than
     that server's specified time interval between pings
-    - once the pings have been sent out, we'll update the status (online vs.
-    offline) of any servers that changed
+    - only the servers that the scheduler reports as due are looked at
+    - the pings are all sent out in parallel by the probe engine
+    (see ProbeEngine.py), which gathers up the results for us
+    (giving up on any that aren't back by the batch's deadline)
+    - the lock is only held while the due servers are picked out and
+    while the results are recorded, not while the pings are out
+    - once the whole batch of pings has come back, we'll update the status
+    (online vs. offline) of any servers that changed
+    - any servers the probe engine didn't get to (before the deadline,
+    or because their host wasn't answering) are left due, to be pinged
+    on the next tick
+    - each pinged server is then rescheduled one interval after the time
+    it was due (rather than after the time it was actually pinged),
+    so that late ticks don't cause the schedule to drift
+    - the probe policy (see ProbePolicy.py) may stretch that interval for
+    servers that stay offline, or shorten it to confirm a change in status
+    before the status is actually changed
+    - if there is a probe budget, only as many servers as the budget allows
+    are pinged, and the rest are left due for the following ticks
+    - in cluster mode, servers that another node is responsible for
+    are rescheduled without being pinged (see ClusterNode.py), and don't
+    count against the probe budget
+    
+applyStatuses(dictionary of server name: status)
+    - updates the statuses of servers that are pinged by another node,
+    as reported by that node (in cluster mode)
+    
+secondsUntilNextPing()
+    - returns how long until the next server is due for a ping,
+    so that the heartbeat knows how long it can wait before checking again
+    
+getServerMetrics(server name)
+    - returns a summary of the server's recent pings: uptime, latency
+    percentiles, status codes, and failures (see ServerMetrics.py)
+    
+probeSpecs()
+    - returns the probe spec of every server that isn't given
+    the default HTTP ping
+    
+getServerHistory(server name, start time, end time, resolution)
+    - returns the server's pings over a range of time, from the history
+    of every ping kept on disk (see HistoryStore.py)
+    - needs no lock, since the history store keeps its own
+    
+statusSince(version)
+    - returns a copy of every server's interval and status, for building
+    a status snapshot (see StatusSnapshot.py) to answer status requests
+    - returns nothing if no status or interval has changed since the given
+    version, so that snapshots are only rebuilt when something has changed
     
 printStatus()
     - prints the status of all servers
-    - returned for GET requests and used for writing out to the dump file
+    - returned for GET requests
 """
 # imports
-import StringIO
-import requests
-import csv
-import os
+import math
+import threading
+import time
+# the pinging itself is handled by the probe engine
+from ProbeEngine import ProbeEngine, sendPing
+from ProbeEngine import default_max_in_flight
+# and knowing when each server is due is handled by the ping scheduler
+from PingScheduler import PingScheduler, monotonicTime
+# and remembering the servers across restarts is handled by the state store
+from StateStore import openStateStore, default_state_store
+from ServerJournal import formatStatus
+# and answering status requests is handled by status snapshots
+from StatusSnapshot import statuses as snapshot_statuses
+# each server we track is kept in a server record
+from ServerRecord import ServerRecord
+# and the results of the pings to each server are kept in its metrics
+from ServerMetrics import ServerMetrics
+# and when each server is next pinged is up to the probe policy
+from ProbePolicy import ProbePolicy, ProbeBudget
+# and the history of every ping is kept on disk
+from HistoryStore import HistoryStore
+# servers may be pinged in other ways than the default HTTP ping
+from ProbeTypes import parseProbeSpec
 
 # global for default length of time between pings, in seconds
 default_ping_interval = 30
 # global for tracker file
 server_tracker_file = 'heartbeat_server_dump.csv'
+# global for the journal of changes made since the tracker file was written
+server_journal_file = 'heartbeat_server_dump.journal'
+# global for the database of the sqlite state store
+server_state_file = 'heartbeat_state.db'
+# global for the directory the history of every ping is kept in
+server_history_dir = 'heartbeat_history'
+# global for how long to put off servers the probe engine didn't get to,
+# in seconds, when it didn't get to any of the servers due
+# (so that we don't keep on asking it straight away)
+unpinged_retry_delay = 0.25
 
 
-def sendPing(server):
+def parseInterval(value):
     """
-    Pings a given server (using HTTP), returns the status of the server
+    Converts the given value into a ping time interval, in seconds
     
-    Returns either 'Online' or 'Offline'
-    """
-    server_status = None
+    Whole numbers of seconds are kept as integers (so that they read nicely
+    in the dump file), while anything else is kept as a float
     
-    # build the url
-    url = 'http://{0}'.format(server)
-    # send the ping via HTTP
-    try:
-        health = requests.get(url)
-    except requests.ConnectionError:
-        return 'Offline'
-    # depending on the health of the system, respond accordingly
-    if health.ok:
-        server_status = 'Online'
-    else:
-        server_status = 'Offline'
+    :param value = the interval to convert (a number or a string)
     
-    return server_status
+    Returns the interval, or raises a ValueError if the value can't be used
+    as an interval (i.e., isn't a number, or isn't positive and finite)
+    """
+    try:
+        interval = float(value)
+    except TypeError:
+        raise ValueError('Ping time interval must be a number')
+    # an interval of zero (or less) would have us pinging constantly
+    if not interval > 0:
+        raise ValueError('Ping time interval must be positive')
+    # and an infinite one would never come due (nor read back in)
+    if math.isinf(interval):
+        raise ValueError('Ping time interval must be finite')
+    if interval.is_integer():
+        return int(interval)
+    return interval
+
+
+def storedProbe(probe):
+    """
+    Returns the probe spec to keep on a server's record, i.e., the given
+    ProbeSpec, or None if it is just the default HTTP ping
+    """
+    if probe is None or probe.isDefault():
+        return None
+    return probe
+
+
+def specKey(record):
+    """
+    Returns the probe spec of a server's record as it is written out to disk,
+    i.e., as a JSON string, or None for the default HTTP ping
+    """
+    if record.probe is None:
+        return None
+    return record.probe.key
 
 
 class ServerTracker:
 
-    def __init__(self):
+    def __init__(self, max_in_flight = default_max_in_flight,
+                 probe_client = None, tracker_file = None, journal_file = None,
+                 probe_policy = None, probe_budget = None, history_dir = None,
+                 state_store = None, state_file = None):
         """
         Initialization function
+
+        :param max_in_flight = most pings we'll allow in flight at once
+        :param probe_client = the probe client (see ProbeEngine.py) to send
+        pings with, which carries the connection pool settings, HTTP method,
+        and timeouts (if not given, the shared default client is used)
+        :param tracker_file = the dump file of the csv state store, which the
+        sqlite store also migrates from (if not given, the global server
+        tracker file is used)
+        :param journal_file = the journal of the csv state store
+        (if not given, the global server journal file is used)
+        :param probe_policy = the ProbePolicy deciding when each server is
+        next pinged (if not given, one with the default settings is used)
+        :param probe_budget = most pings to send out per second, across
+        every server (or None for no limit)
+        :param history_dir = the directory to keep the history of every ping in
+        (if not given, the global server history directory is used)
+        :param state_store = the kind of state store to remember the servers
+        in, 'sqlite' or 'csv' (if not given, the default kind is used)
+        :param state_file = the database of the sqlite state store
+        (if not given, the global server state file is used)
         """
+        if tracker_file is None:
+            tracker_file = server_tracker_file
+        if journal_file is None:
+            journal_file = server_journal_file
+        if history_dir is None:
+            history_dir = server_history_dir
+        if state_store is None:
+            state_store = default_state_store
+        if state_file is None:
+            state_file = server_state_file
         # we'll use a dictionary to keep track of the servers to track,
-        # where the value represents how long to wait between pings
-        # note that these will be considered 'online' servers
-        # i.e., we will keep track of servers that have disconnected separately
-        self.online_servers = {}
-        # we'll also keep track of the servers that have disconnected
-        # this too will be a dictionary -- in this way, we can keep track
-        # of any servers that have gone offline but come back online
-        self.offline_servers = {}
+        # where the value is the server's record (its interval, status, etc.)
+        # note that the servers of every status are kept together, so that
+        # a server going offline or coming back online is just a matter of
+        # updating the status on its record
+        self.servers = {}
+        # along with the metrics on the pings to each server, by server name
+        # (created the first time each server is pinged)
+        self.metrics = {}
+        # how long it took to read in the servers on startup, in seconds
+        self.restore_time = None
+        # and the probe engine that will send out our pings in parallel
+        self.probe_engine = ProbeEngine(max_in_flight, probe_client)
+        # and the scheduler that will tell us which servers are due for a ping
+        self.scheduler = PingScheduler()
+        # along with the policy that decides when they're next due
+        # and the budget of pings per second (if any)
+        if probe_policy is None:
+            probe_policy = ProbePolicy()
+        self.probe_policy = probe_policy
+        self.probe_budget = None
+        if probe_budget is not None:
+            self.probe_budget = ProbeBudget(probe_budget)
+        # function telling us whether we're the one to ping a given server,
+        # or None if we ping every server (set in cluster mode, where each
+        # server is pinged by a single node of the cluster)
+        self.owns = None
+        # the version of our servers, bumped whenever a status or interval
+        # changes
+        self.status_version = 0
+        # and the state store we'll record every change to the tracked
+        # servers in
+        self.state_store = openStateStore(state_store, tracker_file,
+                                          journal_file, state_file)
+        # along with the history of every ping
+        self.history = HistoryStore(history_dir)
         
     def readInServers(self):
         """
-        Will look for the global "tracker" file in the current working dir
-        and read in its contents, presumed to be of the format:
-            Server,Ping Interval,Status
-            machine1,10,Offline
-            google.com,15,Online
-            
-        If the header is any different, we won't read the file in
+        Will read in every server in our state store (see StateStore.py),
+        along with its ping interval and probe spec
+        
+        With the csv store, any changes recorded in the journal file since
+        the tracker file was last written out are replayed on top of it
+        
+        Rather than pinging every server before we return, each server
+        starts out as 'Unknown' and is scheduled for its first ping at some
+        point within its first interval, so that the pings are spread out
+        instead of all landing on the first heartbeat
             
         This is a way of remembering previously-known servers in the event
         that our heartbeat server goes down and we have to restart it
         (i.e., this can serve as a pseudo memory dump file)
         """
-        # we'll be using the global server tracker file
-        global server_tracker_file
-        # first, grab a list of all files in the current working directory
-        current_dir = os.listdir('.')
-        # verify that our server tracker file exists here
-        if server_tracker_file not in current_dir:
-            # if there's nothing to read in, simply return
-            return
+        # keep track of how long the restore takes
+        start_time = time.time()
+        # we'll gather up (server name, ping interval, probe spec) from the
+        # state store before we start tracking anything
+        known_servers, replayed_count = self.state_store.load()
+        server_count = len(self._restoreServers(known_servers))
             
-        # read in the csv
-        with open(server_tracker_file, 'rb') as infile:
-            # initialize the reader
-            reader = csv.reader(infile)
-            # verify that the header looks exactly as we expect
-            header = reader.next()
-            if header != ['Server','Ping Interval','Status']:
-                # if this isn't the case, we won't try to read the file
-                return
-            else:
-                # update our servers with the records we know about
-                # while we update, we'll keep a count of how many
-                # we can successfully read in
-                server_count = 0
-                for record in reader:
-                    # pull out the server name and ping interval
-                    server = record[0]
-                    try:
-                        interval = int(record[1])
-                    except ValueError:
-                        continue
-                    # ping the server to determine whether it is online
-                    # or offline
-                    status = sendPing(server)
-                    if status == 'Online':
-                        # allocate to online
-                        self.online_servers[server] = [0, interval]
-                    else:
-                        # allocate to offline
-                        self.offline_servers[server] = [0, interval]
-                    # udpate our count
-                    server_count += 1
-                # repeat for every record from our pseudo memory dump file
-                # report and return
-                print 'Read in {0} known servers'.format(server_count)
+        # fold any replayed changes into a fresh dump file,
+        # so that the journal starts out empty
+        if replayed_count:
+            self.writeOutServers()
+            
+        # report and return
+        self.status_version += 1
+        self.restore_time = time.time() - start_time
+        if server_count or replayed_count:
+            print 'Read in {0} known servers in {1:.3f} seconds'.format(server_count,
+                                                                         self.restore_time)
                 
         # file read complete
         return
         
         
+    def adoptServers(self, known_servers):
+        """
+        Takes over servers read in from some other state store (e.g., one
+        left behind by a different number of shards), tracking them just as
+        if they had been read in from ours, and recording them in our state
+        store (so that they are read back in from ours from then on)
+        
+        Servers we are already tracking are left as they are
+        
+        :param known_servers = list of (server name, ping interval,
+        probe spec) tuples, as read in from a state store
+        
+        Returns the number of servers taken over
+        """
+        adopted = self._restoreServers([known for known in known_servers
+                                        if known[0] not in self.servers])
+        # these are the only record of the servers once the other state
+        # store is set aside, so we'll wait on the disk for them
+        self.state_store.appendMany([('add', server, self.servers[server].interval,
+                                      specKey(self.servers[server]))
+                                     for server in adopted])
+        self.state_store.sync()
+        if adopted:
+            self.status_version += 1
+        return len(adopted)
+        
+        
+    def exportServers(self, server_names):
+        """
+        Returns the given servers (those of them we are tracking) as they are
+        recorded in our state store, i.e., as a list of (server name,
+        ping interval, probe spec) tuples, so that they can be handed over
+        to another tracker's adoptServers()
+        
+        :param server_names = list of names of the servers to copy out
+        """
+        return [(server, self.servers[server].interval,
+                 specKey(self.servers[server]))
+                for server in server_names if server in self.servers]
+        
+        
+    def _restoreServers(self, known_servers):
+        """
+        Starts tracking the given servers as read in from a state store,
+        each with an 'Unknown' status and its first ping spread out over its
+        first interval (any we can't make sense of are skipped)
+        
+        :param known_servers = list of (server name, ping interval,
+        probe spec) tuples, as read in from a state store
+        
+        Returns the names of the servers read in
+        """
+        # update our servers with the records we know about
+        # while we update, we'll keep track of the ones
+        # we can successfully read in
+        restored = []
+        now = monotonicTime()
+        for server, interval, probe in known_servers:
+            try:
+                interval = parseInterval(interval)
+                if probe:
+                    probe = storedProbe(parseProbeSpec(probe))
+                else:
+                    probe = None
+            except ValueError:
+                continue
+            # we won't know whether the server is online or offline
+            # until its first ping comes back
+            self.servers[server] = ServerRecord(server, interval, 'Unknown', now,
+                                                probe)
+            # stagger the first pings evenly over each server's interval,
+            # so that they don't all go out on the very first heartbeat
+            offset = interval * len(restored) / float(len(known_servers))
+            self.scheduler.schedule(server, now + offset)
+            restored.append(server)
+        # repeat for every record from the state store
+        return restored
+        
+        
     def writeOutServers(self):
         """
-        Writes out our pseudo memory dump file such that, in case the
-        heartbeat server ever goes down, we can remember all of the servers
-        we are tracking
+        Writes out every server we are tracking, along with its status,
+        to our state store, such that, in case the heartbeat server ever
+        goes down, we can remember all of them
         
-        Overwrites any existing copy of that file
+        With the csv store, this atomically replaces any existing copy of
+        the dump file, and empties out the journal (since the file now has
+        every change)
         """
-        # we'll be writing out to the server tracker file, overwriting
-        # anything that may exist in it
-        global server_tracker_file
+        self.state_store.rotate()
+        self.state_store.compact([(record.name, record.interval, record.status,
+                                   specKey(record))
+                                  for record in self.servers.itervalues()])
+        return
         
-        with open(server_tracker_file, 'wb') as outfile:
-            # let's leverage the printStatus method we have
-            outfile.write(self.printStatus())
-            
+        
+    def syncJournal(self, lock = None):
+        """
+        Makes sure every change recorded in the state store has made it to
+        disk, and writes out the statuses (with the csv store, a fresh dump
+        file) once enough changes have built up
+        
+        Meant to be called periodically (i.e., once a heartbeat), so that
+        the disk is only waited on once for however many changes came in
+        
+        :param lock = the lock guarding the tracker, which we'll only hold
+        while copying out the servers for the statuses (the disk is
+        never waited on while holding it)
+        """
+        if lock is None:
+            lock = threading.Lock()
+        rows = None
+        with lock:
+            if self.state_store.needsCompaction():
+                # (with the csv store, every change up to now goes in the
+                # dump file, and every change after in a fresh journal)
+                rows = [(record.name, record.interval, record.status,
+                         specKey(record))
+                        for record in self.servers.itervalues()]
+                self.state_store.rotate()
+        self.state_store.sync()
+        if rows is not None:
+            self.state_store.compact(rows)
+        # and write out the pings since the last heartbeat to the history
+        self.history.flush()
         return
         
         
-    def addServer(self, server_name):
+    def probeIfUntracked(self, server_name, probe = None):
+        """
+        Pings a server ahead of adding it, if we aren't already tracking it,
+        so that addServer() and updatePingInterval() don't have to wait on
+        the ping while the lock is held
+        
+        This is safe to call without holding the lock, since it only looks
+        the server up (if the server is added by someone else in the
+        meantime, the result simply goes unused)
+        
+        :param server_name = name of the server
+        :param probe = the ProbeSpec it will be added with
+        (None for the default HTTP ping)
+        
+        Returns the ProbeResult of the ping, or None if the server is
+        already being tracked
         """
-        This function adds a server to our dictionary of online servers
+        if server_name in self.servers:
+            return None
+        return self.probe_engine.pingServer(server_name,
+                                            spec = storedProbe(probe))
+        
+        
+    def addServer(self, server_name, probe = None, result = None):
+        """
+        This function adds a server to our dictionary of servers
         and initializes the ping wait time to the default time
         
         :param server_name = name of the server to be tracked
+        :param probe = the ProbeSpec to ping the server with (if not given,
+        the default HTTP ping for a new server, or no change for a server
+        that is already tracked)
+        :param result = the ProbeResult from probeIfUntracked(), if the
+        server has already been pinged (otherwise, we'll ping it here)
         
         Returns nothing
         """
         # initialize a return body on requests
         return_body = None
         # make sure we're not already tracking the server
-        if server_name in self.online_servers or server_name in self.offline_servers:
-            # if so, print a message to the console and return
-            return_body = '{0} already being tracked'.format(server_name)
+        record = self.servers.get(server_name)
+        if record is not None:
+            # if so, there's nothing to change, unless it was given
+            # a different probe spec
+            if not self._changeProbe(record, probe):
+                return '{0} already being tracked'.format(server_name)
+            return_body = '{0} updated with probe {1}'.format(server_name,
+                                                              probe.key)
+            self.state_store.append('update', server_name, record.interval,
+                                    specKey(record))
         else:
             # otherwise, send a ping to the server to determine status
-            server_status = sendPing(server_name)
-            # and classify accordingly
-            if server_status == 'Online':
-                self.online_servers[server_name] = [0, default_ping_interval]
-            else:
-                self.offline_servers[server_name] = [0, default_ping_interval]
+            # (unless one has already been sent)
+            probe = storedProbe(probe)
+            if result is None:
+                result = self.probe_engine.pingServer(server_name, spec = probe)
+            server_status = self._recordPing(server_name, result)
+            now = monotonicTime()
+            record = ServerRecord(server_name, default_ping_interval,
+                                  'Unknown', now, probe)
+            self.servers[server_name] = record
+            # the next ping is due (about) one interval from now
+            status_changed, delay = self.probe_policy.update(record,
+                                                             server_status)
+            self.scheduler.schedule(server_name, now + delay)
 
             return_body = '{0} added with interval {1}'.format(server_name,
                                                                default_ping_interval)
                                                                
-        # write out our pseudo dump file
-        self.writeOutServers()
-        print 'New server written to dump file'
+            # record the new server in our state store
+            self.state_store.append('add', server_name, default_ping_interval,
+                                    specKey(record))
+            print 'New server written to state store'
+        self.status_version += 1
         
         return return_body
         
@@ -238,158 +584,461 @@ class ServerTracker:
         
         Returns a message to send to the requestor
         """
-        # check the online servers
-        if server_name in self.online_servers:
-            self.online_servers.pop(server_name)
-        # check the offline servers
-        elif server_name in self.offline_servers:
-            self.offline_servers.pop(server_name)
-        else:
+        if server_name not in self.servers:
             return 'Server already not currently tracked'
+        self.servers.pop(server_name)
+        self.metrics.pop(server_name, None)
+        # and stop scheduling pings to it
+        self.scheduler.unschedule(server_name)
             
-        # report, write out, and return
-        self.writeOutServers()
+        # report, record in the state store, and return
+        self.state_store.append('remove', server_name)
+        self.status_version += 1
         return 'Server {0} removed from tracking'.format(server_name)
         
         
-    def updatePingInterval(self, server_name, ping_interval):
+    def updatePingInterval(self, server_name, ping_interval, probe = None,
+                           result = None):
         """
         Updates the ping wait time interval for a particular server
         If that server is not currently being tracked, we will add it to our
         dictionary of tracked servers.
-        Also writes out our server tracker file.
+        Also records the change in our state store.
         
         :param server_name = name of the server to add/update
         :param ping_interval = time interval to wait between pings to this
         server
+        :param probe = the ProbeSpec to ping the server with (if not given,
+        the default HTTP ping for a new server, or no change for a server
+        that is already tracked)
+        :param result = the ProbeResult from probeIfUntracked(), if the
+        server has already been pinged (otherwise, we'll ping it here
+        if it needs to be added)
         
         Returns a message for the requestor
         """
         # initialize the return body we will send on requests
+        # and the kind of change we'll record in the state store
         return_body = '{0} updated with interval {1}'.format(server_name,
                                                              ping_interval)
-        # find out whether it is in the online or offline dictionary
-        if server_name in self.online_servers:
-            # update the online dictionary
-            self.online_servers[server_name] = [self.online_servers[server_name][0], ping_interval]
-        elif server_name in self.offline_servers:
-            # update the offline dictionary
-            self.offline_servers[server_name] = [self.offline_servers[server_name][0], ping_interval]
+        operation = 'update'
+        # find out whether we're tracking it already
+        record = self.servers.get(server_name)
+        if record is not None:
+            # update its record
+            self._changeInterval(record, ping_interval)
+            self._changeProbe(record, probe)
         else:
             # if it does not exist, we'll add it instead
             return_body = '{0} added with interval {1}'.format(server_name,
                                                                ping_interval)
-            # check the status
-            server_status = sendPing(server_name)
-            # classify accordingly
-            if server_status == 'Online':
-                self.online_servers[server_name] = [0, ping_interval]
-            else:
-                self.offline_servers[server_name] = [0, ping_interval]
+            operation = 'add'
+            # check the status (unless it has already been checked)
+            probe = storedProbe(probe)
+            if result is None:
+                result = self.probe_engine.pingServer(server_name, spec = probe)
+            server_status = self._recordPing(server_name, result)
+            now = monotonicTime()
+            record = ServerRecord(server_name, ping_interval, 'Unknown', now,
+                                  probe)
+            self.servers[server_name] = record
+            status_changed, delay = self.probe_policy.update(record,
+                                                             server_status)
+            self.scheduler.schedule(server_name, now + delay)
                 
-        # write to the pseudo dump file
-        self.writeOutServers()
-        print 'New/updated server written to dump file'
+        # record the change in our state store
+        self.state_store.append(operation, server_name, ping_interval,
+                                specKey(record))
+        self.status_version += 1
+        print 'New/updated server written to state store'
             
         return return_body
         
         
-    def incrementTimers(self):
+    def addServers(self, servers):
+        """
+        Adds or updates a whole batch of servers at once
+        
+        Each server given an interval is handled as in updatePingInterval(),
+        and each server without one is handled as in addServer(), except
+        that new servers are not pinged straight away -- they start out as
+        'Unknown' and are scheduled to be pinged on the next heartbeat.
+        All of the changes are recorded in the state store together.
+        
+        :param servers = list of (server name, ping interval, ProbeSpec)
+        tuples, where the interval and the probe spec are None
+        if none was given
+        
+        Returns a list of messages for the requestor, one for each server
+        """
+        results = []
+        changes = []
+        now = monotonicTime()
+        for server_name, ping_interval, probe in servers:
+            record = self.servers.get(server_name)
+            if record is not None:
+                probe_changed = self._changeProbe(record, probe)
+                if ping_interval is None:
+                    if not probe_changed:
+                        # nothing to change
+                        results.append('{0} already being tracked'.format(server_name))
+                        continue
+                    changes.append(('update', server_name, record.interval,
+                                    specKey(record)))
+                    results.append('{0} updated with probe {1}'.format(server_name,
+                                                                       probe.key))
+                    continue
+                self._changeInterval(record, ping_interval)
+                changes.append(('update', server_name, ping_interval,
+                                specKey(record)))
+                results.append('{0} updated with interval {1}'.format(server_name,
+                                                                      ping_interval))
+            else:
+                if ping_interval is None:
+                    ping_interval = default_ping_interval
+                # leave the first ping for the scheduler
+                record = ServerRecord(server_name, ping_interval, 'Unknown', now,
+                                      storedProbe(probe))
+                self.servers[server_name] = record
+                self.scheduler.schedule(server_name, now)
+                changes.append(('add', server_name, ping_interval,
+                                specKey(record)))
+                results.append('{0} added with interval {1}'.format(server_name,
+                                                                    ping_interval))
+                                                                    
+        # record all of the changes in our state store at once
+        self.state_store.appendMany(changes)
+        if changes:
+            self.status_version += 1
+            print '{0} new/updated servers written to state store'.format(len(changes))
+            
+        return results
+        
+        
+    def removeServers(self, server_names):
         """
-        Simply updates the counter by +1 for each server
+        Removes a whole batch of servers from tracking at once,
+        recording all of the removals in the state store together
         
-        We will subsequently ping all servers for which the counter is at
-        or exceeds the ping interval specified for the given server
+        :param server_names = list of names of the servers to stop tracking
+        
+        Returns a list of messages for the requestor, one for each server
         """
-        # online servers
-        for server in self.online_servers:
-            self.online_servers[server][0] += 1
-        # offline servers
-        for server in self.offline_servers:
-            self.offline_servers[server][0] += 1
+        results = []
+        changes = []
+        for server_name in server_names:
+            if server_name not in self.servers:
+                results.append('Server already not currently tracked')
+                continue
+            self.servers.pop(server_name)
+            self.metrics.pop(server_name, None)
+            self.scheduler.unschedule(server_name)
+            changes.append(('remove', server_name, None, None))
+            results.append('Server {0} removed from tracking'.format(server_name))
             
+        # record all of the removals in our state store at once
+        self.state_store.appendMany(changes)
+        if changes:
+            self.status_version += 1
+        return results
+        
+        
+    def _changeInterval(self, record, ping_interval):
+        """
+        Changes the ping interval of a server that is already tracked,
+        and reschedules its next ping accordingly
+        
+        :param record = the server's record
+        :param ping_interval = the new ping interval
+        """
+        record.interval = ping_interval
+        # the next ping is now due one (new) interval after the last ping,
+        # or right away if that time has already passed
+        self.scheduler.schedule(record.name,
+                                max(record.last_ping + ping_interval,
+                                    monotonicTime()))
         return
         
         
-    def pingAllDueServers(self):
+    def _changeProbe(self, record, probe):
         """
-        This function will increment the timing counter
-        associated with each server.  If the amount of time elapsed
-        since the last ping equals or exceeds the ping time interval,
-        then ping that server and reset our timing counter
+        Changes the probe spec of a server that is already tracked
+        
+        :param record = the server's record
+        :param probe = the new ProbeSpec (or None to leave it as it is)
         
-        For all servers that are no longer online, we will move them to offline
-        and vice versa
+        Returns whether the probe spec changed
         """
-        # initialize lists to keep track of newly online and offline servers
-        newly_online = []
-        newly_offline = []
+        if probe is None:
+            return False
+        # (every server with the same spec shares the same ProbeSpec)
+        probe = storedProbe(probe)
+        if probe is record.probe:
+            return False
+        record.probe = probe
+        return True
         
-        # step through the online servers
-        for server in self.online_servers:
-            # if this counter equals or exceeds the ping time interval,
-            # then we must ping the server and update the status
-            if self.online_servers[server][0] >= self.online_servers[server][1]:
-                status = sendPing(server)
-                # reset the counter
-                self.online_servers[server][0] = 0
-                
-                # update the status accordingly
-                if status == 'Offline':
-                    # remove from the online servers
-                    # and add to the offline servers simultaneously
-                    newly_offline.append({server: self.online_servers[server]})
-        # repeat for every online server
-        # remove the newly offline servers from the online tracker
-        for offline in newly_offline:
-            self.online_servers.pop(offline.keys()[0])
-                
-        # step through the offline servers
-        for server in self.offline_servers:
-            # again, ping the server if the amount of time elapsed equals
-            # or exceeds the ping time interval
-            if self.offline_servers[server][0] >= self.offline_servers[server][1]:
-                status = sendPing(server)
-                # reset the counter
-                self.offline_servers[server][0] = 0
-                
-                # update the status accordingly
-                if status == 'Online':
-                    # remove from the offline servers
-                    # and add to the online servers
-                    newly_online.append({server: self.offline_servers[server]})
-        # repeat for every offline server
-        # remove the newly online servers from the offline tracker
-        for online in newly_online:
-            self.offline_servers.pop(online.keys()[0])
+        
+    def pingAllDueServers(self, lock = None):
+        """
+        Pings every server that the scheduler says is due (i.e., every server
+        where the amount of time elapsed since the last ping equals or
+        exceeds the ping time interval) and then reschedules those servers
+        
+        All of the due pings are sent out together by the probe engine,
+        and we only touch the statuses once the whole batch has come back
+        (or the batch's deadline has passed)
+        
+        Any servers the probe engine didn't get to (before the deadline, or
+        because their host wasn't answering) are left due for the next tick,
+        behind any servers that are already overdue, so that they don't keep
+        the rest waiting
+        
+        For all servers that are no longer online, we will mark them offline
+        and vice versa (and any servers we didn't yet know the status of
+        are marked as whichever one they turned out to be)
+        
+        :param lock = the lock guarding the tracker, which we'll only hold
+        while picking out the due servers and while recording the results
+        (not while the pings are out)
+        """
+        if lock is None:
+            lock = threading.Lock()
+        with lock:
+            # grab every server that is due for a ping
+            # (or as many as our budget allows)
+            now = monotonicTime()
+            limit = None
+            if self.probe_budget is not None:
+                limit = self.probe_budget.available(now)
+            due_servers = []
+            while True:
+                wanted = None
+                if limit is not None:
+                    wanted = limit - len(due_servers)
+                    if wanted <= 0:
+                        break
+                popped = self.scheduler.popDueServers(now, wanted)
+                for server, due_time in popped:
+                    # servers that another node pings are just kept on
+                    # schedule, so that they are ready to go if they are
+                    # handed over to us (and don't count against our budget,
+                    # so we carry on until it is filled with our own)
+                    if self.owns is None or self.owns(server):
+                        due_servers.append((server, due_time))
+                    else:
+                        self._reschedule(self.servers[server], due_time, now)
+                # (once there are no more servers due, we have them all)
+                if wanted is None or len(popped) < wanted:
+                    break
+            if self.probe_budget is not None:
+                self.probe_budget.spend(len(due_servers))
+            # along with the shortest interval, and the probe spec of every
+            # server that isn't given the default HTTP ping
+            shortest_interval = None
+            specs = {}
+            for server, due_time in due_servers:
+                record = self.servers[server]
+                if shortest_interval is None or \
+                   record.interval < shortest_interval:
+                    shortest_interval = record.interval
+                if record.probe is not None:
+                    specs[server] = record.probe
+        # nothing to do if nothing is due
+        if not due_servers:
+            return
+            
+        # send out all of the pings at once and wait on the results
+        # (a cached result is only good enough if it is fresher than
+        # half of the shortest interval, so that fast servers still get
+        # a ping of their own on every beat)
+        results = self.probe_engine.pingServers([server for server, due_time
+                                                 in due_servers],
+                                                shortest_interval / 2.0, specs)
+        
+        with lock:
+            # keep track of whether any of the statuses changed
+            status_changed = False
+            unpinged_count = 0
+            retry_time = now
+            if not results:
+                retry_time += unpinged_retry_delay
+            for server, due_time in due_servers:
+                record = self.servers.get(server)
+                # skip any servers that were removed while the pings were out
+                # (or removed and added back, since those have a fresh record
+                # that has already been scheduled)
+                if record is None or record.last_ping > now:
+                    continue
+                result = results.get(server)
+                if result is None:
+                    # (not pinged, so it is still due)
+                    self.scheduler.schedule(server, max(due_time, retry_time))
+                    unpinged_count += 1
+                    continue
+                status = self._recordPing(server, result)
+                changed, delay = self.probe_policy.update(record, status)
+                status_changed = status_changed or changed
+                record.last_ping = now
+                self._reschedule(record, due_time, now, delay)
                     
-        # update the server tracking dictionaries accordingly
-        for on_server in newly_online:
-            self.online_servers.update(on_server)
-        for off_server in newly_offline:
-            self.offline_servers.update(off_server)
+            if status_changed:
+                self.status_version += 1
+            if unpinged_count and self.probe_budget is not None:
+                self.probe_budget.refund(unpinged_count)
             
         return
         
         
+    def _reschedule(self, record, due_time, now, delay = None):
+        """
+        Schedules the next ping to a server one interval (or the given delay)
+        after its last ping was due, so that a late tick doesn't push back
+        every ping after it
+        
+        If we've fallen more than an entire interval behind, though,
+        we skip the missed pings rather than firing them all at once
+        """
+        if delay is None:
+            delay = record.interval
+        next_due = due_time + delay
+        if next_due <= now:
+            next_due = now + delay
+        self.scheduler.schedule(record.name, next_due)
+        return
+        
+        
+    def applyStatuses(self, statuses):
+        """
+        Updates the statuses of servers that another node of the cluster
+        pings, as reported by that node
+        
+        :param statuses = dictionary of {server name: status}
+        (servers we aren't tracking, or that we ping ourselves, are skipped)
+        """
+        status_changed = False
+        for server_name, status in statuses.iteritems():
+            record = self.servers.get(server_name)
+            if record is None or record.status == status or \
+               status not in snapshot_statuses:
+                continue
+            if self.owns is not None and self.owns(server_name):
+                continue
+            record.status = status
+            status_changed = True
+        if status_changed:
+            self.status_version += 1
+        return
+        
+        
+    def _recordPing(self, server_name, result):
+        """
+        Records the result of a ping in the server's metrics
+        
+        :param server_name = name of the server that was pinged
+        :param result = the ProbeResult of the ping
+        
+        Returns the status the ping found the server in
+        """
+        metrics = self.metrics.get(server_name)
+        if metrics is None:
+            metrics = self.metrics[server_name] = ServerMetrics()
+        metrics.record(result)
+        self.history.record(server_name, result)
+        return result.status
+        
+        
+    def getServerMetrics(self, server_name):
+        """
+        Summarizes the pings to a server
+        
+        :param server_name = name of the server
+        
+        Returns a dictionary of the server's metrics (see ServerMetrics.py),
+        or None if the server isn't being tracked
+        """
+        record = self.servers.get(server_name)
+        if record is None:
+            return None
+        if server_name in self.metrics:
+            summary = self.metrics[server_name].summary()
+        else:
+            # nothing to summarize until the first ping comes back
+            summary = ServerMetrics(1).summary()
+        summary['server'] = server_name
+        summary['status'] = record.status
+        summary['probe'] = None
+        if record.probe is not None:
+            summary['probe'] = record.probe.describe()
+        return summary
+        
+        
+    def probeSpecs(self):
+        """
+        Returns a dictionary of {server name: probe spec (as a JSON string)}
+        for every server that isn't given the default HTTP ping
+        """
+        return dict((record.name, record.probe.key)
+                    for record in self.servers.itervalues()
+                    if record.probe is not None)
+        
+        
+    def getServerHistory(self, server_name, start, end, resolution = None):
+        """
+        Looks up the pings to a server over a range of time
+        (without needing the lock)
+        
+        :param server_name = name of the server
+        :param start = start of the range (seconds since the epoch)
+        :param end = end of the range (seconds since the epoch)
+        :param resolution = 'raw', 'minute', or 'hour'
+        (or None to pick whichever suits the range)
+        
+        Returns a dictionary of the server's history (see HistoryStore.py)
+        """
+        return self.history.query(server_name, start, end, resolution)
+        
+        
+    def secondsUntilNextPing(self):
+        """
+        Returns the number of seconds until the next server is due for a ping
+        (zero if a server is already due), or None if no servers are tracked
+        
+        If servers are already due but the probe budget has run out,
+        this is how long until the budget allows another ping
+        """
+        next_due = self.scheduler.nextDueTime()
+        if next_due is None:
+            return None
+        now = monotonicTime()
+        wait = max(next_due - now, 0)
+        if wait == 0 and self.probe_budget is not None:
+            wait = self.probe_budget.secondsUntilAvailable(now)
+        return wait
+        
+        
+    def statusSince(self, version):
+        """
+        Copies out the interval and status of every server, unless nothing
+        has changed since the given version
+        
+        :param version = the version of the last copy taken (or None)
+        
+        Returns a tuple of (version, list of (server name, ping interval,
+        status)), or None if we are still at the given version
+        """
+        if self.status_version == version:
+            return None
+        rows = [(record.name, record.interval, record.status)
+                for record in self.servers.itervalues()]
+        return self.status_version, rows
+        
+        
     def printStatus(self):
         """
         Prints out the status of all of the servers
         as well as the specified wait time intervals
         """
-        output = StringIO.StringIO()
-        # use a csv writer to write out each row
-        writer = csv.writer(output, lineterminator = '\n')
-        
-        # write the header
-        writer.writerow(['Server','Ping Interval','Status'])
-        
-        # write out the online servers
-        for server, interval in self.online_servers.iteritems():
-            writer.writerow([server, interval[1], 'Online'])
-            
-        # write out the offline servers
-        for server, interval in self.offline_servers.iteritems():
-            writer.writerow([server, interval[1], 'Offline'])
-            
-        return output.getvalue()
\ No newline at end of file
+        return formatStatus((record.name, record.interval, record.status,
+                             specKey(record))
+                            for record in self.servers.itervalues())
@@ -0,0 +1,647 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Sharded tracker definition
+
+This is the class that we will use to spread the servers we are tracking
+across several worker processes (shards), so that pinging the servers and
+processing the results isn't capped at what a single process can do.
+
+Each server belongs to exactly one shard, picked by hashing its name.  Each
+shard is a separate process running its own server tracker (see
+ServerTracker.py) with its own probe engine, its own heartbeat loop, and its
+own state store (see StateStore.py) and history directory:
+
+    heartbeat_state.shard0.db, heartbeat_history.shard0
+    heartbeat_state.shard1.db, heartbeat_history.shard1
+    ...
+
+(or heartbeat_server_dump.shard0.csv and heartbeat_server_dump.shard0.journal,
+and so on, with the csv state store, which the sqlite store migrates from)
+
+The sharded tracker itself lives in the front end (i.e., the Flask app) and
+has the same methods as a server tracker, so it can be used in its place.
+Adding, updating, and removing servers is passed along to the shard that
+owns each server, over a pipe to that shard's process.  Each call carries an
+id that its reply is matched up with, so that several calls can be waiting on
+a shard at once: the calls that may wait on a ping (of a new server) or on
+the disk are answered by the shard in their own threads, so that one slow
+server never holds up the calls behind it.  The statuses of
+the servers are merged together from every shard, and only copied over again
+once one of the shards reports that something has changed.
+
+Since the owner of each server depends on the number of shards, each shard
+reports back any servers it reads in that it no longer owns (i.e., that were
+added under a different number of shards) once it starts up.  These are
+handed over to the shards that own them now, and are only dropped by the
+shard that read them in once their owners have recorded them.  Likewise, the
+servers in any state store that none of the shards read in (the unsharded
+one, from before we were sharded, or those of any shards past the last one,
+from when there were more of them) are handed over to the shards that own
+them, and the files of that state store are then renamed with a .migrated
+suffix (see StateStore.py).  Going back down to a single shard (i.e.,
+unsharded) picks up the servers of every shard in the same way.  Note that the
+history of each server stays in the history directory it was kept in.
+
+
+Methods:
+--------
+shardFor(server name, shard count)
+    - returns the index of the shard that owns the given server
+
+leftoverStateStores(shard count, state store kind)
+    - returns the files of every state store on disk that the given number
+    of shards won't read in
+
+adoptLeftoverServers(shard count, state store kind, adopt function)
+    - hands the servers in every leftover state store to the given function,
+    setting aside each state store once it has
+
+readInServers()
+    - starts up every shard process, each of which reads in its own
+    state store, and waits until they are all ready
+    - then hands any servers read in by the wrong shard, or left behind in
+    a leftover state store, over to the shards that own them
+
+addServer / removeServer / updatePingInterval / addServers / removeServers /
+getServerMetrics / getServerHistory
+    - as in ServerTracker.py, passed along to the shard(s) that own
+    the given servers (each shard pings new servers itself)
+
+probeSpecs()
+    - as in ServerTracker.py, but for the servers across every shard
+
+pingAllDueServers() / syncJournal() / secondsUntilNextPing() /
+probeIfUntracked()
+    - nothing to do, since each shard runs its own heartbeat
+
+statusSince(version)
+    - as in ServerTracker.py, but for the servers across every shard
+
+stop()
+    - stops every shard process, letting each one flush its changes to disk
+"""
+# imports
+import glob
+import itertools
+import multiprocessing
+import os
+import threading
+import traceback
+import zlib
+from HeartbeatLoop import HeartbeatLoop
+from ProbeEngine import default_max_in_flight
+from ServerTracker import ServerTracker
+from ServerTracker import server_tracker_file, server_journal_file
+from ServerTracker import server_state_file
+from StateStore import default_state_store, stateStoreFiles
+from StateStore import readStateStore, retireStateStore
+
+# global for the pattern of each shard's state store files
+shard_tracker_file = 'heartbeat_server_dump.shard{0}.csv'
+shard_journal_file = 'heartbeat_server_dump.shard{0}.journal'
+shard_state_file = 'heartbeat_state.shard{0}.db'
+shard_history_dir = 'heartbeat_history.shard{0}'
+# the server tracker methods that the front end may call on a shard
+shard_methods = ('addServer', 'removeServer', 'updatePingInterval',
+                 'addServers', 'removeServers', 'getServerMetrics',
+                 'getServerHistory', 'statusSince', 'probeSpecs',
+                 'adoptServers')
+# and those of them that may need to ping a new server
+# (which is done before taking the lock, with the probe spec
+# that is passed as their last argument)
+probing_methods = ('addServer', 'updatePingInterval')
+# and those of them that don't need the lock
+# (so that they don't hold up the shard's heartbeat)
+unlocked_methods = ('getServerHistory',)
+# the calls that may wait on the network or the disk, which are answered
+# in their own threads
+threaded_methods = probing_methods + unlocked_methods
+
+
+def shardFor(server_name, shard_count):
+    """
+    Returns the index of the shard that owns the given server
+
+    Uses a CRC of the server name (rather than Python's own hash), so that
+    a server is owned by the same shard from one run to the next
+    """
+    if isinstance(server_name, unicode):
+        server_name = server_name.encode('utf-8')
+    return (zlib.crc32(server_name) & 0xffffffff) % shard_count
+
+
+def leftoverStateStores(shard_count, state_store):
+    """
+    Returns the files of every state store on disk that the given number of
+    shards won't read in: the unsharded state store (unless there is only
+    the one shard, i.e., we are unsharded), and those of any shards past the
+    last one
+
+    :param shard_count = the number of shards we are running
+    :param state_store = the kind of state store the shards keep
+
+    Returns a list of (dump file, journal file, database file)
+    """
+    leftovers = []
+    first_index = 0
+    if shard_count > 1:
+        leftovers.append((server_tracker_file, server_journal_file,
+                          server_state_file))
+        first_index = shard_count
+    # (a shard with no servers may have no files at all, so rather than
+    # counting up from the last shard, we'll look for every shard's files)
+    shard_indexes = set()
+    for pattern in (shard_tracker_file, shard_journal_file, shard_state_file):
+        prefix, suffix = pattern.split('{0}')
+        for shard_file in glob.glob(prefix + '*' + suffix):
+            shard_index = shard_file[len(prefix):len(shard_file) - len(suffix)]
+            if shard_index.isdigit() and int(shard_index) >= first_index:
+                shard_indexes.add(int(shard_index))
+    for shard_index in sorted(shard_indexes):
+        leftovers.append((shard_tracker_file.format(shard_index),
+                          shard_journal_file.format(shard_index),
+                          shard_state_file.format(shard_index)))
+    return [store_files for store_files in leftovers
+            if any(os.path.exists(store_file) for store_file in
+                   stateStoreFiles(state_store, *store_files))]
+
+
+def adoptLeftoverServers(shard_count, state_store, adopt):
+    """
+    Hands the servers in every leftover state store (see
+    leftoverStateStores()) to the given function, and then sets that state
+    store aside, so that it is never read in again
+
+    Each state store is only set aside once its servers have been handed
+    over, so that if we go down partway through, the rest are handed over
+    the next time we start up
+
+    :param shard_count = the number of shards we are running
+    :param state_store = the kind of state store the shards keep
+    (if not given, the default kind)
+    :param adopt = function taking a list of (server name, ping interval,
+    probe spec) and recording them in the state store(s) we are running with
+
+    Returns the number of servers handed over
+    """
+    if state_store is None:
+        state_store = default_state_store
+    adopted_count = 0
+    for store_files in leftoverStateStores(shard_count, state_store):
+        servers = readStateStore(state_store, *store_files) or []
+        if servers:
+            adopted_count += adopt(servers)
+        retireStateStore(state_store, *store_files)
+        print 'Handed over {0} servers left in {1}'.format(
+            len(servers), ', '.join(store_files))
+    return adopted_count
+
+
+def runShard(shard_index, shard_count, connection, heartbeat_tick,
+             max_in_flight, probe_budget, state_store):
+    """
+    The main function of a shard process
+
+    Reads in the shard's servers, starts its heartbeat, and then answers
+    calls from the front end until it is asked to stop (or the front end
+    goes away)
+
+    :param shard_index = the index of this shard
+    :param shard_count = the number of shards
+    :param connection = this shard's end of the pipe to the front end
+    :param heartbeat_tick = longest to go between heartbeats, in seconds
+    :param max_in_flight = most pings to allow in flight at once
+    :param probe_budget = most pings to send out per second (or None)
+    :param state_store = the kind of state store to keep the servers in
+    """
+    tracker = ServerTracker(max_in_flight,
+                            tracker_file = shard_tracker_file.format(shard_index),
+                            journal_file = shard_journal_file.format(shard_index),
+                            probe_budget = probe_budget,
+                            history_dir = shard_history_dir.format(shard_index),
+                            state_store = state_store,
+                            state_file = shard_state_file.format(shard_index))
+    tracker.readInServers()
+    # the servers that another shard owns (i.e., that were added under
+    # a different number of shards), which the front end hands over to
+    # their owners before asking us to drop them
+    stray_servers = tracker.exportServers([server for server in tracker.servers
+                                           if shardFor(server, shard_count) !=
+                                           shard_index])
+    # the heartbeat and the calls from the front end take turns
+    # with the tracker, just like in the front end of an unsharded server
+    lock = threading.Lock()
+
+    def heartbeatCheck():
+        tracker.pingAllDueServers(lock)
+        tracker.syncJournal(lock)
+        with lock:
+            return tracker.secondsUntilNextPing()
+
+    def drainHeartbeat():
+        tracker.syncJournal(lock)
+
+    heartbeat_loop = HeartbeatLoop(heartbeatCheck, heartbeat_tick,
+                                   drain = drainHeartbeat)
+    heartbeat_loop.start()
+    # (the replies may come from several threads at once)
+    send_lock = threading.Lock()
+
+    def reply(call_id, outcome, result):
+        with send_lock:
+            connection.send((call_id, outcome, result))
+
+    def answer(call_id, method, args):
+        try:
+            if method not in shard_methods:
+                raise ValueError('Unknown shard method {0}'.format(method))
+            if method in probing_methods:
+                args = args + (tracker.probeIfUntracked(args[0], args[-1]),)
+            if method in unlocked_methods:
+                result = getattr(tracker, method)(*args)
+            else:
+                with lock:
+                    result = getattr(tracker, method)(*args)
+            reply(call_id, 'ok', result)
+        except Exception:
+            reply(call_id, 'error', traceback.format_exc())
+
+    reply(None, 'ok', (tracker.restore_time, stray_servers))
+    # the id of the call asking us to stop, which is answered once we have
+    stop_id = None
+    while True:
+        try:
+            call_id, method, args = connection.recv()
+        except EOFError:
+            # the front end has gone away
+            break
+        if method == 'stop':
+            stop_id = call_id
+            break
+        if method in threaded_methods:
+            thread = threading.Thread(target = answer,
+                                      args = (call_id, method, args))
+            thread.daemon = True
+            thread.start()
+        else:
+            answer(call_id, method, args)
+
+    # let the current heartbeat finish and flush out any changes
+    heartbeat_loop.stop(drain = True)
+    if stop_id is not None:
+        try:
+            reply(stop_id, 'ok', None)
+        except IOError:
+            pass
+    return
+
+
+class ShardedTracker:
+
+    def __init__(self, shard_count, heartbeat_tick = 1,
+                 max_in_flight = default_max_in_flight, probe_budget = None,
+                 state_store = None):
+        """
+        Initialization function
+
+        :param shard_count = the number of shard processes to run
+        :param heartbeat_tick = longest each shard will go between
+        heartbeats, in seconds
+        :param max_in_flight = most pings each shard will allow
+        in flight at once
+        :param probe_budget = most pings to send out per second across every
+        shard (or None for no limit), which is split evenly between them
+        :param state_store = the kind of state store each shard keeps its
+        servers in (if not given, the default kind is used)
+        """
+        self.shard_count = shard_count
+        self.heartbeat_tick = heartbeat_tick
+        self.max_in_flight = max_in_flight
+        self.shard_probe_budget = None
+        if probe_budget is not None:
+            self.shard_probe_budget = probe_budget / float(shard_count)
+        self.state_store = state_store
+        # the process, our end of the pipe, and a lock on sending down that
+        # pipe for each shard (filled in once the shards are started)
+        self.processes = []
+        self.connections = []
+        self.connection_locks = []
+        # the calls waiting on their replies, by call id, each of which is
+        # [shard index, event set once the reply is in, the reply]
+        self.call_ids = itertools.count()
+        self.pending_calls = {}
+        self.pending_lock = threading.Lock()
+        # the shards that have gone away
+        self.exited_shards = set()
+        # the longest any shard took to read in its servers, in seconds
+        self.restore_time = None
+        # the last (version, rows) we've seen from each shard
+        self.shard_status = [(None, [])] * shard_count
+
+
+    def readInServers(self):
+        """
+        Starts up every shard, each of which reads in its own state store,
+        and waits until they have all finished reading them in
+        """
+        for shard_index in xrange(self.shard_count):
+            connection, shard_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target = runShard,
+                                              args = (shard_index,
+                                                      self.shard_count,
+                                                      shard_connection,
+                                                      self.heartbeat_tick,
+                                                      self.max_in_flight,
+                                                      self.shard_probe_budget,
+                                                      self.state_store),
+                                              name = 'shard{0}'.format(shard_index))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+            self.connections.append(connection)
+            self.connection_locks.append(threading.Lock())
+
+        # the shards read in their servers in parallel, so we'll wait on them
+        # all once they've all been started
+        startups = [self._receive(shard_index)
+                    for shard_index in xrange(self.shard_count)]
+        self.restore_time = max(restore_time for restore_time, stray_servers
+                                in startups)
+        # and from then on, the replies are handed out by a thread per shard
+        for shard_index in xrange(self.shard_count):
+            thread = threading.Thread(target = self._receiveReplies,
+                                      args = (shard_index,),
+                                      name = 'shard{0}-replies'.format(shard_index))
+            thread.daemon = True
+            thread.start()
+
+        # hand the servers each shard read in but no longer owns over to
+        # their owners, and only then have that shard drop them
+        # (so that a server is never missing from every shard)
+        for shard_index, (restore_time, stray_servers) in enumerate(startups):
+            if stray_servers:
+                self._adoptServers(stray_servers)
+                self._call(shard_index, 'removeServers',
+                           [server for server, interval, probe
+                            in stray_servers])
+                print 'Shard {0} handed over {1} servers'.format(
+                    shard_index, len(stray_servers))
+        # along with the servers in any state store none of the shards read
+        adoptLeftoverServers(self.shard_count, self.state_store,
+                             self._adoptServers)
+        return
+
+
+    def stop(self, timeout = 10):
+        """
+        Stops every shard, letting each one finish its current heartbeat
+        and flush its changes out to disk
+
+        :param timeout = most seconds to wait for each shard
+        """
+        for shard_index in xrange(len(self.processes)):
+            try:
+                self._call(shard_index, 'stop')
+            except (EOFError, IOError, RuntimeError):
+                pass
+        for process in self.processes:
+            process.join(timeout)
+        return
+
+
+    def _receive(self, shard_index):
+        """
+        Waits on the message a shard sends once it has started up,
+        returning its result (or raising a RuntimeError if the shard failed)
+        """
+        call_id, outcome, result = self.connections[shard_index].recv()
+        return self._result(shard_index, outcome, result)
+
+
+    def _result(self, shard_index, outcome, result):
+        """
+        Returns the result of a call to a shard
+        (or raises a RuntimeError if the call failed in the shard)
+        """
+        if outcome != 'ok':
+            raise RuntimeError('Shard {0} failed:\n{1}'.format(shard_index,
+                                                                result))
+        return result
+
+
+    def _receiveReplies(self, shard_index):
+        """
+        Hands each reply from a shard to the call waiting on it, until the
+        shard goes away (failing any calls still waiting on it then)
+        """
+        while True:
+            try:
+                call_id, outcome, result = self.connections[shard_index].recv()
+            except (EOFError, IOError):
+                break
+            with self.pending_lock:
+                pending = self.pending_calls.pop(call_id, None)
+            if pending is not None:
+                pending[2] = (outcome, result)
+                pending[1].set()
+        with self.pending_lock:
+            self.exited_shards.add(shard_index)
+            for call_id, pending in self.pending_calls.items():
+                if pending[0] == shard_index:
+                    del self.pending_calls[call_id]
+                    pending[2] = ('error', 'The shard process has exited')
+                    pending[1].set()
+        return
+
+
+    def _call(self, shard_index, method, *args):
+        """
+        Calls a method of the server tracker in the given shard,
+        and waits on its result
+        """
+        call_id = next(self.call_ids)
+        pending = [shard_index, threading.Event(), None]
+        with self.pending_lock:
+            if shard_index in self.exited_shards:
+                raise RuntimeError('Shard {0} failed:\nThe shard process has '
+                                   'exited'.format(shard_index))
+            self.pending_calls[call_id] = pending
+        try:
+            with self.connection_locks[shard_index]:
+                self.connections[shard_index].send((call_id, method, args))
+        except Exception:
+            with self.pending_lock:
+                self.pending_calls.pop(call_id, None)
+            raise
+        pending[1].wait()
+        return self._result(shard_index, *pending[2])
+
+
+    def _callOwner(self, method, server_name, *args):
+        """
+        Calls a method of the server tracker in the shard that owns
+        the given server (which is passed along as the first argument)
+        """
+        return self._call(shardFor(server_name, self.shard_count), method,
+                          server_name, *args)
+
+
+    def _callEachOwner(self, method, items, server_name):
+        """
+        Splits a batch of items up by the shard that owns each one, calls
+        the given method of each of those shards with its part of the batch,
+        and puts the results back together in the order of the items
+
+        :param method = name of the bulk method to call
+        :param items = the batch of items
+        :param server_name = function returning the server name of an item
+        """
+        indexes_by_shard = {}
+        for index, item in enumerate(items):
+            shard_index = shardFor(server_name(item), self.shard_count)
+            indexes_by_shard.setdefault(shard_index, []).append(index)
+
+        results = [None] * len(items)
+        for shard_index, indexes in indexes_by_shard.iteritems():
+            shard_results = self._call(shard_index, method,
+                                       [items[index] for index in indexes])
+            for index, result in zip(indexes, shard_results):
+                results[index] = result
+        return results
+
+
+    def _adoptServers(self, known_servers):
+        """
+        Hands servers read in from some other state store over to the shards
+        that own them (see adoptServers() in ServerTracker.py)
+
+        Returns the number of servers taken over
+        """
+        servers_by_shard = {}
+        for known in known_servers:
+            shard_index = shardFor(known[0], self.shard_count)
+            servers_by_shard.setdefault(shard_index, []).append(known)
+        return sum(self._call(shard_index, 'adoptServers', servers)
+                   for shard_index, servers in servers_by_shard.iteritems())
+
+
+    def addServer(self, server_name, probe = None, result = None):
+        """
+        See ServerTracker.py (passed along to the shard that owns the server,
+        which pings the server itself)
+        """
+        return self._callOwner('addServer', server_name, probe)
+
+
+    def removeServer(self, server_name):
+        """
+        See ServerTracker.py (passed along to the shard that owns the server)
+        """
+        return self._callOwner('removeServer', server_name)
+
+
+    def updatePingInterval(self, server_name, ping_interval, probe = None,
+                           result = None):
+        """
+        See ServerTracker.py (passed along to the shard that owns the server,
+        which pings the server itself if need be)
+        """
+        return self._callOwner('updatePingInterval', server_name, ping_interval,
+                               probe)
+
+
+    def addServers(self, servers):
+        """
+        See ServerTracker.py (passed along to the shards that own the servers)
+        """
+        return self._callEachOwner('addServers', servers, lambda item: item[0])
+
+
+    def removeServers(self, server_names):
+        """
+        See ServerTracker.py (passed along to the shards that own the servers)
+        """
+        return self._callEachOwner('removeServers', server_names,
+                                   lambda item: item)
+
+
+    def getServerMetrics(self, server_name):
+        """
+        See ServerTracker.py (passed along to the shard that owns the server)
+        """
+        return self._callOwner('getServerMetrics', server_name)
+
+
+    def getServerHistory(self, server_name, start, end, resolution = None):
+        """
+        See ServerTracker.py (passed along to the shard that owns the server)
+        """
+        return self._callOwner('getServerHistory', server_name, start, end,
+                               resolution)
+
+
+    def probeSpecs(self):
+        """
+        See ServerTracker.py (gathered up from every shard)
+        """
+        specs = {}
+        for shard_index in xrange(self.shard_count):
+            specs.update(self._call(shard_index, 'probeSpecs'))
+        return specs
+
+
+    def pingAllDueServers(self, lock = None):
+        """
+        Nothing to do, since each shard pings its own servers
+        """
+        return
+
+
+    def syncJournal(self, lock = None):
+        """
+        Nothing to do, since each shard keeps its own state store
+        """
+        return
+
+
+    def probeIfUntracked(self, server_name, probe = None):
+        """
+        Nothing to do, since each shard pings its own new servers
+        """
+        return None
+
+
+    def secondsUntilNextPing(self):
+        """
+        Nothing is ever due in the front end, since each shard
+        runs its own heartbeat
+        """
+        return None
+
+
+    def statusSince(self, version):
+        """
+        Copies out the interval and status of every server across every
+        shard, unless none of the shards have changed since the given version
+
+        :param version = the version of the last copy taken (or None)
+
+        Returns a tuple of (version, list of (server name, ping interval,
+        status)), or None if we are still at the given version
+        """
+        for shard_index in xrange(self.shard_count):
+            shard_version = self.shard_status[shard_index][0]
+            update = self._call(shard_index, 'statusSince', shard_version)
+            if update is not None:
+                self.shard_status[shard_index] = update
+
+        # every shard's version only ever goes up, so their sum does too
+        status_version = sum(shard_version for shard_version, rows
+                             in self.shard_status)
+        if status_version == version:
+            return None
+        rows = []
+        for shard_version, shard_rows in self.shard_status:
+            rows.extend(shard_rows)
+        return status_version, rows
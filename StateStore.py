@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+State store definitions
+
+These are the classes that we will use to remember which servers we are
+tracking (along with their ping intervals, probe specs, and last known
+statuses) across restarts.  There are two kinds of state store:
+
+    sqlite (the default)
+        - the servers are kept in an embedded SQLite database, in a single
+        table indexed by server name and by status:
+            servers (name TEXT PRIMARY KEY, interval NUMERIC,
+                     status TEXT, probe TEXT)
+        - the database is in WAL mode, so every batch of changes is a single
+        small transaction appended to the write-ahead log (which survives the
+        process dying straight away), and only the checkpoint once a heartbeat
+        waits on the disk (which makes it survive the machine dying too)
+        - nothing ever has to be rewritten in full: every so often, the
+        statuses that have changed since they were last written are updated
+        in small batches, and the database can be looked at from outside
+        while we are running, e.g.
+            sqlite3 heartbeat_state.db "select name from servers
+                                        where status = 'Offline'"
+
+    csv
+        - the original dump file and journal (see ServerJournal.py), where
+        every change is appended to the journal, and the whole dump file is
+        rewritten every so often
+
+Both kinds have the same methods, so the server tracker doesn't need to know
+which one it has (and other kinds can be added to the state_stores registry).
+Every change is recorded with append() or appendMany(), which are cheap enough
+to call while holding the server tracker lock; sync(), rotate(), and compact()
+are meant to be called once a heartbeat, with compact() (and the disk) never
+waited on while holding it.
+
+The first time the sqlite store is opened, if there is no database yet but
+there is a dump file (or a journal) from the csv store, the servers in it are
+copied over into the database, which is then swapped in all at once, and the
+dump file and journal are renamed with a .migrated suffix (so that they are
+kept around, but never copied over again).
+
+A state store that is no longer going to be used (e.g., one left behind by a
+different number of shards, see ShardedTracker.py) can be read in once with
+readStateStore(), and then set aside with retireStateStore() once its servers
+have been recorded elsewhere, which renames its files with the same suffix.
+
+
+Methods:
+--------
+openStateStore(kind, dump file, journal file, database file)
+    - opens a state store of the given kind ('sqlite' or 'csv'),
+    copying the servers over from the csv store if need be
+
+migrateCsv(dump file, journal file, database file)
+    - copies the servers from the csv store into a new sqlite store
+
+readStateStore(kind, dump file, journal file, database file)
+    - returns every server in a state store of the given kind, or None if
+    there is no such state store on disk
+
+retireStateStore(kind, dump file, journal file, database file)
+    - renames the files of a state store with the migrated suffix, so that
+    they are never read in again
+
+SqliteStateStore.load()
+    - returns every server in the store, along with the number of changes
+    that still need to be folded into a snapshot (always none for sqlite)
+
+SqliteStateStore.append / appendMany / sync / needsCompaction / rotate /
+compact
+    - as in ServerJournal.py
+"""
+# imports
+import itertools
+import os
+import sqlite3
+import threading
+from Instrumentation import persistence_duration
+from PingScheduler import monotonicTime
+from ServerJournal import ServerJournal, rotated_suffix
+
+# global for the kind of state store used unless told otherwise
+default_state_store = 'sqlite'
+# global for how many changes we'll let build up before we bring the
+# statuses in the database up to date
+default_status_threshold = 1000
+# global for the most statuses we'll update in a single transaction,
+# so that the updates never hold up the changes coming in for long
+default_status_batch_size = 1000
+# global for how long to wait on the database if it is busy, in seconds
+database_timeout = 30
+# global for the suffix given to the csv files once they have been migrated
+migrated_suffix = '.migrated'
+
+# the statements every sqlite store runs
+create_statements = (
+    'CREATE TABLE IF NOT EXISTS servers (name TEXT PRIMARY KEY, '
+    'interval NUMERIC NOT NULL, status TEXT NOT NULL DEFAULT \'Unknown\', '
+    'probe TEXT)',
+    'CREATE INDEX IF NOT EXISTS servers_by_status ON servers (status)')
+upsert_statement = ('INSERT INTO servers (name, interval, probe) '
+                    'VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET '
+                    'interval = excluded.interval, probe = excluded.probe')
+delete_statement = 'DELETE FROM servers WHERE name = ?'
+status_statement = 'UPDATE servers SET status = ? WHERE name = ?'
+
+
+class SqliteStateStore:
+
+    def __init__(self, database_file,
+                 status_threshold = default_status_threshold):
+        """
+        Initialization function
+
+        :param database_file = the SQLite database to keep the servers in
+        :param status_threshold = number of changes to let build up before
+        it is time to bring the statuses up to date
+        """
+        self.database_file = database_file
+        self.status_threshold = status_threshold
+        # the connection that changes are written through (opened the
+        # first time we need it), and a second one for the checkpoints and
+        # status updates, so that those never hold up the changes
+        self.connection = None
+        self.sync_connection = None
+        # number of changes written since the last checkpoint,
+        # and since the statuses were last brought up to date
+        self.unsynced_count = 0
+        self.entry_count = 0
+        # appends come in under the server tracker lock, while syncs and
+        # compactions happen without it, so we keep our own (short) lock
+        # around each connection
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+
+
+    def _connect(self):
+        """
+        Opens a connection to the database, creating the table if need be
+        """
+        connection = sqlite3.connect(self.database_file,
+                                     timeout = database_timeout,
+                                     check_same_thread = False)
+        # the log survives the process dying as soon as a transaction
+        # commits, and the checkpoint in sync() makes it durable
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        with connection:
+            for statement in create_statements:
+                connection.execute(statement)
+        return connection
+
+
+    def close(self):
+        """
+        Closes the connections to the database (which are opened
+        again if they are needed)
+        """
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        with self.sync_lock:
+            if self.sync_connection is not None:
+                self.sync_connection.close()
+                self.sync_connection = None
+        return
+
+
+    def load(self):
+        """
+        Reads in every server in the database
+
+        Returns a tuple of (list of (server name, ping interval, probe spec),
+        number of changes to fold into a snapshot), where the probe spec is
+        None for the default HTTP ping, and there are never any changes
+        to fold in
+        """
+        with self.lock:
+            if self.connection is None:
+                self.connection = self._connect()
+            servers = self.connection.execute(
+                'SELECT name, interval, probe FROM servers').fetchall()
+        return servers, 0
+
+
+    def append(self, operation, server, interval = None, probe = None):
+        """
+        Records a single change in the database
+
+        :param operation = 'add', 'update', or 'remove'
+        :param server = name of the server that changed
+        :param interval = the server's new ping interval
+        (not needed for removals)
+        :param probe = the server's probe spec, as a JSON string
+        (None for the default HTTP ping)
+        """
+        self.appendMany([(operation, server, interval, probe)])
+        return
+
+
+    def appendMany(self, changes):
+        """
+        Records a batch of changes in the database, in a single transaction
+
+        :param changes = list of (operation, server name, ping interval,
+        probe spec) tuples, in the order the changes were made
+        """
+        if not changes:
+            return
+        start_time = monotonicTime()
+        with self.lock:
+            if self.connection is None:
+                self.connection = self._connect()
+            with self.connection:
+                # each run of the same kind of change goes in together
+                for removal, run in itertools.groupby(changes,
+                                                      lambda change: change[0] == 'remove'):
+                    if removal:
+                        self.connection.executemany(delete_statement,
+                                                    [(server,) for operation,
+                                                     server, interval, probe in run])
+                    else:
+                        self.connection.executemany(upsert_statement,
+                                                    [(server, interval, probe)
+                                                     for operation, server,
+                                                     interval, probe in run])
+            self.unsynced_count += len(changes)
+            self.entry_count += len(changes)
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('append',))
+        return
+
+
+    def _syncConnection(self):
+        """
+        Returns the connection for checkpoints and status updates
+        (which must be used while holding the sync lock)
+        """
+        if self.sync_connection is None:
+            self.sync_connection = self._connect()
+        return self.sync_connection
+
+
+    def sync(self):
+        """
+        Checkpoints the write-ahead log into the database, which forces
+        every change written so far out to disk
+
+        The changes coming in don't have to wait on this, since it is done
+        through our second connection
+        """
+        with self.lock:
+            if self.unsynced_count == 0:
+                return
+            self.unsynced_count = 0
+        start_time = monotonicTime()
+        with self.sync_lock:
+            self._syncConnection().execute('PRAGMA wal_checkpoint(PASSIVE)')
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('sync',))
+        return
+
+
+    def needsCompaction(self):
+        """
+        Returns whether or not enough changes have built up that it is time
+        to bring the statuses in the database up to date
+        """
+        return self.entry_count >= self.status_threshold
+
+
+    def rotate(self):
+        """
+        Nothing to set aside (every change is already in the database),
+        so this just starts counting the changes towards the next compaction
+        """
+        with self.lock:
+            self.entry_count = 0
+        return
+
+
+    def compact(self, rows):
+        """
+        Brings the statuses in the database up to date, a batch of servers
+        at a time (the servers themselves are already up to date)
+
+        Only the statuses that have changed are written, in order of server
+        name, so that the updates touch as few pages of the database as they
+        can (in whatever order they come in, they'd be all over the table)
+
+        :param rows = (server name, ping interval, status, probe spec)
+        of every server
+        """
+        start_time = monotonicTime()
+        with self.sync_lock:
+            connection = self._syncConnection()
+            written = dict(connection.execute('SELECT name, status FROM servers'))
+            # (leaving out any server removed since the rows were copied out)
+            changed = sorted((server, status) for server, interval, status,
+                             probe in rows
+                             if written.get(server, status) != status)
+            for start in xrange(0, len(changed), default_status_batch_size):
+                with connection:
+                    connection.executemany(status_statement,
+                                           [(status, server) for server, status
+                                            in changed[start:start +
+                                                       default_status_batch_size]])
+        persistence_duration.observe(monotonicTime() - start_time,
+                                     labels = ('compact',))
+        return
+
+
+def migrateCsv(tracker_file, journal_file, database_file):
+    """
+    Copies the servers in the csv dump file and journal into a new sqlite
+    database, and renames the csv files with the migrated suffix
+
+    The database is built alongside and then renamed into place, so that
+    a crash partway through leaves us with the csv files as they were
+
+    :param tracker_file = the csv dump file
+    :param journal_file = the csv journal
+    :param database_file = the sqlite database to create
+
+    Returns the number of servers copied over
+    """
+    servers, replayed_count = ServerJournal(tracker_file, journal_file).load()
+    temp_file = database_file + '.tmp'
+    for leftover in (temp_file, temp_file + '-wal', temp_file + '-shm'):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    store = SqliteStateStore(temp_file)
+    store.appendMany([('add', server, interval, probe or None)
+                      for server, interval, probe in servers])
+    # closing the last connection folds the log into the database itself
+    store.close()
+    os.rename(temp_file, database_file)
+    # (including the set-aside journal of a compaction that never finished)
+    for csv_file in (tracker_file, journal_file,
+                     journal_file + rotated_suffix):
+        if os.path.exists(csv_file):
+            os.rename(csv_file, csv_file + migrated_suffix)
+    return len(servers)
+
+
+def stateStoreFiles(kind, tracker_file, journal_file, database_file):
+    """
+    Returns the files on disk that make up a state store of the given kind
+    (for sqlite, including any csv files it has yet to copy the servers from)
+    """
+    csv_files = (tracker_file, journal_file, journal_file + rotated_suffix)
+    if kind == 'sqlite':
+        return (database_file, database_file + '-wal',
+                database_file + '-shm') + csv_files
+    return csv_files
+
+
+def openSqliteStore(tracker_file, journal_file, database_file):
+    """
+    Opens the sqlite store, first copying over the servers from the csv store
+    if there is no database yet
+    """
+    if not os.path.exists(database_file) and \
+       any(os.path.exists(csv_file) for csv_file in
+           (tracker_file, journal_file,
+            journal_file + rotated_suffix)):
+        migrated_count = migrateCsv(tracker_file, journal_file, database_file)
+        print 'Migrated {0} servers from {1} to {2}'.format(migrated_count,
+                                                           tracker_file,
+                                                           database_file)
+    return SqliteStateStore(database_file)
+
+
+def openCsvStore(tracker_file, journal_file, database_file):
+    """
+    Opens the csv store (the database file goes unused)
+    """
+    return ServerJournal(tracker_file, journal_file)
+
+
+# the kinds of state store, by name
+state_stores = {'sqlite': openSqliteStore, 'csv': openCsvStore}
+
+
+def openStateStore(kind, tracker_file, journal_file, database_file):
+    """
+    Opens a state store of the given kind
+
+    :param kind = 'sqlite' or 'csv'
+    :param tracker_file = the csv dump file
+    :param journal_file = the csv journal
+    :param database_file = the sqlite database
+
+    Raises a ValueError if there is no such kind of state store
+    """
+    if kind not in state_stores:
+        raise ValueError('State store must be one of: {0}'.format(
+            ', '.join(sorted(state_stores))))
+    return state_stores[kind](tracker_file, journal_file, database_file)
+
+
+def readStateStore(kind, tracker_file, journal_file, database_file):
+    """
+    Reads in every server in a state store of the given kind, without
+    keeping it open (e.g., to copy its servers into another state store)
+
+    :param kind = 'sqlite' or 'csv'
+    :param tracker_file = the csv dump file
+    :param journal_file = the csv journal
+    :param database_file = the sqlite database
+
+    Returns a list of (server name, ping interval, probe spec) as in load(),
+    or None if there is no such state store on disk
+    """
+    if not any(os.path.exists(store_file) for store_file in
+               stateStoreFiles(kind, tracker_file, journal_file,
+                               database_file)):
+        return None
+    store = openStateStore(kind, tracker_file, journal_file, database_file)
+    servers, replayed_count = store.load()
+    if isinstance(store, SqliteStateStore):
+        store.close()
+    return servers
+
+
+def retireStateStore(kind, tracker_file, journal_file, database_file):
+    """
+    Renames the files of a state store of the given kind with the migrated
+    suffix (once its servers have been copied elsewhere), so that they are
+    kept around, but never read in again
+
+    Returns the number of files renamed
+    """
+    renamed_count = 0
+    for store_file in stateStoreFiles(kind, tracker_file, journal_file,
+                                      database_file):
+        if os.path.exists(store_file):
+            os.rename(store_file, store_file + migrated_suffix)
+            renamed_count += 1
+    return renamed_count
+
+
+if __name__ == '__main__':
+    # migrate the default files by hand, e.g. ahead of an upgrade
+    from ServerTracker import server_tracker_file, server_journal_file
+    from ServerTracker import server_state_file
+    if os.path.exists(server_state_file):
+        print '{0} already exists'.format(server_state_file)
+    else:
+        print 'Migrated {0} servers to {1}'.format(
+            migrateCsv(server_tracker_file, server_journal_file,
+                       server_state_file), server_state_file)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Status snapshot definition
+
+This is the class that we will use to answer requests for the status of the
+servers we are tracking.  A snapshot is a frozen copy of every server's name,
+ping interval, and status, taken from the server tracker at a given version.
+The tracker bumps its version every time a status or interval actually
+changes, and hands back the same snapshot until it does, so that polling
+for the status of a large number of servers doesn't have to rebuild
+(or re-serialize) anything when nothing has changed.
+
+Within the snapshot, the servers are kept sorted by name, both all together
+and split up by status.  Paging through the servers uses the name of the last
+server on the previous page as a cursor, so that each page can be found with
+a binary search rather than by stepping through every server before it.
+
+
+Methods:
+--------
+page(status, cursor, limit)
+    - returns up to limit servers (optionally of a single status) whose names
+    come after the cursor, along with the cursor for the next page
+
+lookup(server name)
+    - returns the (server name, ping interval, status) of a single server,
+    or None if the server isn't being tracked
+
+toCsv()
+    - returns every server as CSV (in the same format as the dump file),
+    built the first time it is asked for
+"""
+# imports
+import StringIO
+import bisect
+import csv
+
+# the statuses a server can be in
+statuses = ('Online', 'Offline', 'Unknown')
+
+
+class StatusSnapshot:
+
+    def __init__(self, version, rows):
+        """
+        Initialization function
+
+        :param version = the tracker version this snapshot was taken at
+        :param rows = list of (server name, ping interval, status) tuples
+        """
+        self.version = version
+        # every server, sorted by name
+        self.rows = sorted(rows)
+        self.names = [row[0] for row in self.rows]
+        # and the same again for each status
+        self.rows_by_status = {}
+        self.names_by_status = {}
+        for status in statuses:
+            self.rows_by_status[status] = [row for row in self.rows
+                                           if row[2] == status]
+            self.names_by_status[status] = [row[0] for row in
+                                            self.rows_by_status[status]]
+        # the CSV of every server, built the first time it's asked for
+        self.csv = None
+
+
+    def page(self, status = None, cursor = None, limit = None):
+        """
+        Returns a single page of servers
+
+        :param status = only return servers with this status
+        (or servers of any status, if None)
+        :param cursor = only return servers whose names come after this one
+        (i.e., the name of the last server on the previous page)
+        :param limit = the most servers to return (or all of them, if None)
+
+        Returns a tuple of (list of (server name, ping interval, status),
+        cursor for the next page or None if this is the last page)
+        """
+        if status is None:
+            rows, names = self.rows, self.names
+        else:
+            rows = self.rows_by_status[status]
+            names = self.names_by_status[status]
+
+        # find where the page starts
+        start = 0
+        if cursor is not None:
+            start = bisect.bisect_right(names, cursor)
+        if limit is None:
+            end = len(rows)
+        else:
+            end = min(start + limit, len(rows))
+
+        page = rows[start:end]
+        next_cursor = None
+        if end < len(rows) and page:
+            next_cursor = page[-1][0]
+        return page, next_cursor
+
+
+    def lookup(self, server):
+        """
+        Looks up a single server
+
+        :param server = name of the server to look up
+
+        Returns a tuple of (server name, ping interval, status),
+        or None if the server isn't being tracked
+        """
+        index = bisect.bisect_left(self.names, server)
+        if index < len(self.names) and self.names[index] == server:
+            return self.rows[index]
+        return None
+
+
+    def toCsv(self):
+        """
+        Returns every server in the snapshot as CSV,
+        using the same header as the dump file
+        """
+        if self.csv is None:
+            output = StringIO.StringIO()
+            writer = csv.writer(output, lineterminator = '\n')
+            writer.writerow(['Server','Ping Interval','Status'])
+            writer.writerows(self.rows)
+            self.csv = output.getvalue()
+        return self.csv
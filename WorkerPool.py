@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Worker pool definition
+
+These are the classes that we will use to serve the heartbeat server from
+several worker processes at once (e.g., under gunicorn, or with the pre-fork
+runner below), so that the number of requests we can answer isn't capped at
+what a single process can do, without every worker pinging every server.
+
+Of all the workers, only one is the probe owner: the worker that runs the
+server tracker and the heartbeat, exactly as a single process would.  The
+owner is elected with a lock on a file (see claimOwnership()): whichever
+worker takes the lock first is the owner, and every other worker waits on
+the lock in the background, so that if the owner dies (and the operating
+system lets go of its lock), one of the other workers takes over, reading
+the servers back in from the state store.
+
+The rest of the workers never touch a server tracker of their own:
+    - status requests are answered from a copy of the owner's latest status
+    snapshot (see StatusSnapshot.py), which the owner writes out to a local
+    file every time it publishes a new one (before answering the worker that
+    made the change, if any), and each worker reads back in, in the background
+    or else on the next status request once it finds the file has changed
+    (so a change is visible through every worker as soon as it is made)
+    - changes, stats, history, and events are passed along to the owner over
+    a Unix socket, through a remote tracker and a remote event hub that have
+    the same methods as the real ones, so that the request handlers don't
+    need to know which kind of worker they are running in
+
+Each thread of a worker keeps its own connection to the owner, so that a
+long-poll of /events only ever holds up the thread that is waiting on it.
+
+Note that the workers must be started up separately (i.e., without loading
+the application before forking, such as with gunicorn's --preload), so that
+each one takes part in the election.
+
+
+Methods:
+--------
+claimOwnership(lock file, wait)
+    - tries to take the probe owner lock, returning the open lock file
+    if we took it (or None, if another worker has it and we aren't waiting)
+
+OwnerServer.start() / stop()
+    - starts (or stops) answering the calls of the other workers,
+    in the probe owner
+
+OwnerClient.call(method, arguments)
+    - makes a call of the probe owner, and returns its result
+
+writeSnapshot(snapshot file, instance tag, snapshot)
+    - writes out a status snapshot for the other workers, atomically
+    replacing the last one
+
+SnapshotReader.changed()
+    - whether the status snapshot has changed since it was last read in
+
+SnapshotReader.read()
+    - reads the status snapshot back in, if it has changed
+
+serveWorkers(application factory, stop function, worker count, host, port)
+    - the pre-fork runner: serves the application from the given number of
+    worker processes, all accepting connections on the same socket, and
+    starts up a fresh worker in place of any that dies
+"""
+# imports
+import fcntl
+import marshal
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+from werkzeug.serving import make_server
+
+# global for the files the workers share, in the working directory
+owner_lock_file = 'heartbeat_owner.lock'
+owner_socket_file = 'heartbeat_owner.sock'
+status_snapshot_file = 'heartbeat_status.snapshot'
+# global for the longest a worker will wait on the probe owner
+# (e.g., while another worker is taking over as the owner), in seconds
+default_owner_wait = 10
+# global for how often a worker checks for a new status snapshot, in seconds
+default_snapshot_poll = 0.25
+# global for how many connections the pre-fork runner will let queue up
+listen_backlog = 128
+
+
+def claimOwnership(lock_file = owner_lock_file, wait = False):
+    """
+    Tries to take the probe owner lock
+
+    The lock is held for as long as the returned file is kept open, which
+    is normally until the process exits (at which point the operating system
+    lets go of it, however the process exits)
+
+    :param lock_file = the file to lock
+    :param wait = whether to wait until the lock is free (which may be never)
+
+    Returns the open lock file if we took the lock, or None otherwise
+    """
+    lock = open(lock_file, 'a')
+    flags = fcntl.LOCK_EX
+    if not wait:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(lock.fileno(), flags)
+    except IOError:
+        lock.close()
+        return None
+    return lock
+
+
+class OwnerServer:
+
+    def __init__(self, answer, socket_file = owner_socket_file):
+        """
+        Initialization function
+
+        :param answer = function answering a call of the owner, given the
+        name of the method called and a tuple of its arguments
+        :param socket_file = the Unix socket to listen on
+        """
+        self.answer = answer
+        self.socket_file = socket_file
+        self.listener = None
+        self.stopping = False
+
+
+    def start(self):
+        """
+        Starts listening for the other workers, each of which is answered
+        in its own thread
+        """
+        # (a socket left behind by an owner that died can't be listened on,
+        # and we're the only owner now, so nobody else is using it)
+        if os.path.exists(self.socket_file):
+            os.remove(self.socket_file)
+        self.listener = Listener(self.socket_file, 'AF_UNIX')
+        # calls are pickled, so only we should be able to make them
+        os.chmod(self.socket_file, 0600)
+        thread = threading.Thread(target = self._accept, name = 'owner-server')
+        thread.daemon = True
+        thread.start()
+        return
+
+
+    def stop(self):
+        """
+        Stops listening for the other workers
+        """
+        if self.listener is None or self.stopping:
+            return
+        self.stopping = True
+        # wake up the listening thread, so that it sees we're stopping
+        try:
+            Client(self.socket_file, 'AF_UNIX').close()
+        except (IOError, OSError, socket.error):
+            pass
+        return
+
+
+    def _accept(self):
+        """
+        Accepts connections from the other workers until we are stopped
+        """
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (IOError, OSError, socket.error):
+                if self.stopping:
+                    break
+                continue
+            if self.stopping:
+                connection.close()
+                break
+            thread = threading.Thread(target = self._answerCalls,
+                                      args = (connection,),
+                                      name = 'owner-connection')
+            thread.daemon = True
+            thread.start()
+        self.listener.close()
+        return
+
+
+    def _answerCalls(self, connection):
+        """
+        Answers the calls coming in over a single connection,
+        until the worker at the other end goes away
+        """
+        while True:
+            try:
+                method, args = connection.recv()
+            except (EOFError, IOError):
+                break
+            try:
+                reply = ('ok', self.answer(method, args))
+            except Exception:
+                reply = ('error', traceback.format_exc())
+            try:
+                connection.send(reply)
+            except (IOError, ValueError):
+                break
+        connection.close()
+        return
+
+
+class OwnerClient:
+
+    def __init__(self, socket_file = owner_socket_file,
+                 wait = default_owner_wait):
+        """
+        Initialization function
+
+        :param socket_file = the Unix socket the probe owner listens on
+        :param wait = longest to wait on the owner to be listening, in seconds
+        """
+        self.socket_file = socket_file
+        self.wait = wait
+        # each thread's own connection to the owner
+        self.local = threading.local()
+
+
+    def _connect(self):
+        """
+        Returns this thread's connection to the owner, connecting first
+        if need be (and waiting up to our wait for the owner to listen)
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            return connection
+        deadline = time.time() + self.wait
+        while True:
+            try:
+                connection = Client(self.socket_file, 'AF_UNIX')
+                break
+            except (IOError, OSError, socket.error):
+                if time.time() >= deadline:
+                    raise RuntimeError('No probe owner to call')
+                time.sleep(0.1)
+        self.local.connection = connection
+        return connection
+
+
+    def call(self, method, *args):
+        """
+        Calls a method of the probe owner, and waits on its result
+        (raising a RuntimeError if the call failed in the owner)
+
+        If the owner has gone away since we last called it, we'll
+        connect to whichever worker has taken over and call that instead
+        """
+        for attempt in (0, 1):
+            connection = self._connect()
+            try:
+                connection.send((method, args))
+                outcome, result = connection.recv()
+                break
+            except (EOFError, IOError):
+                connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise RuntimeError('Lost the probe owner')
+        if outcome != 'ok':
+            raise RuntimeError('Probe owner failed:\n{0}'.format(result))
+        return result
+
+
+class RemoteTracker:
+
+    def __init__(self, client):
+        """
+        A stand-in for the server tracker, in a worker that isn't the probe
+        owner, passing every call along to the owner
+
+        :param client = the OwnerClient
+        """
+        self.client = client
+        # we never read in any servers ourselves
+        self.restore_time = None
+
+
+    def probeIfUntracked(self, server_name, probe = None):
+        """
+        See ServerTracker.py (passed along to the owner, which pings the
+        server without holding its lock and hands back the result)
+        """
+        return self.client.call('probeIfUntracked', server_name, probe)
+
+
+    def addServer(self, server_name, probe = None, result = None):
+        """
+        See ServerTracker.py (passed along to the owner, which pings the
+        server itself if it hasn't been already)
+        """
+        return self.client.call('addServer', server_name, probe, result)
+
+
+    def removeServer(self, server_name):
+        """
+        See ServerTracker.py (passed along to the owner)
+        """
+        return self.client.call('removeServer', server_name)
+
+
+    def updatePingInterval(self, server_name, ping_interval, probe = None,
+                           result = None):
+        """
+        See ServerTracker.py (passed along to the owner, which pings the
+        server itself if need be and it hasn't been already)
+        """
+        return self.client.call('updatePingInterval', server_name,
+                                ping_interval, probe, result)
+
+
+    def addServers(self, servers):
+        """
+        See ServerTracker.py (passed along to the owner)
+        """
+        return self.client.call('addServers', servers)
+
+
+    def removeServers(self, server_names):
+        """
+        See ServerTracker.py (passed along to the owner)
+        """
+        return self.client.call('removeServers', server_names)
+
+
+    def getServerMetrics(self, server_name):
+        """
+        See ServerTracker.py (passed along to the owner)
+        """
+        return self.client.call('getServerMetrics', server_name)
+
+
+    def getServerHistory(self, server_name, start, end, resolution = None):
+        """
+        See ServerTracker.py (passed along to the owner)
+        """
+        return self.client.call('getServerHistory', server_name, start, end,
+                                resolution)
+
+
+    def probeSpecs(self):
+        """
+        See ServerTracker.py (passed along to the owner)
+        """
+        return self.client.call('probeSpecs')
+
+
+class RemoteSubscriber(object):
+
+    __slots__ = ('subscription_id',)
+
+    def __init__(self, subscription_id):
+        """
+        A webhook registered with the probe owner's event hub
+        """
+        self.subscription_id = subscription_id
+
+
+class RemoteEventHub:
+
+    def __init__(self, client):
+        """
+        A stand-in for the event hub, in a worker that isn't the probe owner,
+        passing every call along to the owner (so that every worker hands out
+        the same events, and each webhook is only delivered to once)
+
+        :param client = the OwnerClient
+        """
+        self.client = client
+
+
+    def eventsSince(self, seq, timeout, limit = None):
+        """
+        See Notifications.py (passed along to the owner)
+        """
+        args = (seq, timeout) if limit is None else (seq, timeout, limit)
+        return self.client.call('eventsSince', *args)
+
+
+    def subscribe(self, url):
+        """
+        See Notifications.py (passed along to the owner)
+        """
+        return RemoteSubscriber(self.client.call('subscribe', url))
+
+
+    def unsubscribe(self, subscription_id):
+        """
+        See Notifications.py (passed along to the owner)
+        """
+        return self.client.call('unsubscribe', subscription_id)
+
+
+    def describe(self):
+        """
+        See Notifications.py (passed along to the owner)
+        """
+        return self.client.call('describeSubscriptions')
+
+
+def writeSnapshot(snapshot_file, instance_tag, snapshot):
+    """
+    Writes out a status snapshot for the other workers to read back in,
+    atomically replacing the last one (so that they never see a partial one)
+
+    The snapshot is written with marshal, which is by far the quickest way to
+    write out and read back in a long list of tuples, and is fine for files
+    that are only ever read back in by the same version of Python
+
+    :param snapshot_file = the file to write to
+    :param instance_tag = the tag of the owner's run (see HeartbeatServer.py)
+    :param snapshot = the StatusSnapshot
+    """
+    temp_file = snapshot_file + '.tmp'
+    with open(temp_file, 'wb') as outfile:
+        marshal.dump((instance_tag, snapshot.version, snapshot.rows), outfile)
+    os.rename(temp_file, snapshot_file)
+    return
+
+
+class SnapshotReader:
+
+    def __init__(self, snapshot_file = status_snapshot_file):
+        """
+        Initialization function
+
+        :param snapshot_file = the file the probe owner writes its status
+        snapshots to
+        """
+        self.snapshot_file = snapshot_file
+        # the (inode, modification time, size) of the file we last read in,
+        # so that we only read it in again once a new one has been written
+        self.identity = None
+
+
+    def changed(self):
+        """
+        Returns whether a new status snapshot has been written since we last
+        read one in (which only takes a stat, so it can be checked on every
+        status request)
+        """
+        try:
+            stat = os.stat(self.snapshot_file)
+        except OSError:
+            return False
+        return (stat.st_ino, stat.st_mtime, stat.st_size) != self.identity
+
+
+    def read(self):
+        """
+        Reads in the status snapshot, if a new one has been written since
+        we last read it in
+
+        Returns a tuple of (instance tag, version, rows), or None if the
+        snapshot hasn't changed (or hasn't been written yet)
+        """
+        try:
+            infile = open(self.snapshot_file, 'rb')
+        except IOError:
+            return None
+        with infile:
+            stat = os.fstat(infile.fileno())
+            identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+            if identity == self.identity:
+                return None
+            try:
+                tag, version, rows = marshal.load(infile)
+            except (EOFError, ValueError, TypeError):
+                return None
+        self.identity = identity
+        return tag, version, rows
+
+
+def runWorker(app_factory, stop, listener):
+    """
+    The main function of a worker process of the pre-fork runner
+
+    Starts up the application, and serves it on the shared socket (one thread
+    per request) until the process is asked to stop
+    """
+    # a stop from the runner (or Ctrl+C) stops the server below
+    def stopWorker(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stopWorker)
+    try:
+        app = app_factory()
+        host, port = listener.getsockname()[:2]
+        server = make_server(host, port, app, threaded = True,
+                             fd = listener.fileno())
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # (and nothing stops us partway through stopping)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        stop()
+    return
+
+
+def serveWorkers(app_factory, stop, worker_count, host = '127.0.0.1',
+                 port = 5000):
+    """
+    Serves the application from several worker processes, all accepting
+    connections on the same socket, until we are stopped (with Ctrl+C or
+    a SIGTERM)
+
+    :param app_factory = function starting up the application in a worker,
+    and returning it
+    :param stop = function to call in a worker once it stops serving
+    :param worker_count = the number of worker processes to run
+    :param host = the address to listen on
+    :param port = the port to listen on
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(listen_backlog)
+    print 'Serving on http://{0}:{1}/ with {2} workers'.format(host, port,
+                                                                worker_count)
+
+    # {process id: worker number}
+    workers = {}
+    def startWorker(index):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                runWorker(app_factory, stop, listener)
+            finally:
+                os._exit(0)
+        workers[pid] = index
+        return
+
+    def stopRunner(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stopRunner)
+    try:
+        for index in xrange(worker_count):
+            startWorker(index)
+        while True:
+            pid, status = os.wait()
+            index = workers.pop(pid, None)
+            if index is not None:
+                print 'Worker {0} exited, starting it again'.format(index)
+                startWorker(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # let every worker finish up (and the owner flush out its changes)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        listener.close()
+    return
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Tests for the probe budget (see ProbePolicy.py)
+
+Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+# imports
+import unittest
+from ProbePolicy import ProbeBudget
+
+
+class ProbeBudgetTest(unittest.TestCase):
+
+    def testRateBelowOnePerSecond(self):
+        """
+        A budget of less than one ping a second still lets a ping out
+        every so often (e.g., a budget of 2 a second split across 4 shards)
+        """
+        budget = ProbeBudget(0.5)
+        self.assertEqual(budget.available(0), 1)
+        budget.spend(1)
+        self.assertEqual(budget.available(1), 0)
+        self.assertAlmostEqual(budget.secondsUntilAvailable(1), 1)
+        self.assertEqual(budget.available(2), 1)
+        # and never saves up more than a single ping
+        self.assertEqual(budget.available(100), 1)
+
+
+    def testRateCapsPingsPerSecond(self):
+        """
+        A budget holds at most a second's worth of pings
+        """
+        budget = ProbeBudget(10)
+        self.assertEqual(budget.available(0), 10)
+        budget.spend(10)
+        self.assertEqual(budget.available(0.5), 5)
+        self.assertEqual(budget.available(100), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
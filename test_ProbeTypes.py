@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+__author__ = 'mshadish'
+"""
+Tests for the probe types (see ProbeTypes.py)
+
+Run with:
+    python -m unittest discover -p 'test_*.py'
+"""
+# imports
+import sys
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest('ProbeTypes needs Python 2')
+
+from ProbeTypes import parseProbeSpec
+
+
+class HttpProbeTest(unittest.TestCase):
+
+    def testBodyDefaultsToGet(self):
+        """
+        A probe checking the body is sent with GET if no method is given,
+        since the client's default method may be HEAD
+        """
+        spec = parseProbeSpec({'type': 'http', 'body': 'OK'})
+        self.assertEqual(spec.options['method'], 'GET')
+        spec = parseProbeSpec({'type': 'http', 'method': 'post',
+                               'body': 'OK'})
+        self.assertEqual(spec.options['method'], 'POST')
+
+
+    def testBodyWithHead(self):
+        """
+        A probe can't check the body of a HEAD request
+        """
+        self.assertRaises(ValueError, parseProbeSpec,
+                          {'type': 'http', 'method': 'HEAD', 'body': 'OK'})
+
+
+    def testNoBodyKeepsDefaultMethod(self):
+        """
+        A probe without a body leaves the method to the client
+        """
+        spec = parseProbeSpec({'type': 'http', 'path': '/health'})
+        self.assertNotIn('method', spec.options)
+
+
+if __name__ == '__main__':
+    unittest.main()